@@ -26,7 +26,8 @@ def process_one_sweep(args):
 
   from xia2.Driver.DriverFactory import DriverFactory
   default_driver_type = DriverFactory.get_driver_type()
-  DriverFactory.set_driver_type(driver_type)
+  if driver_type is not None:
+    DriverFactory.set_driver_type(driver_type)
 
   curdir = os.path.abspath(os.curdir)
 
@@ -101,6 +102,66 @@ def process_one_sweep(args):
     DriverFactory.set_driver_type(default_driver_type)
     return success, output, xsweep_dict
 
+# the project being processed, set in the main process before forking the
+# sweep workers - see process_one_sweep_forked
+_forked_xinfo = None
+
+def set_forked_xinfo(xinfo):
+  global _forked_xinfo
+  _forked_xinfo = xinfo
+
+def process_one_sweep_forked(args):
+  '''Process one sweep in a worker forked from the main xia2 process, so
+  that everything is already imported and the project already set up: the
+  sweep is found from its crystal, wavelength and sweep ids and processed
+  in place, in its usual working directories.'''
+
+  assert len(args) == 1
+  args = args[0]
+
+  assert _forked_xinfo is not None
+
+  from xia2.Handlers.Phil import PhilIndex
+  from xia2.Handlers.Streams import Debug
+
+  mp_params = PhilIndex.params.xia2.settings.multiprocessing
+  mp_params.mode = 'serial'
+  mp_params.njob = 1
+  mp_params.nproc = args.nproc
+
+  # keep the output of this sweep together rather than interleaved with
+  # that of the other workers
+  Chatter.cache()
+  Debug.set_file(open('xia2-debug-%s-%s-%s.txt' % (
+    args.crystal_id, args.wavelength_id, args.sweep_id), 'w'))
+
+  wavelength = _forked_xinfo.get_crystals()[args.crystal_id].get_xwavelength(
+    args.wavelength_id)
+  sweep = [s for s in wavelength.get_sweeps()
+           if s.get_name() == args.sweep_id][0]
+
+  success = False
+  xsweep_dict = None
+
+  try:
+    if args.stop_after == 'index':
+      sweep.get_indexer_cell()
+    else:
+      sweep.get_integrater_intensities()
+    sweep.serialize()
+    xsweep_dict = sweep.to_dict()
+    success = True
+  except Exception, e:
+    if args.failover:
+      Chatter.write('Processing sweep %s failed: %s' % \
+                    (args.sweep_id, str(e)))
+    else:
+      raise
+  finally:
+    output = ''.join('%s\n' % record for record in Chatter.take_cached())
+
+  return success, output, xsweep_dict
+
 def get_sweep_output_only(all_output):
   sweep_lines = []
   in_sweep = False
@@ -0,0 +1,277 @@
+from __future__ import absolute_import, division
+
+# A small dependency-aware task scheduler for running sweeps in parallel:
+# tasks form a graph, and each is started as soon as all of the tasks it
+# depends on have completed. Pool tasks are run in a bounded pool of worker
+# processes, where each worker slot has a Driver type (so for example one
+# slot can run jobs on the local machine while the others submit to a
+# cluster), and are dispatched as soon as a slot becomes free. Local tasks
+# are run in the main process, e.g. scaling a crystal once all of its sweeps
+# have been integrated, while the pool carries on with the other tasks: a
+# slot freed while a local task runs is refilled straight away from the
+# pool's result thread.
+# Where worker processes may not be started (in a daemonic process, itself
+# a pool worker) the pool may be of threads instead, which suits tasks that
+# mostly wait for external programs.
+#
+# A pool task whose worker dies (e.g. killed when out of memory) or whose
+# result cannot be passed back never completes: each worker reports its
+# process id as it starts a task, so that the scheduler can notice that the
+# process has gone and raise an error rather than wait for ever.
+
+import errno
+import multiprocessing
+import os
+import cPickle as pickle
+import Queue
+import threading
+import traceback
+
+# queue on which each worker reports (task name, process id) as it starts
+# a task, set in the worker processes by the pool initializer: for worker
+# processes a SimpleQueue, which writes straight to the pipe, so that the
+# report is not lost if the worker dies before a feeder thread sends it
+
+_started = None
+
+def _init_worker(started):
+  global _started
+  _started = started
+
+  return
+
+def _run_task(name, func, args, driver_type):
+  '''Run func(*args) in a worker process with the given Driver type,
+  returning (True, result) or (False, (exception, traceback)) so that
+  exceptions are passed back to the scheduler - as RuntimeError if the
+  exception itself cannot be pickled.'''
+
+  from xia2.Driver.DriverFactory import DriverFactory
+
+  if _started is not None:
+    _started.put((name, os.getpid()))
+
+  try:
+    if driver_type is not None:
+      DriverFactory.set_driver_type(driver_type)
+    return True, func(*args)
+  except BaseException, e:
+    tb = traceback.format_exc()
+    try:
+      pickle.loads(pickle.dumps(e, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+      e = RuntimeError(str(e))
+    return False, (e, tb)
+
+def _process_exists(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno != errno.ESRCH
+  return True
+
+class task(object):
+  '''A node in the task graph.'''
+
+  def __init__(self, name, func, args, depends_on=None, local=False,
+               callback=None):
+    self.name = name
+    self.func = func
+    self.args = args
+    self.depends_on = list(depends_on or [])
+    self.local = local
+    self.callback = callback
+
+    # pending -> running -> finished (result available) -> done (callback
+    # has been run in the main process)
+    self.state = 'pending'
+    self.result = None
+
+    # for pool tasks, the AsyncResult and the id of the worker process
+    self.async_result = None
+    self.pid = None
+
+    return
+
+  def is_ready(self):
+    return self.state == 'pending' and \
+           all(t.state == 'done' for t in self.depends_on)
+
+class scheduler(object):
+  '''Run a graph of tasks, with pool tasks run in a bounded pool of worker
+  processes with one slot per entry in slots (the Driver type to use in
+  that slot) and local tasks run in the main process. If threads, the pool
+  is of threads, which share one Driver type.'''
+
+  def __init__(self, slots, threads=False):
+    assert len(slots) > 0
+    if threads:
+      assert len(set(slots)) == 1, 'threads share one Driver type'
+    self._threads = threads
+    self._slots = list(slots)
+    self._free_slots = list(range(len(self._slots)))
+    self._tasks = []
+    self._pool = None
+    self._lock = threading.Lock()
+    self._events = Queue.Queue()
+    self._started = None
+
+    return
+
+  def add_task(self, name, func, args, depends_on=None, local=False,
+               callback=None):
+    '''Add a task to the graph, returning it so that it may be used as a
+    dependency for other tasks. callback(result) is called in the main
+    process once the task is complete.'''
+
+    t = task(name, func, args, depends_on=depends_on, local=local,
+             callback=callback)
+    self._tasks.append(t)
+    return t
+
+  def _dispatch(self):
+    '''Start every ready pool task for which there is a free slot - must
+    be called with the lock held.'''
+
+    if self._pool is None:
+      return
+
+    for t in self._tasks:
+      if not self._free_slots:
+        break
+      if t.local or not t.is_ready():
+        continue
+      slot = self._free_slots.pop(0)
+      t.state = 'running'
+      t.async_result = self._pool.apply_async(
+        _run_task, (t.name, t.func, t.args, self._slots[slot]),
+        callback=lambda outcome, t=t, slot=slot: \
+          self._finished(t, slot, outcome))
+
+    return
+
+  def _check_running(self):
+    '''Raise an error for any pool task which will never complete: the
+    result could not be returned, or the worker process has died.'''
+
+    by_name = dict((t.name, t) for t in self._tasks)
+    while not self._started.empty():
+      name, pid = self._started.get()
+      by_name[name].pid = pid
+
+    for t in self._tasks:
+      if t.state != 'running' or t.async_result is None:
+        continue
+
+      if t.async_result.ready():
+        if not t.async_result.successful():
+          try:
+            t.async_result.get()
+          except Exception, e:
+            raise RuntimeError('task %s failed to return its result: %s' % \
+                               (t.name, str(e)))
+        continue
+
+      if t.pid is not None and not _process_exists(t.pid):
+        # the result may still be on its way from a worker which exited
+        # normally once the task was complete
+        t.async_result.wait(5)
+        if not t.async_result.ready():
+          raise RuntimeError('task %s lost: worker process %d died' % \
+                             (t.name, t.pid))
+
+    return
+
+  def _finished(self, t, slot, outcome):
+    '''Called in the pool result thread when a pool task completes: free
+    the slot, start the next ready task in it (the main thread may be busy
+    with a local task) and pass the outcome back to the main process.'''
+
+    with self._lock:
+      self._free_slots.append(slot)
+      t.state = 'finished'
+      self._dispatch()
+    self._events.put((t, outcome))
+
+    return
+
+  def _complete(self, t, result):
+    '''Record the result of a task in the main process.'''
+
+    t.result = result
+    if t.callback is not None:
+      t.callback(result)
+    with self._lock:
+      t.state = 'done'
+      self._dispatch()
+
+    return
+
+  def run(self):
+    '''Run all of the tasks, returning when they are all done.'''
+
+    from xia2.Handlers.Streams import Debug
+
+    n_pool = len([t for t in self._tasks if not t.local])
+
+    if n_pool and self._threads:
+      from multiprocessing.pool import ThreadPool
+      self._started = Queue.Queue()
+      self._pool = ThreadPool(
+        processes=min(len(self._slots), n_pool),
+        initializer=_init_worker, initargs=(self._started,))
+
+    elif n_pool:
+      from multiprocessing.queues import SimpleQueue
+      self._started = SimpleQueue()
+      self._pool = multiprocessing.Pool(
+        processes=min(len(self._slots), n_pool), maxtasksperchild=1,
+        initializer=_init_worker, initargs=(self._started,))
+
+    try:
+      with self._lock:
+        self._dispatch()
+
+      while any(t.state != 'done' for t in self._tasks):
+
+        local = [t for t in self._tasks if t.local and t.is_ready()]
+        if local:
+          t = local[0]
+          Debug.write('Running task %s' % t.name)
+          t.state = 'running'
+          self._complete(t, t.func(*t.args))
+          continue
+
+        if not any(t.state in ('running', 'finished') for t in self._tasks):
+          raise RuntimeError('unsatisfiable task dependencies: %s' % \
+            ', '.join(t.name for t in self._tasks if t.state == 'pending'))
+
+        try:
+          t, (success, result) = self._events.get(True, 1)
+        except Queue.Empty:
+          self._check_running()
+          continue
+
+        if not success:
+          e, tb = result
+          Debug.write('Task %s failed:\n%s' % (t.name, tb))
+          raise e
+
+        Debug.write('Task %s complete' % t.name)
+        self._complete(t, result)
+
+    except:
+      with self._lock:
+        pool, self._pool = self._pool, None
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+      raise
+
+    with self._lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+    return [t.result for t in self._tasks]
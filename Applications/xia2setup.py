@@ -51,53 +51,65 @@
 target_template = None
 
 def is_sequence_name(file):
-  global known_sequence_extensions
 
   if os.path.isfile(file):
-    if file.split('.')[-1] in known_sequence_extensions:
-      return True
+    return is_sequence_filename(file)
 
   return False
 
+def is_sequence_filename(file):
+  global known_sequence_extensions
+
+  return file.split('.')[-1] in known_sequence_extensions
+
 def is_image_name(filename):
 
+  if os.path.isfile(filename):
+    return is_image_filename(filename)
+
+  return False
+
+def is_image_filename(filename):
+  '''Test whether the name of a file (known to exist) looks like an image,
+  without touching the file system.'''
+
   global known_image_extensions
   from xia2.Wrappers.XDS.XDSFiles import XDSFiles
 
-  if os.path.isfile(filename):
+  if os.path.split(filename)[-1] in XDSFiles:
+    return False
 
-    if os.path.split(filename)[-1] in XDSFiles:
+  for xds_file in 'ABSORP', 'DECAY', 'MODPIX':
+    if os.path.join('scale', xds_file) in filename:
       return False
 
-    for xds_file in 'ABSORP', 'DECAY', 'MODPIX':
-      if os.path.join('scale', xds_file) in filename:
-        return False
-
-    for exten in known_image_extensions:
-      if filename.endswith(exten):
-        return True
-
-    end = filename.split('.')[-1]
-    try:
-      j = int(end)
-      if not '.log.' in filename and len(end) > 1:
-        return True
-    except:
-      pass
+  for exten in known_image_extensions:
+    if filename.endswith(exten):
+      return True
 
-    if is_hd5f_name(filename):
+  end = filename.split('.')[-1]
+  try:
+    j = int(end)
+    if not '.log.' in filename and len(end) > 1:
       return True
+  except:
+    pass
+
+  if is_hd5f_filename(filename):
+    return True
 
   return False
 
 def is_hd5f_name(filename):
 
   if os.path.isfile(filename):
-    if os.path.splitext(filename)[-1] in known_hdf5_extensions:
-      return True
+    return is_hd5f_filename(filename)
 
   return False
 
+def is_hd5f_filename(filename):
+  return os.path.splitext(filename)[-1] in known_hdf5_extensions
+
 def is_xds_file(f):
   filename = os.path.split(f)[1]
 
@@ -478,18 +490,43 @@ def get_sweeps(templates):
 
 
 
+def visit_index(directory, entry):
+  '''As visit(), for a directory which has been read into the ImageIndex,
+  where the image files have already been grouped into templates.'''
+
+  templates = set()
+
+  for f in entry['hdf5']:
+    full_path = os.path.join(directory, f)
+
+    from dxtbx.format.Registry import Registry
+
+    format_class = Registry.find(full_path)
+    if format_class is None:
+      Debug.write(
+        'Ignoring %s (Registry can not find format class)' % full_path)
+      continue
+    elif format_class.ignore():
+      continue
+    templates.add(full_path)
+
+  for template in sorted(entry['templates']):
+    if target_template and template not in target_template:
+      continue
+    templates.add(os.path.join(directory, template))
+
+  for f in entry['sequence']:
+    parse_sequence(os.path.join(directory, f))
+
+  return templates
+
 def rummage(directories):
   '''Walk through the directories looking for sweeps.'''
+  from xia2.Handlers.ImageIndex import ImageIndex
+
   templates = set()
-  visited = set()
-  for path in directories:
-    for root, dirs, files in os.walk(path, followlinks=True):
-      realpath = os.path.realpath(root)
-      if realpath in visited:
-        # safety-check to avoid recursively symbolic links
-        continue
-      visited.add(realpath)
-      templates.update(visit(os.getcwd(), root, files))
+  for directory, entry in ImageIndex.walk(directories):
+    templates.update(visit_index(directory, entry))
 
   get_sweeps(templates)
 
@@ -522,9 +559,10 @@ def write_xinfo(filename, directories, template=None, hdf5_master_files=None):
 
   import libtbx.load_env
   if CommandLine.get_template() and CommandLine.get_directory():
+    from xia2.Handlers.ImageIndex import ImageIndex
     templates = set()
     for directory in CommandLine.get_directory():
-      templates.update(visit(None, directory, os.listdir(directory)))
+      templates.update(visit_index(directory, ImageIndex.get(directory)))
     get_sweeps(templates)
   elif hdf5_master_files is not None:
     get_sweeps(hdf5_master_files)
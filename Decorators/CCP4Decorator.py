@@ -42,6 +42,7 @@
 import os
 
 from xia2.Decorators.DecoratorHelper import inherits_from
+from xia2.lib.loggraph import loggraph_parser
 
 def CCP4DecoratorFactory(DriverInstance):
   '''Create a CCP4 decorated Driver instance - based on the Driver
@@ -85,6 +86,7 @@ def __init__(self):
 
       # somewhere to store the loggraph output
       self._loggraph = { }
+      self._loggraph_parser = loggraph_parser()
 
       # put the CCP4 library directory at teh start of the
       # LD_LIBRARY_PATH in case it mashes CCP4 programs...
@@ -368,78 +370,21 @@ def get_ccp4_status(self):
 
       raise RuntimeError, 'could not find status'
 
-    def parse_ccp4_loggraph(self):
-      '''Look through the standard output of the program for
-      CCP4 loggraph text. When this is found store it in a
-      local dictionary to allow exploration.'''
-
-      # reset the loggraph store
-      self._loggraph = { }
-
-      output = self.get_all_output()
-
-      for i in range(len(output)):
-        line = output[i]
-        if '$TABLE' in line:
-
-          n_dollar = line.count('$$')
-
-          current = line.split(':')[1].replace('>',
-                                                        '').strip()
-          self._loggraph[current] = { }
-          self._loggraph[current]['columns'] = []
-          self._loggraph[current]['data'] = []
-
-          loggraph_info = ''
-
-          # FIXME 09/FEB/07 this is assumed to represent the
-          # end of a loggraph but really it isn't
-
-          # almost exactly one year later this has come back to
-          # bite me - with chef! indeed... OK, in Smartie the
-          # way this worked was to count the number of $$
-          # following the $TABLE spell - when this was equal to
-          # 4 this table is complete. Good idea.
+    def output(self):
+      '''Pull a record from the child program, passing it to the loggraph
+      parser as it arrives.'''
 
-          # while not 'inline graphs' in line and not 'FONT' in line:
-          while n_dollar < 4:
-            n_dollar += line.count('$$')
-            loggraph_info += line
+      record = self._original_class.output(self)
+      self._loggraph_parser.update(self.get_all_output())
+      return record
 
-            if n_dollar == 4:
-              break
-
-            i += 1
-            line = output[i]
-
-          # at this stage I should have the whole 9 yards in
-          # a single string...
-
-          tokens = loggraph_info.split('$$')
-          self._loggraph[current]['columns'] = tokens[1].split()
-
-          if len(tokens) < 4:
-            raise RuntimeError, 'loggraph "%s" broken' % current
-
-          data = tokens[3].split('\n')
-
-          # pop takes the data off the end so...
-          # data.reverse()
-
-          columns = len(self._loggraph[current]['columns'])
-
-          # while len(data) > 0:
-          # record = []
-          # for i in range(columns):
-          # record.append(data.pop())
-          # self._loggraph[current]['data'].append(record)
-
-          # code around cases where columns merge together...
+    def parse_ccp4_loggraph(self):
+      '''Return the CCP4 loggraph tables found in the standard output of
+      the program, as a dictionary keyed by table name - these are parsed
+      as the output is read, so this is usually immediate.'''
 
-          for j in range(len(data)):
-            record = data[j].split()
-            if len(record) == columns:
-              self._loggraph[current]['data'].append(record)
+      self._loggraph_parser.update(self.get_all_output())
+      self._loggraph = self._loggraph_parser.get_tables()
 
       return self._loggraph
 
@@ -50,6 +50,7 @@
 from xia2.Driver.DriverHelper import error_fp, error_python_traceback
 from xia2.Driver.DriverHelper import error_library_not_loaded
 from xia2.Driver.DriverHelper import generate_random_name, executable_exists
+from xia2.Driver.OutputStore import OutputStore
 
 # out of context stuff
 
@@ -79,8 +80,8 @@ def __init__(self):
     # usually small
     self._standard_input_records = []
 
-    # this will be bigger but that is ok...
-    self._standard_output_records = []
+    # this will be bigger, so is spilled to disk if it gets too big
+    self._standard_output_records = OutputStore()
 
     # optional - possibly useful if using a batch submission
     # system or wanting to describe better what the job is doing
@@ -249,7 +250,7 @@ def reset(self):
     '''Reset the output things.'''
 
     self._standard_input_records = []
-    self._standard_output_records = []
+    self._standard_output_records = OutputStore()
 
     self._command_line = []
 
@@ -398,10 +399,17 @@ def get_all_input(self):
     return self._standard_input_records
 
   def get_all_output(self):
-    '''Return all of the output of the job.'''
+    '''Return all of the output of the job, as a read-only list of
+    records.'''
 
     return self._standard_output_records
 
+  def find_output(self, keyword):
+    '''Return the indices in get_all_output() of the records containing
+    keyword.'''
+
+    return self.get_all_output().find(keyword)
+
   def close(self):
     '''Close the standard input channel.'''
 
@@ -431,12 +439,12 @@ def close_wait(self):
       self._log_file.close()
       self._log_file = None
       from xia2.Handlers.Streams import Debug
-      with open(self._log_file_name, 'rb') as f:
-        lines = f.readlines()
-        n = min(50, len(lines))
-        Debug.write('Last %i lines of %s:' %(n, self._log_file_name))
-        for line in lines[-n:]:
-          Debug.write(line.rstrip('\n'), strip=False)
+      lines = ''.join(self._standard_output_records[-50:]).splitlines(True)
+      lines += ['# command line:\n', '# %s\n' % command_line]
+      n = min(50, len(lines))
+      Debug.write('Last %i lines of %s:' %(n, self._log_file_name))
+      for line in lines[-n:]:
+        Debug.write(line.rstrip('\n'), strip=False)
 
     self.cleanup()
 
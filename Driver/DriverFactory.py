@@ -12,7 +12,7 @@
 #
 # At the moment this will instantiate
 #
-# SimpleDriver, ScriptDriver, QSubDriver, InteractiveDriver
+# SimpleDriver, ScriptDriver, QSubDriver, InteractiveDriver, StreamingDriver
 #
 # instances only.
 #
@@ -24,6 +24,7 @@
 from xia2.Driver.ScriptDriver import ScriptDriver
 from xia2.Driver.QSubDriver import QSubDriver
 from xia2.Driver.InteractiveDriver import InteractiveDriver
+from xia2.Driver.StreamingDriver import StreamingDriver
 
 # another factory to delegate to
 from xia2.Driver.ClusterDriverFactory import ClusterDriverFactory
@@ -35,7 +36,7 @@ def __init__(self):
     self._driver_type = 'simple'
 
     self._implemented_types = ['simple', 'script', 'interactive',
-                               'qsub', 'cluster.sge']
+                               'qsub', 'streaming', 'cluster.sge']
 
     # should probably write a message or something explaining
     # that the following Driver implementation is being used
@@ -79,6 +80,9 @@ def Driver(self, type = None):
     if type == 'qsub':
       return QSubDriver()
 
+    if type == 'streaming':
+      return StreamingDriver()
+
     raise RuntimeError, 'Driver class "%s" unknown' % type
 
 DriverFactory = _DriverFactory()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# OutputStore.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# Storage for the standard output of a program run through a Driver, which
+# behaves as a read-only list of records. Short output is kept in memory;
+# once the output grows beyond a given size it is spilled to an anonymous
+# temporary file, with an index of the byte offset of every record, so that
+# only the most recent records and a block of records which are being read
+# are kept in memory. Records may also be found by keyword, through an index
+# of the records containing each keyword which is built on first use and
+# extended as more output arrives, so that parsers may go straight to e.g.
+# the $TABLE records rather than reading every record of the output. Records
+# added once spilled are buffered, and written in blocks: the file stays
+# positioned at its end, except after records have been read back from it.
+
+from __future__ import absolute_import, division
+import array
+import collections
+import tempfile
+
+class OutputStore(object):
+  '''A list-like store of the records of program output.'''
+
+  # size of the output kept in memory before spilling to disk, number of
+  # records kept in memory as the tail of the output, number of records
+  # read from disk at a time and size of the output buffered before it is
+  # written to disk
+
+  _memory_limit = 1 << 20
+  _tail_size = 100
+  _block_size = 4096
+  _write_size = 1 << 16
+
+  def __init__(self):
+    self._records = []
+    self._size = 0
+
+    # once spilled: the file, the offset of the start of every record (and
+    # the end of the last), and the most recent records
+
+    self._file = None
+    self._offsets = None
+    self._tail = collections.deque(maxlen=self._tail_size)
+
+    # records not yet written to the file, and whether the file is
+    # positioned at its end
+
+    self._pending = []
+    self._pending_size = 0
+    self._at_end = True
+
+    self._block_start = None
+    self._block = None
+
+    self._keywords = { }
+
+    return
+
+  def __del__(self):
+    if self._file is not None:
+      self._file.close()
+
+  def _spill(self):
+    '''Move the records from memory to a temporary file.'''
+
+    self._file = tempfile.TemporaryFile()
+    self._offsets = array.array('l', [0])
+    self._tail.extend(self._records[-self._tail_size:])
+
+    self._file.writelines(self._records)
+    offset = 0
+    for record in self._records:
+      offset += len(record)
+      self._offsets.append(offset)
+    self._records = None
+    self._at_end = True
+
+    return
+
+  def _flush(self):
+    '''Write any buffered records to the end of the file.'''
+
+    if not self._pending:
+      return
+
+    if not self._at_end:
+      self._file.seek(0, 2)
+      self._at_end = True
+    self._file.writelines(self._pending)
+    self._pending = []
+    self._pending_size = 0
+
+    return
+
+  def append(self, record):
+    '''Add a record to the end of the output.'''
+
+    if self._file is None:
+      self._records.append(record)
+      self._size += len(record)
+      if self._size > self._memory_limit:
+        self._spill()
+      return
+
+    self._pending.append(record)
+    self._pending_size += len(record)
+    self._offsets.append(self._offsets[-1] + len(record))
+    self._tail.append(record)
+
+    if self._pending_size > self._write_size:
+      self._flush()
+
+    return
+
+  def extend(self, records):
+    for record in records:
+      self.append(record)
+
+    return
+
+  def _read(self, start, stop):
+    '''Read records start to stop from the file.'''
+
+    self._flush()
+    self._at_end = False
+    self._file.seek(self._offsets[start])
+    data = self._file.read(self._offsets[stop] - self._offsets[start])
+    base = self._offsets[start]
+    return [data[self._offsets[j] - base:self._offsets[j + 1] - base]
+            for j in range(start, stop)]
+
+  def _read_blocks(self, start, stop):
+    '''Read records start to stop from the file a block at a time,
+    yielding the records of each block in turn.'''
+
+    for block_start in range(start, stop, self._block_size):
+      yield self._read(block_start, min(stop, block_start + self._block_size))
+
+  def _get_record(self, j):
+    n = len(self)
+    if j < 0:
+      j += n
+    if j < 0 or j >= n:
+      raise IndexError('output record index out of range')
+
+    if self._file is None:
+      return self._records[j]
+
+    if j >= n - len(self._tail):
+      return self._tail[j - n]
+
+    # read a block of records around j, as records are usually read in turn
+
+    if self._block is None or not \
+           self._block_start <= j < self._block_start + len(self._block):
+      self._block_start = j - j % self._block_size
+      self._block = self._read(
+        self._block_start, min(n, self._block_start + self._block_size))
+
+    return self._block[j - self._block_start]
+
+  def __len__(self):
+    if self._file is None:
+      return len(self._records)
+    return len(self._offsets) - 1
+
+  def __getitem__(self, j):
+    if isinstance(j, slice):
+      start, stop, step = j.indices(len(self))
+      if self._file is None:
+        return self._records[j]
+      if step == 1:
+        if start >= stop:
+          return []
+        if start >= len(self) - len(self._tail):
+          return list(self._tail)[start - len(self):stop - len(self) or None]
+        records = []
+        for block in self._read_blocks(start, stop):
+          records.extend(block)
+        return records
+      return [self._get_record(k) for k in range(start, stop, step)]
+    return self._get_record(j)
+
+  def __iter__(self):
+    if self._file is None:
+      for record in self._records:
+        yield record
+      return
+
+    for block in self._read_blocks(0, len(self)):
+      for record in block:
+        yield record
+
+  def __contains__(self, record):
+    for r in self:
+      if r == record:
+        return True
+    return False
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __add__(self, other):
+    return list(self) + list(other)
+
+  def __radd__(self, other):
+    return list(other) + list(self)
+
+  def __repr__(self):
+    return 'OutputStore(%d records)' % len(self)
+
+  def find(self, keyword):
+    '''Return the indices of the records which contain keyword, reading
+    only the records which have been added since the last search for this
+    keyword.'''
+
+    indices, searched = self._keywords.get(keyword, ([], 0))
+
+    n = len(self)
+    if searched < n:
+      if self._file is None:
+        indices.extend(j for j in range(searched, n)
+                       if keyword in self._records[j])
+      else:
+        start = searched
+        for block in self._read_blocks(searched, n):
+          indices.extend(start + j for j, record in enumerate(block)
+                         if keyword in record)
+          start += len(block)
+
+    self._keywords[keyword] = (indices, n)
+
+    return list(indices)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# StreamingDriver.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A Driver implementation which runs the child process directly (without a
+# shell) and streams its standard output from a background thread as soon
+# as it is produced, rather than line by line from close_wait(). The output
+# is read from the pipe in large chunks, written to the log file through a
+# buffered file object, and only a bounded tail of it is kept in memory for
+# check_for_errors(). Callers may register callbacks on regular expressions
+# which are fired for every matching line as the program runs.
+#
+# If no log file has been set before the program starts the output is kept
+# in memory as for the other Driver implementations, as it has nowhere
+# else to go - otherwise get_all_output() reads it back from the log file.
+#
+# Applicability: UNIX
+
+from __future__ import absolute_import, division
+import collections
+import copy
+import os
+import re
+import subprocess
+import threading
+
+from xia2.Driver.DefaultDriver import DefaultDriver
+from xia2.Driver.DriverHelper import kill_process, check_return_code
+
+class StreamingDriver(DefaultDriver):
+
+  # size of the chunks read from the pipe, and number of lines kept in
+  # memory for error checking and the debug output
+  _chunk_size = 1 << 16
+  _tail_size = 50
+
+  def __init__(self):
+    super(StreamingDriver, self).__init__()
+
+    self._popen = None
+    self._popen_status = None
+
+    self._pump = None
+    self._lock = threading.Lock()
+
+    self._output_tail = collections.deque(maxlen = self._tail_size)
+    self._output_callbacks = []
+
+    # whether the output is being kept in memory or in the log file, and
+    # the length of the program output in the log file
+    self._output_in_memory = True
+    self._output_end = None
+
+    return
+
+  def add_output_callback(self, pattern, callback):
+    '''Register callback(line, match) to be called for every line of output
+    matching the regular expression pattern, as it is produced. Callbacks
+    are called from the thread reading the output.'''
+
+    self._output_callbacks.append((re.compile(pattern), callback))
+
+    return
+
+  def clear_output_callbacks(self):
+    self._output_callbacks = []
+
+    return
+
+  def reset(self):
+    super(StreamingDriver, self).reset()
+
+    self._output_tail.clear()
+    self._output_in_memory = True
+    self._output_end = None
+
+    return
+
+  def start(self):
+    if self._executable is None:
+      raise RuntimeError, 'no executable is set.'
+
+    command_line = [self._executable]
+    for c in self._command_line:
+      command_line.append(c)
+
+    environment = copy.deepcopy(os.environ)
+
+    for name in self._working_environment:
+      added = self._working_environment[name][0]
+      for value in self._working_environment[name][1:]:
+        added += '%s%s' % (os.pathsep, value)
+
+      if name in environment and \
+             not name in self._working_environment_exclusive:
+        environment[name] = '%s%s%s' % (added, os.pathsep,
+                                        environment[name])
+      else:
+        environment[name] = added
+
+    self._output_tail.clear()
+    self._output_in_memory = self._log_file is None
+    self._output_end = None
+    self._finished = False
+
+    self._popen = subprocess.Popen(command_line,
+                                   stdin = subprocess.PIPE,
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT,
+                                   cwd = self._working_directory,
+                                   env = environment)
+    self._popen_status = None
+
+    self._pump = threading.Thread(target = self._pump_output)
+    self._pump.daemon = True
+    self._pump.start()
+
+    return
+
+  def _pump_output(self):
+    '''Read the output of the child process in chunks until end of file,
+    splitting it into lines with universal newline handling.'''
+
+    fd = self._popen.stdout.fileno()
+    remainder = ''
+
+    while True:
+      chunk = os.read(fd, self._chunk_size)
+      if not chunk:
+        break
+
+      # hold back a trailing carriage return in case the following
+      # line feed is in the next chunk
+      text = remainder + chunk
+      if text.endswith('\r'):
+        text, remainder = text[:-1], '\r'
+      else:
+        remainder = ''
+
+      lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+      remainder = lines.pop() + remainder
+
+      self._record_lines([line + '\n' for line in lines])
+
+    if remainder:
+      self._record_lines([remainder.replace('\r', '\n')])
+
+    self._popen.stdout.close()
+    self._finished = True
+
+    return
+
+  def _record_lines(self, lines):
+    '''Store, log and dispatch the callbacks for a block of lines.'''
+
+    with self._lock:
+      if self._output_in_memory:
+        self._standard_output_records.extend(lines)
+      if self._log_file is not None:
+        self._log_file.writelines(lines)
+      self._output_tail.extend(lines)
+
+    if self._output_callbacks:
+      for line in lines:
+        for pattern, callback in self._output_callbacks:
+          match = pattern.search(line)
+          if match:
+            callback(line, match)
+
+    return
+
+  def _input(self, record):
+
+    if not self.check():
+      raise RuntimeError, 'child process has termimated'
+
+    self._popen.stdin.write(record)
+    self._popen.stdin.flush()
+
+    return
+
+  def _output(self):
+    # the output is read by the pump thread, so there is nothing to pull
+    # from here other than the end of the output
+
+    self.wait()
+    return ''
+
+  def output(self):
+    return self._output()
+
+  def wait(self):
+    '''Wait for all of the output of the child process to be read.'''
+
+    if self._pump is not None:
+      self._pump.join()
+      self._pump = None
+
+    return
+
+  def _status(self):
+    # get the return status of the process
+
+    if self._popen_status is not None:
+      return self._popen_status
+
+    if self._popen:
+      return self._popen.poll()
+
+    return 0
+
+  def check_for_errors(self):
+    '''Look for errors in the tail of the output, as DefaultDriver.'''
+
+    self.check_for_error_text(list(self._output_tail)[-30:])
+    check_return_code(self.status())
+
+  def write_log_file(self, filename):
+
+    with self._lock:
+      if self._log_file:
+        self._log_file.close()
+        self._log_file = None
+
+      self._log_file = open(filename, 'w')
+      if self._standard_output_records:
+        self._log_file.writelines(self._standard_output_records)
+
+      self._log_file_name = self._log_file.name
+
+    return
+
+  def get_all_output(self):
+    '''Return all of the output of the job, from the log file if the output
+    has not been kept in memory.'''
+
+    if self._output_in_memory or not self._log_file_name:
+      return self._standard_output_records
+
+    with self._lock:
+      if self._log_file is not None:
+        self._log_file.flush()
+
+    with open(self._log_file_name, 'r') as f:
+      if self._output_end is None:
+        return f.readlines()
+      return f.read(self._output_end).splitlines(True)
+
+  def close(self):
+
+    if not self.check():
+      raise RuntimeError, 'child process has termimated'
+
+    self._popen.stdin.close()
+
+    return
+
+  def close_wait(self):
+    '''Close the standard input channel and wait for the output to be
+    read - c/f DefaultDriver.close_wait().'''
+
+    self.close()
+    self.wait()
+    self._popen.wait()
+
+    if self._log_file:
+      self._output_end = self._log_file.tell()
+      command_line = '%s ' % os.path.split(self._executable)[-1]
+      for c in self._command_line:
+        command_line += ' \'%s\'' % c.replace(self._working_directory + os.sep, '')
+      self._log_file.write('# command line:\n')
+      self._log_file.write('# %s\n' % command_line)
+      self._log_file.close()
+      self._log_file = None
+      from xia2.Handlers.Streams import Debug
+      lines = list(self._output_tail)
+      Debug.write('Last %i lines of %s:' %(len(lines), self._log_file_name))
+      for line in lines:
+        Debug.write(line.rstrip('\n'), strip=False)
+
+    self.cleanup()
+
+  def cleanup(self):
+    self._popen_status = self._popen.poll()
+    self._popen = None
+    return
+
+  def kill(self):
+    kill_process(self._popen)
+
+    return
@@ -193,6 +193,14 @@ def find_matching_images(template, directory):
   '''Find images which match the input template in the directory
   provided.'''
 
+  # the index has the image numbers for every template found in the
+  # directory, and reads the directory only if it has changed
+
+  from xia2.Handlers.ImageIndex import ImageIndex
+  images = ImageIndex.find_matching_images(template, directory)
+  if images is not None:
+    return images
+
   files = os.listdir(directory)
 
   # to turn the template to a regular expression want to replace
@@ -21,7 +21,6 @@
 import time
 
 from xia2.Wrappers.CCP4.Pointless import Pointless
-from xia2.Wrappers.CCP4.Rebatch import Rebatch
 from xia2.Handlers.Streams import Debug
 
 # global parameters
@@ -378,45 +377,25 @@ def xds_integrate_header_read(xds_hkl):
 
   # fixme do I need to calculate the beam centre? probably
 
-  cell = None
-  pixel = None
-  distance = None
-  wavelength = None
-  origin = None
-  beam = None
-
-  for record in open(xds_hkl, 'r').readlines():
-    if not record[0] == '!':
-      break
-
-    lst = record[1:].split()
-
-    if lst[0] == 'UNIT_CELL_CONSTANTS=':
-      cell = tuple(map(float, lst[1:]))
-      continue
+  from xia2.Modules.XDSReflections import read_header
 
-    if lst[0] == 'DETECTOR_DISTANCE=':
-      distance = float(lst[-1])
-      continue
+  header = read_header(xds_hkl)[0]
 
-    if lst[0] == 'X-RAY_WAVELENGTH=':
-      wavelength = float(lst[-1])
-      continue
+  def values(keyword):
+    return [float(v) for v in header.get(keyword, [])]
 
-    if lst[0] == 'NX=':
-      pixel_x = float(lst[5])
-      pixel_y = float(lst[7])
-      pixel = pixel_x, pixel_y
-      continue
+  cell = tuple(values('UNIT_CELL_CONSTANTS')) or None
+  distance = (values('DETECTOR_DISTANCE') or [None])[-1]
+  wavelength = (values('X-RAY_WAVELENGTH') or [None])[-1]
+  pixel = None
+  origin = None
+  beam = tuple(values('INCIDENT_BEAM_DIRECTION')) or None
 
-    if lst[0] == 'ORGX=':
-      origin_x = float(lst[1])
-      origin_y = float(lst[3])
-      origin = origin_x, origin_y
-      continue
+  if 'QX' in header and 'QY' in header:
+    pixel = values('QX')[0], values('QY')[0]
 
-    if lst[0] == 'INCIDENT_BEAM_DIRECTION=':
-      beam = tuple(map(float, lst[1:]))
+  if 'ORGX' in header and 'ORGY' in header:
+    origin = values('ORGX')[0], values('ORGY')[0]
 
   if not pixel:
     raise RuntimeError, 'pixel size not found'
@@ -455,6 +434,9 @@ def xds_integrate_hkl_to_list(xds_hkl):
   '''Convert the output from XDS INTEGRATE to a list of (s, i, sigma)
   records. Check the s calculations as an aside.'''
 
+  import numpy
+  from xia2.Modules.XDSReflections import read_xds_reflections
+
   cell, pixel, origin, distance, wavelength = xds_integrate_header_read(
       xds_hkl)
 
@@ -462,26 +444,16 @@ def xds_integrate_hkl_to_list(xds_hkl):
 
   rc = ResolutionCell(a, b, c, alpha, beta, gamma)
 
-  result = []
-
-  for record in open(xds_hkl, 'r').readlines():
-    if record[:1] == '!':
-      continue
-
-    lst = record.split()
-
-    if not lst:
-      continue
-
-    h, k, l = tuple(map(int, lst[:3]))
-
-    i, sigma, x, y = tuple(map(float, lst[3:7]))
+  reflections = read_xds_reflections(xds_hkl)
 
-    s, r = rc.resolution(h, k, l)
+  # s = |h a* + k b* + l c*|^2 for all reflections at once
 
-    result.append((s, i, sigma))
+  hkl = reflections.get('hkl')
+  d = numpy.dot(hkl, numpy.array([rc._A, rc._B, rc._C]))
+  s = (d * d).sum(axis=1)
 
-  return result
+  return zip(s.tolist(), reflections.get('i').tolist(),
+             reflections.get('sigma').tolist())
 
 def mosflm_mtz_to_list(mtz):
   '''Run pointless to convert mtz to list of h k l ... and give the
@@ -526,52 +498,78 @@ def pointless_summedlist_to_list(summedlist, cell):
 
   return result
 
-def find_blank(hklin):
+def batch_isigma(hklin):
+  '''Compute the mean I/sigma for every batch in the unmerged MTZ file
+  hklin, with partial reflections summed (c/f Pointless sum_mtz), returning
+  a dictionary of batch: mean I/sigma.'''
 
-  # first dump to temp. file
-  hklout = tempfile.mktemp('.hkl', '', os.environ['CCP4_SCR'])
+  import numpy
+  from iotbx import mtz
 
-  p = Pointless()
-  p.set_hklin(hklin)
-  cell = p.sum_mtz(hklout)
+  mtz_obj = mtz.object(hklin)
 
-  if not os.path.isfile(hklout):
-    Debug.write('Pointless failed:')
-    Debug.write(''.join(p.get_all_output()))
-    raise RuntimeError('Pointless failed: %s does not exist' %hklout)
+  def column(label):
+    return mtz_obj.get_column(label).extract_values().as_numpy_array()
 
-  isig = { }
+  hkl = mtz_obj.extract_miller_indices().as_vec3_double().as_numpy_array()
+  batch = column('BATCH').astype(numpy.int64)
+  i = column('I')
+  variance = column('SIGI') ** 2
+  if 'M_ISYM' in mtz_obj.column_labels():
+    isym = column('M_ISYM')
+  else:
+    isym = numpy.zeros(len(batch))
 
-  for record in open(hklout, 'r'):
-    lst = record.split()
-    if not lst:
-      continue
-    batch = int(lst[3])
-    i, sig = float(lst[4]), float(lst[5])
+  if not len(batch):
+    return { }
 
-    if not sig:
-      continue
+  # partials are the observations of the same reflection (and symmetry
+  # operator) on consecutive batches: sort them together, then sum the
+  # intensities and variances over each run, assigning the sum to the
+  # middle batch of the run
+
+  order = numpy.lexsort((batch, isym, hkl[:, 2], hkl[:, 1], hkl[:, 0]))
+  hkl = hkl[order]
+  batch = batch[order]
+  isym = isym[order]
+
+  start = numpy.ones(len(order), dtype=bool)
+  start[1:] = (hkl[1:] != hkl[:-1]).any(axis=1) | \
+              (isym[1:] != isym[:-1]) | (batch[1:] != batch[:-1] + 1)
+  offsets = numpy.flatnonzero(start)
+  n_parts = numpy.diff(numpy.append(offsets, len(order)))
+
+  i = numpy.add.reduceat(i[order], offsets)
+  sigma = numpy.sqrt(numpy.add.reduceat(variance[order], offsets))
+  batch = batch[offsets + n_parts // 2]
 
-    if not batch in isig:
-      isig[batch] = []
+  # then the mean I/sigma for every batch, ignoring sigma = 0
 
-    isig[batch].append(i / sig)
+  valid = sigma > 0
+  batch = batch[valid]
+  isigma = i[valid] / sigma[valid]
 
-  # look at the mean and sd
+  batches, index = numpy.unique(batch, return_inverse=True)
+  totals = numpy.bincount(index, weights=isigma)
+  counts = numpy.bincount(index)
+
+  return dict(zip(batches.tolist(), (totals / counts).tolist()))
+
+def find_blank(hklin):
+  '''Find the blank batches in hklin, as those with mean I/sigma < 1,
+  returning the lists of blank and good batches.'''
+
+  isig = batch_isigma(hklin)
 
   blank = []
   good = []
 
   for batch in sorted(isig):
-    m, s = meansd(isig[batch])
-    if m < 1:
+    if isig[batch] < 1:
       blank.append(batch)
     else:
       good.append(batch)
 
-  # finally delete temp file
-  os.remove(hklout)
-
   return blank, good
 
 def remove_blank(hklin, hklout):
@@ -588,17 +586,107 @@ def remove_blank(hklin, hklout):
     Debug.write('%d blank vs. %d good: ignore' % (len(blanks), len(goods)))
     return hklin
 
-  rb = Rebatch()
-  rb.set_hklin(hklin)
-  rb.set_hklout(hklout)
+  import numpy
+  from cctbx.array_family import flex
+  from iotbx import mtz
+
+  mtz_obj = mtz.object(hklin)
+  batch = mtz_obj.get_column('BATCH').extract_values().as_numpy_array()
+  exclude = numpy.flatnonzero(numpy.in1d(batch.astype(numpy.int64), blanks))
+
+  Debug.write('Removing %d reflections from %d blank batches' % \
+              (len(exclude), len(blanks)))
 
-  for b in blanks:
-    rb.exclude_batch(b)
+  mtz_obj.delete_reflections(flex.size_t(exclude.tolist()))
+  mtz_obj.write(hklout)
 
-  rb.exclude_batches()
+  # iotbx.mtz writes a header for every batch, including those with no
+  # reflections left - remove them as Rebatch did
+
+  remove_batch_headers(hklout, blanks)
 
   return hklout
 
+def remove_batch_headers(hklout, batches):
+  '''Remove the headers of the given batches from the MTZ file hklout: the
+  batch numbers from the BATCH records and the count in the NCOL record of
+  the main header, and the header block of each batch after MTZBATS. The
+  reflection data are not changed.'''
+
+  import struct
+
+  exclude = set(batches)
+
+  data = open(hklout, 'rb').read()
+
+  # the header follows the reflection data, at the word given after the
+  # MTZ stamp, in the byte order given by the machine stamp
+
+  if ord(data[8]) >> 4 == 4:
+    header_start = struct.unpack('<i', data[4:8])[0]
+  else:
+    header_start = struct.unpack('>i', data[4:8])[0]
+  header_start = (header_start - 1) * 4
+
+  main = []
+  position = header_start
+
+  while True:
+    record = data[position:position + 80]
+    position += 80
+    if record.startswith('MTZBATS') or record.startswith('MTZENDOFHEADERS'):
+      break
+    if record.startswith('BATCH'):
+      if not None in main:
+        main.append(None)
+      continue
+    main.append(record)
+    if record.startswith('MTZHIST'):
+      n_history = int(record.split()[1])
+      main.extend(data[position + 80 * j:position + 80 * (j + 1)]
+                  for j in range(n_history))
+      position += 80 * n_history
+
+  # each batch header: the BH record (batch, number of words...), TITLE
+  # record, the header itself and the BHCH record
+
+  kept = []
+  numbers = []
+  if record.startswith('MTZBATS'):
+    while not data.startswith('MTZENDOFHEADERS', position):
+      record = data[position:position + 80]
+      batch, n_words = map(int, record[2:].split()[:2])
+      size = 80 * 3 + 4 * n_words
+      if not batch in exclude:
+        kept.append(data[position:position + size])
+        numbers.append(batch)
+      position += size
+
+  batch_records = []
+  for j in range(0, len(numbers), 12):
+    batch_records.append(('BATCH ' + ''.join(
+      '%6d' % batch for batch in numbers[j:j + 12])).ljust(80))
+
+  header = []
+  for record in main:
+    if record is None:
+      header.extend(batch_records)
+    elif record.startswith('NCOL'):
+      ncol, nref = record.split()[1:3]
+      header.append(('NCOL %8d %12d %8d' % (
+        int(ncol), int(nref), len(numbers))).ljust(80))
+    else:
+      header.append(record)
+
+  if kept:
+    header.append('MTZBATS'.ljust(80))
+    header.extend(kept)
+
+  open(hklout, 'wb').write(
+    data[:header_start] + ''.join(header) + data[position:])
+
+  return
+
 def bin_o_tron0(sisigma):
   '''Bin the incoming list of (s, i, sigma) and return a list of bins
   of width _scale_bins in S.'''
@@ -14,20 +14,38 @@
 
 from __future__ import absolute_import, division
 import os
-import xml.dom.minidom
+
+from xia2.Handlers.StartupCache import module_source, source_key, \
+     startup_cache
 
 class _Citations(object):
   '''A class to track citations.'''
 
   def __init__(self):
-    self._citations = {}
+    self._citations = None
     self._cited = []
 
-    # set up the citations list...
+  def _get_citations(self):
+    '''Return the citations by program, reading citations.xml (or the
+    startup cache) on first use.'''
+
+    if self._citations is None:
+      citations_xml = os.path.abspath(os.path.join(
+          os.path.dirname(__file__), '..', 'Data', 'citations.xml'))
+      key = source_key(paths=[citations_xml, module_source(__file__)])
+      self._citations = startup_cache(
+        'citations', key, lambda: self._read_citations(citations_xml))
+
+    return self._citations
+
+  def _read_citations(self, citations_xml):
+    '''Read the citations list.'''
 
-    dom = xml.dom.minidom.parse(os.path.abspath(os.path.join(
-        os.path.dirname(__file__), '..',
-        'Data', 'citations.xml')))
+    import xml.dom.minidom
+
+    result = {}
+
+    dom = xml.dom.minidom.parse(citations_xml)
     citations = dom.getElementsByTagName(
         'citations')[0].getElementsByTagName('citation')
     for citation in citations:
@@ -49,9 +67,11 @@ def __init__(self):
         elif 'doi' in bibtex_data:
           citation_data['url'] = 'http://dx.doi.org/' + bibtex_data['doi']
 
-      if program not in self._citations:
-        self._citations[program] = []
-      self._citations[program].append(citation_data)
+      if program not in result:
+        result[program] = []
+      result[program].append(citation_data)
+
+    return result
 
   def cite(self, program):
     '''Cite a given program.'''
@@ -77,7 +97,7 @@ def get_citations_dicts(self):
     result = []
 
     for c in self._cited:
-      for b in self._citations.get(c, []):
+      for b in self._get_citations().get(c, []):
         result.append(b)
 
     return result
@@ -94,11 +114,11 @@ def find_citations(self, program=None, acta=None):
     results = []
 
     if program:
-      results.extend(self._citations.get(program, []))
+      results.extend(self._get_citations().get(program, []))
 
     if acta:
       results.extend(citation \
-          for citations in self._citations.itervalues() \
+          for citations in self._get_citations().itervalues() \
           for citation in citations \
           if citation.get('acta') == acta)
 
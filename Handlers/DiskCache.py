@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# DiskCache.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A persistent cache of image headers and imagesets which survives between
+# runs of xia2, stored in an SQLite database in $XDG_CACHE_HOME/xia2 (or
+# ~/.cache/xia2), or a directory given with xia2.settings.header_cache.
+# Entries are keyed on the file path(s) together with the size and
+# modification time of the file(s), so any change to an image invalidates
+# the entry; the least recently used entries are evicted once the cache
+# holds more than max_entries. Any failure to use the cache (e.g. a read-only
+# home directory) simply disables it.
+
+from __future__ import absolute_import, division
+import hashlib
+import json
+import os
+import time
+
+def file_key(paths, extra=None):
+  '''Return a key for the current state of the files in paths, from their
+  names, sizes and modification times, and any other JSON-able values in
+  extra on which the cached result depends.'''
+
+  state = []
+  for path in paths:
+    st = os.stat(path)
+    state.append((os.path.abspath(path), st.st_size, st.st_mtime))
+  return hashlib.sha1(json.dumps([state, extra])).hexdigest()
+
+class _DiskCache(object):
+  '''A persistent key-value store for JSON-able values, with namespaces
+  for different kinds of cached data.'''
+
+  def __init__(self):
+    self._connection = None
+    self._pid = None
+    self._disabled = False
+    self._n_put = 0
+
+    return
+
+  def _get_params(self):
+    from xia2.Handlers.Phil import PhilIndex
+    return PhilIndex.params.xia2.settings.header_cache
+
+  def _get_filename(self):
+    directory = self._get_params().directory
+    if directory is None:
+      cache_home = os.environ.get('XDG_CACHE_HOME')
+      if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+      directory = os.path.join(cache_home, 'xia2')
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    return os.path.join(directory, 'header_cache.sqlite')
+
+  def _connect(self):
+    '''Return a connection to the cache database, or None if the cache is
+    disabled - connections are not shared with forked processes.'''
+
+    if self._disabled:
+      return None
+
+    if self._connection is not None and self._pid == os.getpid():
+      return self._connection
+
+    if not self._get_params().enable:
+      return None
+
+    try:
+      import sqlite3
+      connection = sqlite3.connect(self._get_filename(), timeout=30)
+      connection.execute('PRAGMA synchronous=OFF')
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, '
+        'value TEXT, accessed REAL, PRIMARY KEY (namespace, key))')
+      connection.commit()
+    except Exception, e:
+      from xia2.Handlers.Streams import Debug
+      Debug.write('Disabling header cache: %s' % str(e))
+      self._disabled = True
+      return None
+
+    self._connection = connection
+    self._pid = os.getpid()
+    return self._connection
+
+  def get(self, namespace, key):
+    '''Return the cached value for key, or None.'''
+
+    connection = self._connect()
+    if connection is None:
+      return None
+
+    try:
+      row = connection.execute(
+        'SELECT value FROM cache WHERE namespace=? AND key=?',
+        (namespace, key)).fetchone()
+      if row is None:
+        return None
+      connection.execute(
+        'UPDATE cache SET accessed=? WHERE namespace=? AND key=?',
+        (time.time(), namespace, key))
+      connection.commit()
+      return json.loads(row[0])
+    except Exception, e:
+      from xia2.Handlers.Streams import Debug
+      Debug.write('Error reading header cache: %s' % str(e))
+      return None
+
+  def put(self, namespace, key, value):
+    '''Store value for key, evicting the least recently used entries if
+    the cache is full.'''
+
+    connection = self._connect()
+    if connection is None:
+      return
+
+    try:
+      connection.execute(
+        'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+        (namespace, key, json.dumps(value), time.time()))
+      self._n_put += 1
+      if self._n_put % 100 == 1:
+        self._evict(connection)
+      connection.commit()
+    except Exception, e:
+      from xia2.Handlers.Streams import Debug
+      Debug.write('Error writing header cache: %s' % str(e))
+
+    return
+
+  def _evict(self, connection):
+    max_entries = self._get_params().max_entries
+    n = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    if n > max_entries:
+      connection.execute(
+        'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache '
+        'ORDER BY accessed ASC LIMIT ?)', (n - max_entries,))
+
+    return
+
+DiskCache = _DiskCache()
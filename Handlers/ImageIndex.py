@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# ImageIndex.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# An index of the image files in directories, grouped by template, built by
+# reading each directory once: the directory trees searched by xia2setup are
+# walked in parallel with a pool of threads (which spend their time waiting
+# on the file system) and the image numbers for each template kept as a
+# sorted list, so that find_matching_images() does not need to list and
+# pattern match the directory again for every template.
+#
+# Each directory entry records the modification time of the directory when it
+# was read, and is re-read only if this has changed - files appearing in or
+# vanishing from a directory change its modification time. As the modification
+# time may have a resolution of a second (e.g. on NFS), files added soon after
+# a directory was read could leave it unchanged: an entry read within
+# _mtime_margin seconds of the modification time is not trusted, and the
+# directory is read again next time. Optionally the
+# index is kept between runs in the DiskCache, so that only those directories
+# which have been modified since the last run are read again.
+
+from __future__ import absolute_import, division
+import os
+import threading
+import time
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# allowing for the resolution of modification times and for clock skew
+# between a file server and this computer
+
+_mtime_margin = 2.0
+
+def _list_directory(directory):
+  '''Return the names of the files and subdirectories in directory,
+  following symbolic links as os.walk(followlinks=True).'''
+
+  files = []
+  subdirs = []
+
+  if scandir is not None:
+    for entry in scandir(directory):
+      try:
+        if entry.is_dir():
+          subdirs.append(entry.name)
+        elif entry.is_file():
+          files.append(entry.name)
+      except OSError:
+        continue
+
+  else:
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      if os.path.isdir(path):
+        subdirs.append(name)
+      elif os.path.isfile(path):
+        files.append(name)
+
+  return files, subdirs
+
+def _read_directory(directory, mtime):
+  '''Read directory, grouping the image files into templates, returning a
+  dictionary suitable for storing as JSON.'''
+
+  scanned = time.time()
+
+  from xia2.Applications.xia2setup import is_image_filename, \
+    is_hd5f_filename, is_sequence_filename
+  from xia2.Experts.FindImages import template_regex
+  from xia2.Handlers.Streams import Debug
+
+  files, subdirs = _list_directory(directory)
+
+  templates = { }
+  hdf5 = []
+  sequence = []
+
+  for f in sorted(files):
+    full_path = os.path.join(directory, f)
+
+    if is_hd5f_filename(full_path):
+      hdf5.append(f)
+
+    elif is_image_filename(full_path):
+      try:
+        template, number = template_regex(f)
+      except Exception, e:
+        Debug.write('Exception A: %s (%s)' % (str(e), full_path))
+        continue
+      templates.setdefault(template, []).append(number)
+
+    elif is_sequence_filename(full_path):
+      sequence.append(f)
+
+  for template in templates:
+    templates[template].sort()
+
+  return {'mtime':mtime,
+          'scanned':scanned,
+          'subdirs':sorted(subdirs),
+          'templates':templates,
+          'hdf5':hdf5,
+          'sequence':sequence}
+
+class _ImageIndex(object):
+  '''An index of image templates and numbers by directory.'''
+
+  def __init__(self):
+    self._entries = { }
+    self._lock = threading.Lock()
+
+    return
+
+  def _get_params(self):
+    from xia2.Handlers.Phil import PhilIndex
+    return PhilIndex.params.xia2.settings.directory_index
+
+  def _get_entry(self, directory):
+    '''Return the current entry for directory, reading it if it has changed
+    since it was last read - may be called from any thread.'''
+
+    try:
+      mtime = os.stat(directory).st_mtime
+
+      entry = self._entries.get(directory)
+      if entry is not None and entry['mtime'] == mtime and \
+             entry.get('scanned', mtime) - mtime > _mtime_margin:
+        return entry, False
+
+      entry = _read_directory(directory, mtime)
+
+    except OSError, e:
+      # unreadable directories are skipped, as os.walk()
+      from xia2.Handlers.Streams import Debug
+      Debug.write('Error reading %s: %s' % (directory, str(e)))
+      return {'mtime':None, 'subdirs':[], 'templates':{ }, 'hdf5':[],
+              'sequence':[]}, False
+
+    with self._lock:
+      self._entries[directory] = entry
+    return entry, True
+
+  def _load(self, directories):
+    '''Load any persistent entries for directories not yet in memory.'''
+
+    from xia2.Handlers.DiskCache import DiskCache
+
+    for directory in directories:
+      if not directory in self._entries:
+        entry = DiskCache.get('directory', directory)
+        if entry is not None:
+          self._entries[directory] = entry
+
+    return
+
+  def _save(self, directories):
+    from xia2.Handlers.DiskCache import DiskCache
+
+    for directory in directories:
+      DiskCache.put('directory', directory, self._entries[directory])
+
+    return
+
+  def get(self, directory):
+    '''Return the entry for a single directory.'''
+
+    directory = os.path.realpath(directory)
+    persist = self._get_params().persist
+
+    if persist:
+      self._load([directory])
+    entry, changed = self._get_entry(directory)
+    if persist and changed:
+      self._save([directory])
+
+    return entry
+
+  def walk(self, paths):
+    '''Walk the directory trees under paths, a level at a time with a pool
+    of threads, returning a list of (directory, entry) - c/f os.walk().'''
+
+    from multiprocessing.pool import ThreadPool
+    from xia2.Handlers.Streams import Debug
+
+    params = self._get_params()
+
+    # directories are identified by their real path, to avoid visiting any
+    # directory twice through symbolic links
+    visited = set()
+    level = []
+    for path in paths:
+      realpath = os.path.realpath(path)
+      if not realpath in visited:
+        visited.add(realpath)
+        level.append((path, realpath))
+
+    result = []
+    n_read = 0
+    pool = ThreadPool(params.nproc)
+
+    try:
+      while level:
+        if params.persist:
+          self._load([realpath for path, realpath in level])
+
+        entries = pool.map(lambda d: self._get_entry(d[1]), level)
+
+        changed = [realpath for (path, realpath), (entry, read) in
+                   zip(level, entries) if read]
+        n_read += len(changed)
+        if params.persist and changed:
+          self._save(changed)
+
+        next_level = []
+        for (path, realpath), (entry, read) in zip(level, entries):
+          result.append((path, entry))
+          for subdir in entry['subdirs']:
+            subpath = os.path.join(path, subdir)
+            subrealpath = os.path.realpath(subpath)
+            if not subrealpath in visited:
+              visited.add(subrealpath)
+              next_level.append((subpath, subrealpath))
+        level = next_level
+
+    finally:
+      pool.close()
+      pool.join()
+
+    Debug.write('Indexed %d directories (%d read)' % (len(result), n_read))
+
+    return result
+
+  def find_matching_images(self, template, directory):
+    '''Return the sorted image numbers for template in directory, or None
+    if the template is not in the index.'''
+
+    entry = self.get(directory)
+    images = entry['templates'].get(template)
+    if images is None:
+      return None
+    return list(images)
+
+ImageIndex = _ImageIndex()
@@ -11,10 +11,10 @@
 
 from __future__ import absolute_import, division
 
-from libtbx.phil import interface
-from iotbx.phil import parse
+from xia2.Handlers.StartupCache import LazyObject, module_source, \
+     source_key, startup_cache
 
-master_phil = parse("""
+master_phil_str = """
 general
   .short_caption = "General settings"
 {
@@ -40,6 +40,13 @@
     .type = float
     .short_caption="DELPHI= for small molecule mode"
     .expert_level = 1
+  stage_input_files = *link copy
+    .type = choice
+    .help = "How the files from earlier XDS steps are placed in the working"
+            " directory of a step: as hard (or symbolic) links to the"
+            " original files, or as copies."
+    .short_caption = "Stage input files"
+    .expert_level = 2
   untrusted_ellipse = None
     .type = ints(size = 4)
     .multiple = True
@@ -110,6 +117,21 @@
       .type = float
       .short_caption="BEAM_DIVERGENCE_E.S.D.="
       .expert_level = 1
+    wedge_width = 0
+      .type = float(value_min=0)
+      .help = "Split sweeps into wedges of about this many degrees, which are"
+              " integrated as separate INTEGRATE jobs (e.g. on a cluster) and"
+              " joined into one INTEGRATE.HKL - 0 to integrate each sweep in"
+              " one job."
+      .short_caption="Wedge width"
+      .expert_level = 2
+    wedge_overlap = 2.0
+      .type = float(value_min=0)
+      .help = "The extra rotation in degrees integrated either side of each"
+              " wedge, so that reflections on the wedge boundaries are fully"
+              " recorded."
+      .short_caption="Wedge overlap"
+      .expert_level = 2
     reintegrate = true
       .type = bool
       .short_caption="Reintegrate after global refinement"
@@ -632,6 +654,43 @@
     .type = bool
     .short_caption = "Read all image headers"
     .expert_level = 1
+  header_cache
+    .short_caption = "Image header cache"
+  {
+    enable = True
+      .type = bool
+      .help = "Keep a persistent cache of image headers between runs, keyed"
+              " on the size and modification time of each image."
+      .short_caption = "Cache image headers"
+      .expert_level = 2
+    directory = None
+      .type = path
+      .help = "Directory for the header cache (default $XDG_CACHE_HOME/xia2)"
+      .short_caption = "Header cache directory"
+      .expert_level = 2
+    max_entries = 10000
+      .type = int(value_min=1)
+      .help = "Maximum number of cached headers and imagesets to keep."
+      .short_caption = "Header cache size"
+      .expert_level = 2
+  }
+  directory_index
+    .short_caption = "Image directory index"
+  {
+    nproc = 8
+      .type = int(value_min=1)
+      .help = "Number of threads to use when searching directories for"
+              " images."
+      .short_caption = "Directory search threads"
+      .expert_level = 2
+    persist = False
+      .type = bool
+      .help = "Keep the index of images found in each directory between"
+              " runs (in the header cache), so that only directories modified"
+              " since the last run are read again."
+      .short_caption = "Keep directory index"
+      .expert_level = 2
+  }
   detector_distance = None
     .type = float(value_min=0.0)
     .help = "Distance between sample and detector (mm)"
@@ -782,11 +841,55 @@
       .type = str
       .help = "The command to use to submit qsub jobs"
       .expert_level = 1
+    sweep_worker = *subprocess fork
+      .type = choice
+      .help = "Whether each sweep processed in parallel is run in a new"
+              " xia2.integrate process, or in a worker forked from the main"
+              " xia2 process (avoiding the start-up cost of each new process)."
+      .expert_level = 2
   }
 }
-""", process_includes=True)
+"""
+
+# the modules of the scopes included in master_phil_str
+
+_included_modules = ['dials.util.masking', 'dials.util.options',
+                     'xia2.Modules.Resolutionizer']
+
+def _parse_master_phil():
+  from iotbx.phil import parse
+  return parse(master_phil_str, process_includes=True)
+
+def _master_phil_key():
+  '''Return the key for the parsed master_phil_str, which depends on the
+  included scopes and the phil parser too.'''
+
+  import pkgutil
+  import libtbx.phil
+  import iotbx.phil
+
+  paths = [module_source(libtbx.phil.__file__),
+           module_source(iotbx.phil.__file__)]
+  for module in _included_modules:
+    paths.append(module_source(pkgutil.get_loader(module).get_filename()))
+  return source_key(text=master_phil_str, paths=paths)
+
+def _get_master_phil():
+  try:
+    key = _master_phil_key()
+  except Exception:
+    return _parse_master_phil()
+  return startup_cache('master_phil', key, _parse_master_phil)
+
+def _get_phil_index():
+  from libtbx.phil import interface
+  return interface.index(master_phil=master_phil._lazy_get())
+
+# both parsed when first used
+
+master_phil = LazyObject(_get_master_phil)
 
-PhilIndex = interface.index(master_phil=master_phil)
+PhilIndex = LazyObject(_get_phil_index)
 
 if __name__ == '__main__':
   PhilIndex.working_phil.show()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# StartupCache.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# Support for a quick start for the handler singletons (PhilIndex, Syminfo,
+# Citations), which every xia2 command and every child process imports:
+# LazyObject defers building a singleton until it is first used, and
+# startup_cache() keeps the result of parsing the phil definitions, symop.lib
+# &c. as a pickle in $XDG_CACHE_HOME/xia2 (or ~/.cache/xia2) so that it is
+# only parsed again when the source changes. The pickles are keyed on the
+# source (or the size and modification time of the source files, including
+# the module which parses them) and the version of python; any failure to
+# use the cache just means the source is parsed. Set XIA2_STARTUP_CACHE=0
+# to disable the cache.
+
+from __future__ import absolute_import, division
+import cPickle as pickle
+import hashlib
+import os
+import sys
+import tempfile
+
+def _cache_directory():
+  cache_home = os.environ.get('XDG_CACHE_HOME')
+  if not cache_home:
+    cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(cache_home, 'xia2')
+
+def module_source(module_file):
+  '''Return the .py file for a module __file__, which may be the .pyc.'''
+
+  return os.path.splitext(module_file)[0] + '.py'
+
+def source_key(text=None, paths=()):
+  '''Return a key for the source of a cached object, from the text parsed
+  and / or the sizes and modification times of the files read.'''
+
+  key = hashlib.sha1()
+  key.update(sys.version)
+  if text is not None:
+    key.update(text)
+  for path in paths:
+    st = os.stat(path)
+    key.update('%s %d %f' % (os.path.abspath(path), st.st_size, st.st_mtime))
+  return key.hexdigest()
+
+def startup_cache(name, key, build):
+  '''Return the object cached as name for key, or build() it and cache
+  the result.'''
+
+  if os.environ.get('XIA2_STARTUP_CACHE', '1') == '0':
+    return build()
+
+  filename = os.path.join(_cache_directory(), '%s-%s.pickle' % (name, key))
+
+  try:
+    with open(filename, 'rb') as f:
+      return pickle.load(f)
+  except Exception:
+    pass
+
+  result = build()
+
+  # write to a temporary file first, as other processes may be reading
+
+  try:
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_filename, filename)
+    except Exception:
+      os.remove(tmp_filename)
+  except Exception:
+    pass
+
+  return result
+
+class LazyObject(object):
+  '''A stand-in for an object which is built by factory() when one of its
+  attributes is first used.'''
+
+  def __init__(self, factory):
+    self.__dict__['_lazy_factory'] = factory
+    self.__dict__['_lazy_object'] = None
+
+    return
+
+  def _lazy_get(self):
+    if self._lazy_object is None:
+      self.__dict__['_lazy_object'] = self._lazy_factory()
+    return self._lazy_object
+
+  def __getattr__(self, name):
+    return getattr(self._lazy_get(), name)
+
+  def __setattr__(self, name, value):
+    setattr(self._lazy_get(), name, value)
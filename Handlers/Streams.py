@@ -91,6 +91,14 @@ def uncache(self):
       self.write(record, forward)
     return self._cachelines
 
+  def take_cached(self):
+    '''Stop caching, returning the cached records rather than writing
+    them.'''
+    records = [record for record, forward in self._cachelines]
+    self._cache = False
+    self._cachelines = []
+    return records
+
   def get_file(self):
     if self._file:
       return self._file
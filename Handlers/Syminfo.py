@@ -10,6 +10,9 @@
 # A handler singleton for the information in the CCP4 symmetry library
 # syminfo.lib.
 #
+# The library is read when first needed, and the tables kept in the startup
+# cache so that later runs need not parse it again.
+#
 
 from __future__ import absolute_import, division
 import sys
@@ -17,7 +20,8 @@
 import copy
 import re
 
-from cctbx import sgtbx
+from xia2.Handlers.StartupCache import module_source, source_key, \
+     startup_cache
 
 class _Syminfo(object):
   '''An object to retain symmetry information.'''
@@ -25,7 +29,7 @@ class _Syminfo(object):
   def __init__(self):
     '''Initialise everything.'''
 
-    self._parse_symop()
+    self._symop = None
 
     self._int_re = re.compile('^[0-9]*$')
 
@@ -52,20 +56,35 @@ def _generate_lattice(self,
     else:
       return '%sR' % lattice[0]
 
-  def _parse_symop(self):
-    '''Parse the CCP4 symop library.'''
+  def _get_symop(self):
+    '''Return the symop tables, reading them on first use.'''
+
+    if self._symop is None:
+      symop_lib = os.path.join(os.environ['CLIBD'], 'symop.lib')
+      key = source_key(paths=[symop_lib, module_source(__file__)])
+      (self._symop,
+       self._spacegroup_name_to_lattice,
+       self._spacegroup_short_to_long,
+       self._spacegroup_long_to_short,
+       self._spacegroup_name_to_number,
+       self._spacegroup_name_to_pointgroup) = startup_cache(
+         'syminfo', key, lambda: self._parse_symop(symop_lib))
+
+    return self._symop
 
-    self._symop = { }
-    self._spacegroup_name_to_lattice = { }
-    self._spacegroup_short_to_long = { }
-    self._spacegroup_long_to_short = { }
-    self._spacegroup_name_to_number = { }
-    self._spacegroup_name_to_pointgroup = { }
+  def _parse_symop(self, symop_lib):
+    '''Parse the CCP4 symop library, returning the tables.'''
+
+    symop = { }
+    spacegroup_name_to_lattice = { }
+    spacegroup_short_to_long = { }
+    spacegroup_long_to_short = { }
+    spacegroup_name_to_number = { }
+    spacegroup_name_to_pointgroup = { }
 
     current = 0
 
-    for line in open(os.path.join(os.environ['CLIBD'],
-                                  'symop.lib')).readlines():
+    for line in open(symop_lib).readlines():
       if line[0] != ' ':
         list = line.split()
         index = int(list[0])
@@ -84,45 +103,51 @@ def _parse_symop(self):
           elif token[0] != '1':
             pointgroup += token[0]
 
-        self._symop[index] = {'index':index,
-                              'lattice_type':lattice_type,
-                              'lattice':lattice,
-                              'name':shortname,
-                              'longname':longname,
-                              'pointgroup':pointgroup,
-                              'symops':0,
-                              'operations':[]}
+        symop[index] = {'index':index,
+                        'lattice_type':lattice_type,
+                        'lattice':lattice,
+                        'name':shortname,
+                        'longname':longname,
+                        'pointgroup':pointgroup,
+                        'symops':0,
+                        'operations':[]}
 
-        if shortname not in self._spacegroup_name_to_lattice:
-          self._spacegroup_name_to_lattice[shortname] = lattice
+        if shortname not in spacegroup_name_to_lattice:
+          spacegroup_name_to_lattice[shortname] = lattice
 
-        if shortname not in self._spacegroup_name_to_number:
-          self._spacegroup_name_to_number[shortname] = index
+        if shortname not in spacegroup_name_to_number:
+          spacegroup_name_to_number[shortname] = index
 
-        if longname not in self._spacegroup_long_to_short:
-          self._spacegroup_long_to_short[longname] = shortname
+        if longname not in spacegroup_long_to_short:
+          spacegroup_long_to_short[longname] = shortname
 
-        if shortname not in self._spacegroup_short_to_long:
-          self._spacegroup_short_to_long[shortname] = longname
+        if shortname not in spacegroup_short_to_long:
+          spacegroup_short_to_long[shortname] = longname
 
-        if shortname not in self._spacegroup_name_to_pointgroup:
-          self._spacegroup_name_to_pointgroup[shortname] = pointgroup
+        if shortname not in spacegroup_name_to_pointgroup:
+          spacegroup_name_to_pointgroup[shortname] = pointgroup
 
         current = index
 
       else:
 
-        self._symop[current]['symops'] += 1
-        self._symop[current]['operations'].append(line.strip())
+        symop[current]['symops'] += 1
+        symop[current]['operations'].append(line.strip())
 
-    return
+    return (symop,
+            spacegroup_name_to_lattice,
+            spacegroup_short_to_long,
+            spacegroup_long_to_short,
+            spacegroup_name_to_number,
+            spacegroup_name_to_pointgroup)
 
   def get_syminfo(self, spacegroup_number):
     '''Return the syminfo for spacegroup number.'''
-    return copy.deepcopy(self._symop[spacegroup_number])
+    return copy.deepcopy(self._get_symop()[spacegroup_number])
 
   def get_pointgroup(self, name):
     '''Get the pointgroup for this spacegroup, e.g. P422 for P43212.'''
+    from cctbx import sgtbx
     space_group = sgtbx.space_group_info(name).group()
     point_group = space_group.build_derived_patterson_group(
       ).build_derived_acentric_group()
@@ -151,13 +176,14 @@ def get_lattice(self, name):
   def get_spacegroup_numbers(self):
     '''Get a list of all spacegroup numbers.'''
 
-    numbers = self._symop.keys()
+    numbers = self._get_symop().keys()
     numbers.sort()
 
     return numbers
 
   def spacegroup_number_to_name(self, spacegroup_number):
     '''Return the name of this spacegroup.'''
+    from cctbx import sgtbx
     return sgtbx.space_group_info(spacegroup_number).type().lookup_symbol()
 
   def spacegroup_name_to_number(self, spacegroup):
@@ -171,11 +197,13 @@ def spacegroup_name_to_number(self, spacegroup):
     except:
       pass
 
+    from cctbx import sgtbx
     return sgtbx.space_group_info(str(spacegroup)).type().number()
 
   def get_num_symops(self, spacegroup_number):
     '''Get the number of symmetry operations that spacegroup
     number has.'''
+    from cctbx import sgtbx
     return len(sgtbx.space_group_info(number=spacegroup_number).group())
 
   def get_symops(self, spacegroup):
@@ -186,7 +214,7 @@ def get_symops(self, spacegroup):
     except ValueError, e:
       number = self.spacegroup_name_to_number(spacegroup)
 
-    return self._symop[number]['operations']
+    return self._get_symop()[number]['operations']
 
   def get_subgroups(self, spacegroup):
     '''Get the list of spacegroups which are included entirely in this
@@ -197,13 +225,13 @@ def get_subgroups(self, spacegroup):
     except ValueError, e:
       number = self.spacegroup_name_to_number(spacegroup)
 
-    symops = self._symop[number]['operations']
+    symops = self._get_symop()[number]['operations']
 
     subgroups = []
 
     for j in range(230):
       sub = True
-      for s in self._symop[j + 1]['operations']:
+      for s in self._get_symop()[j + 1]['operations']:
         if not s in symops:
           sub = False
       if sub:
@@ -30,6 +30,12 @@
   .type = float(value_min=0, value_max=1)
   .help = "Minimum value of completeness in outer resolution shell used to "
           "determine suitable resolution cutoff for CHEF analysis"
+sections = *xtriage *multiplicity *multiplicity_vs_resolution *multiplicity_histogram *completeness *scale_rmerge_vs_batch *cc_one_half *i_over_sig_i *second_moments *cumulative_intensity_distribution *l_test *wilson *pychef
+  .type = choice(multi=True)
+  .help = "The sections of the report to compute"
+nproc = 1
+  .type = int(value_min=1)
+  .help = "The number of processes in which to compute the report sections"
 %s
 """ %dose_phil_str)
 
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division
 import sys
 
+import numpy
 import iotbx.phil
 from libtbx.phil import command_line
 from cctbx.array_family import flex
@@ -27,7 +28,158 @@
 """, process_includes=True)
 
 from xia2.Modules.MultiCrystalAnalysis import separate_unmerged
+from xia2.Toolkit.MillerIndexGroups import miller_index_array, \
+  unique_miller_indices
+
+
+class leave_one_out_cc_half(object):
+  '''CC1/2 for the unmerged intensities of all groups of observations, and
+  for all of the groups but one in turn, in time linear in the number of
+  observations: the sums over the observations of each unique reflection
+  are kept for each group, and leaving out a group only changes the
+  reflections which that group measured, so the sums over each resolution
+  shell are corrected for those reflections alone.
+
+  For the sigma_tau method the sums are of the weights 1/sigma^2, wI and
+  wI^2, giving the weighted mean intensity and its internal variance as
+  merge_equivalents(); for the half_dataset method the observations of each
+  reflection are split at random into two halves once, and the sums are of
+  the intensities in each half. The resolution shells are chosen once, with
+  equal numbers of observations, for all groups.'''
+
+  def __init__(self, groups, n_bins=20, cc_one_half_method='sigma_tau'):
+    self._method = cc_one_half_method
+    self._n_bins = n_bins
+
+    # symmetry equivalent observations are only grouped once mapped to the
+    # asymmetric unit, as by merge_equivalents()
+
+    groups = [unmerged.map_to_asu() for unmerged in groups]
+
+    group = numpy.concatenate([
+      numpy.repeat(j, len(unmerged.data()))
+      for j, unmerged in enumerate(groups)])
+    hkl = numpy.concatenate([
+      miller_index_array(unmerged.indices()) for unmerged in groups])
+    data = numpy.concatenate([
+      unmerged.data().as_numpy_array() for unmerged in groups])
+    sigmas = numpy.concatenate([
+      unmerged.sigmas().as_numpy_array() for unmerged in groups])
+    d_spacings = numpy.concatenate([
+      unmerged.d_spacings().data().as_numpy_array() for unmerged in groups])
+
+    # unique reflections, and resolution shells with equal numbers of
+    # observations
+
+    unique_hkl, refl = unique_miller_indices(hkl)
+    n_refl = len(unique_hkl)
+    first = numpy.zeros(n_refl, dtype=numpy.int64)
+    first[refl[::-1]] = numpy.arange(len(refl) - 1, -1, -1)
+
+    d_sorted = numpy.sort(d_spacings)[::-1]
+    limits = d_sorted[
+      (numpy.arange(1, n_bins) * len(d_sorted)) // n_bins]
+    self._bin = numpy.searchsorted(-limits, -d_spacings[first], side='right')
+
+    if self._method == 'sigma_tau':
+      w = 1 / (sigmas * sigmas)
+      values = [numpy.ones(len(data)), w, w * data, w * data * data]
+    else:
+      half = self._split(refl, n_refl)
+      values = [(half == 0).astype(numpy.float64),
+                numpy.where(half == 0, data, 0),
+                (half == 1).astype(numpy.float64),
+                numpy.where(half == 1, data, 0)]
+
+    # the sums for each (group, reflection), in order of group, and over all
+    # groups for each reflection
+
+    pairs, pair = numpy.unique(group * n_refl + refl, return_inverse=True)
+    self._pair_group = pairs // n_refl
+    self._pair_refl = pairs % n_refl
+    self._pair_sums = numpy.array(
+      [numpy.bincount(pair, weights=v, minlength=len(pairs))
+       for v in values]).T
+    self._sums = numpy.array(
+      [numpy.bincount(refl, weights=v, minlength=n_refl)
+       for v in values]).T
+
+    self._shell_sums = self._shell_terms(
+      self._sums, numpy.arange(n_refl))
+    self.n_groups = len(groups)
+
+    return
+
+  @staticmethod
+  def _split(refl, n_refl):
+    '''Assign the observations of each reflection at random to two halves,
+    with half (rounded down) of them in the first.'''
+
+    order = numpy.lexsort((numpy.random.random(len(refl)), refl))
+    counts = numpy.bincount(refl, minlength=n_refl)
+    starts = numpy.cumsum(counts) - counts
+    rank = numpy.empty(len(refl), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(refl)) - starts[refl[order]]
+    return numpy.where(rank < counts[refl] // 2, 0, 1)
+
+  def _shell_terms(self, sums, refl):
+    '''Return the sums over each resolution shell of the terms needed for
+    CC1/2 from the reflections with the given sums.'''
+
+    if self._method == 'sigma_tau':
+      n, sw, swi, swii = sums.T
+      valid = n > 1
+      n, sw, swi, swii = n[valid], sw[valid], swi[valid], swii[valid]
+      y = swi / sw
+      var_e = (swii - swi * y) / ((n - 1) * sw)
+      terms = [numpy.ones(len(y)), y, y * y, var_e]
+    else:
+      n1, s1, n2, s2 = sums.T
+      valid = (n1 > 0) & (n2 > 0)
+      y1 = s1[valid] / n1[valid]
+      y2 = s2[valid] / n2[valid]
+      terms = [numpy.ones(len(y1)), y1, y2, y1 * y1, y2 * y2, y1 * y2]
+
+    shells = self._bin[refl[valid]]
+    return numpy.array([numpy.bincount(shells, weights=t,
+                                       minlength=self._n_bins)
+                        for t in terms]).T
+
+  def _cc_one_half(self, shell_sums):
+    '''Return CC1/2 as the mean over resolution shells weighted by the
+    number of reflections in each shell.'''
+
+    if self._method == 'sigma_tau':
+      n, sy, syy, se = shell_sums.T
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        var_y = (syy - sy * sy / n) / (n - 1)
+        var_e = se / n
+        cc = (var_y - var_e) / (var_y + var_e)
+    else:
+      n, s1, s2, s11, s22, s12 = shell_sums.T
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        cc = (n * s12 - s1 * s2) / numpy.sqrt(
+          (n * s11 - s1 * s1) * (n * s22 - s2 * s2))
+
+    defined = (n > 1) & numpy.isfinite(cc)
+    if not defined.any():
+      return 0.0
+    return float(numpy.average(cc[defined], weights=n[defined]))
+
+  def cc_one_half(self, exclude=None):
+    '''Return CC1/2 for all of the groups, or all but group exclude.'''
+
+    if exclude is None:
+      return self._cc_one_half(self._shell_sums)
 
+    start, end = numpy.searchsorted(self._pair_group, [exclude, exclude + 1])
+    refl = self._pair_refl[start:end]
+    before = self._sums[refl]
+    after = before - self._pair_sums[start:end]
+
+    shell_sums = self._shell_sums - self._shell_terms(before, refl) + \
+                 self._shell_terms(after, refl)
+    return self._cc_one_half(shell_sums)
 
 
 class delta_cc_half(object):
@@ -59,39 +211,19 @@ def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
       use_internal_variance=False,
       eliminate_sys_absent=False,
       cc_one_half_method=cc_one_half_method)
-    if cc_one_half_method == 'sigma_tau':
-      cc_overall = self.merging_statistics.cc_one_half_sigma_tau_overall
-    else:
-      cc_overall = self.merging_statistics.cc_one_half_overall
     self.merging_statistics.show()
 
+    # CC1/2 leaving out each group in turn, from the sums over the
+    # observations of each group
+
+    cc_half = leave_one_out_cc_half(
+      self.intensities.values(), n_bins=n_bins,
+      cc_one_half_method=cc_one_half_method)
+    cc_overall = cc_half.cc_one_half()
+
     self.delta_cc = flex.double()
-    for test_k in self.intensities.keys():
-      #print test_k
-      indices_i = flex.miller_index()
-      data_i = flex.double()
-      sigmas_i = flex.double()
-      for k, unmerged in self.intensities.iteritems():
-        if k == test_k: continue
-        indices_i.extend(unmerged.indices())
-        data_i.extend(unmerged.data())
-        sigmas_i.extend(unmerged.sigmas())
-
-      unmerged_i = unmerged_intensities.customized_copy(
-        indices=indices_i, data=data_i, sigmas=sigmas_i).set_info(
-          unmerged_intensities.info())
-
-      unmerged_i.setup_binner_counting_sorted(n_bins=n_bins)
-      if cc_one_half_method == 'sigma_tau':
-        cc_bins = unmerged_i.cc_one_half_sigma_tau(
-          use_binning=True, return_n_refl=True)
-      else:
-        cc_bins = unmerged_i.cc_one_half(use_binning=True, return_n_refl=True)
-      cc_i = flex.mean_weighted(
-        flex.double(b[0] for b in cc_bins.data[1:-1]),
-        flex.double(b[1] for b in cc_bins.data[1:-1]))
-
-      delta_cc_i = cc_i - cc_overall
+    for j in range(cc_half.n_groups):
+      delta_cc_i = cc_half.cc_one_half(exclude=j) - cc_overall
       self.delta_cc.append(delta_cc_i)
 
   def _labels(self):
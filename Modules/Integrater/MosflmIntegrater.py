@@ -14,8 +14,6 @@
 
 import os
 
-from xia2.Background.Background import Background
-
 # interfaces that this will present
 from xia2.Schema.Interfaces.Integrater import Integrater
 
@@ -31,7 +29,7 @@
 
 from xia2.Modules.GainEstimater import gain
 
-from xia2.lib.bits import auto_logfiler
+from xia2.lib.bits import auto_logfiler, _get_number
 from xia2.lib.SymmetryLib import lattice_to_spacegroup
 
 # exceptions
@@ -43,6 +41,53 @@
 from xia2.Wrappers.CCP4.Reindex import Reindex
 from xia2.Wrappers.CCP4.Sortmtz import Sortmtz
 
+class _mosflm_job_settings(object):
+  '''A record of the calls made to set up a Mosflm integration job, and of
+  the number for its log file, so that the job may be created and set up
+  in a worker process.'''
+
+  def __init__(self):
+    self.calls = []
+    self.log_number = None
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    def record(*args):
+      self.calls.append((name, args))
+    return record
+
+def _run_mosflm_integrate(settings):
+  '''Create, set up and run a Mosflm integration job, returning the
+  results needed by the integrater - may be run in a worker process.'''
+
+  job = MosflmIntegrate()
+  for name, args in settings.calls:
+    getattr(job, name)(*args)
+  auto_logfiler(job, number=settings.log_number)
+
+  # an IntegrationError (e.g. a negative mosaic spread) cannot be passed
+  # back from a worker process as such, so is returned for the integrater
+  # to raise again and recover from
+
+  try:
+    job.run()
+  except IntegrationError, e:
+    return {'integration_error':e.parameter}
+
+  return {'integration_error':None,
+          'hklout':job.get_hklout(),
+          'nref':job.get_nref(),
+          'batches':job.get_batches_out(),
+          'mosaics':job.get_mosaic_spreads(),
+          'bgsig_too_large':job.get_bgsig_too_large(),
+          'getprof_error':job.get_getprof_error(),
+          'detector_gain_error':job.get_detector_gain_error(),
+          'suggested_gain':job.get_suggested_gain(),
+          'per_image_statistics':job.get_per_image_statistics(),
+          'postref_result':job.get_postref_result(),
+          'residuals':job.get_residuals()}
+
 class MosflmIntegrater(Integrater):
   '''A wrapper for Mosflm integration.'''
 
@@ -443,12 +488,10 @@ def _mosflm_integrate(self):
 
     return self._mosflm_hklout
 
-  def _mosflm_parallel_integrate(self):
-    '''Perform the integration as before, but this time as a
-    number of parallel Mosflm jobs (hence, in separate directories)
-    and including a step of pre-refinement of the mosaic spread and
-    missets. This will all be kind of explicit and hence probably
-    messy!'''
+  def _mosflm_parallel_job(self, wd, image_range, refine_profiles):
+    '''Return the set up of a Mosflm job to integrate image_range in the
+    working directory wd, as the calls to make on the job and the number
+    of its log file.'''
 
     refinr = self.get_integrater_refiner()
 
@@ -459,6 +502,113 @@ def _mosflm_parallel_integrate(self):
     distance = refinr.get_refiner_payload('distance')
     matrix = refinr.get_refiner_payload('mosflm_orientation_matrix')
 
+    pname, xname, dname = self.get_integrater_project_info()
+
+    if not os.path.exists(wd):
+      os.makedirs(wd)
+
+    job = _mosflm_job_settings()
+    job.set_working_directory(wd)
+
+    # the log file is numbered here rather than in the worker, which has
+    # its own copy of the run number, so that every chunk (and every rerun
+    # of one) has a log file of its own
+    job.log_number = _get_number()
+
+    # create the starting point
+    f = open(os.path.join(wd, 'xiaintegrate-%s.mat' % lattice), 'w')
+    for m in matrix:
+      f.write(m)
+    f.close()
+
+    job.set_refine_profiles(refine_profiles)
+
+    # N.B. for harvesting need to append N to dname.
+
+    if pname is not None and xname is not None and dname is not None:
+      Debug.write('Harvesting: %s/%s/%s' %
+                  (pname, xname, dname))
+      temp_dname = '%s_%s' % \
+                   (dname, self.get_integrater_sweep_name())
+      job.set_pname_xname_dname(pname, xname, temp_dname)
+
+    job.set_template(os.path.basename(self.get_template()))
+    job.set_directory(self.get_directory())
+
+    # check for ice - and if so, exclude (ranges taken from
+    # XDS documentation)
+    if self.get_integrater_ice() != 0:
+      Debug.write('Excluding ice rings')
+      job.set_exclude_ice(True)
+
+    # exclude specified resolution ranges
+    if len(self.get_integrater_excluded_regions()) != 0:
+      regions = self.get_integrater_excluded_regions()
+      Debug.write('Excluding regions: %s' % `regions`)
+      job.set_exclude_regions(regions)
+
+    mask = standard_mask(self.get_detector())
+    for m in mask:
+      job.add_instruction(m)
+
+    job.set_input_mat_file('xiaintegrate-%s.mat' % lattice)
+
+    job.set_beam_centre(beam)
+    job.set_distance(distance)
+    job.set_space_group_number(spacegroup_number)
+    job.set_mosaic(mosaic)
+
+    if self.get_wavelength_prov() == 'user':
+      job.set_wavelength(self.get_wavelength())
+
+    parameters = self.get_integrater_parameters('mosflm')
+    job.update_parameters(parameters)
+
+    if self._mosflm_gain:
+      job.set_gain(self._mosflm_gain)
+
+    # check for resolution limits
+    if self._intgr_reso_high > 0.0:
+      job.set_d_min(self._intgr_reso_high)
+    if self._intgr_reso_low:
+      job.set_d_max(self._intgr_reso_low)
+
+    if PhilIndex.params.general.backstop_mask:
+      from xia2.Toolkit.BackstopMask import BackstopMask
+      mask = BackstopMask(PhilIndex.params.general.backstop_mask)
+      mask = mask.calculate_mask_mosflm(self.get_header())
+      job.set_mask(mask)
+
+    detector = self.get_detector()
+    detector_width, detector_height = detector[0].get_image_size_mm()
+
+    lim_x = 0.5 * detector_width
+    lim_y = 0.5 * detector_height
+
+    Debug.write('Scanner limits: %.1f %.1f' % (lim_x, lim_y))
+    job.set_limits(lim_x, lim_y)
+
+    job.set_fix_mosaic(self._mosflm_postref_fix_mosaic)
+
+    job.set_pre_refinement(True)
+    job.set_image_range(image_range)
+
+    return job
+
+  def _mosflm_parallel_integrate(self):
+    '''Perform the integration as before, but this time as a
+    number of parallel Mosflm jobs (hence, in separate directories)
+    and including a step of pre-refinement of the mosaic spread and
+    missets. The sweep is split into chunks, about two per processor,
+    which are run in a bounded pool of worker processes (locally or
+    through qsub) and the results of each chunk are read as soon as it
+    is finished - chunks which fail with BGSIG or GETPROF errors are
+    run again with the profiles fixed.'''
+
+    from xia2.Applications.xia2_scheduler import scheduler
+
+    refinr = self.get_integrater_refiner()
+
     integration_params = refinr.get_refiner_payload(
       'mosflm_integration_parameters')
 
@@ -473,31 +623,23 @@ def _mosflm_parallel_integrate(self):
             '%d %d %d %d %d' % tuple(integration_params['raster']))
 
     refinr.set_refiner_payload('mosflm_integration_parameters', None)
-    pname, xname, dname = self.get_integrater_project_info()
 
-    # what follows below should (i) be run in separate directories
-    # and (ii) be repeated N=parallel times.
-
-    nproc = PhilIndex.params.xia2.settings.multiprocessing.nproc
-    parallel = nproc
+    mp_params = PhilIndex.params.xia2.settings.multiprocessing
+    nproc = mp_params.nproc
 
     # FIXME this is something of a kludge - if too few frames refinement
     # and integration does not work well... ideally want at least 15
-    # frames / chunk (say)
+    # frames / chunk (say) - otherwise smaller chunks keep the processors
+    # busy while the slowest chunks are finishing
     nframes = self._intgr_wedge[1] - self._intgr_wedge[0] + 1
 
-    if parallel > nframes / 15:
-      parallel = nframes // 15
+    parallel = min(2 * nproc, nframes // 15)
 
     if not parallel:
       raise RuntimeError, 'parallel not set'
     if parallel < 2:
       raise RuntimeError, 'parallel not parallel: %s' % parallel
 
-    jobs = []
-    hklouts = []
-    nref = 0
-
     # calculate the chunks to use
     offset = self.get_frame_offset()
     start = self._intgr_wedge[0] - offset
@@ -514,226 +656,121 @@ def _mosflm_parallel_integrate(self):
       left_images -= size
       left_chunks -= 1
 
-    summary_files = []
-
-    for j in range(parallel):
-
-      # make some working directories, as necessary - chunk-(0:N-1)
-      wd = os.path.join(self.get_working_directory(),
-                        'chunk-%d' % j)
-      if not os.path.exists(wd):
-        os.makedirs(wd)
-
-      job = MosflmIntegrate()
-      job.set_working_directory(wd)
-
-      auto_logfiler(job)
-
-      l = refinr.get_refiner_lattice()
-
-      # create the starting point
-      f = open(os.path.join(wd, 'xiaintegrate-%s.mat' % l), 'w')
-      for m in matrix:
-        f.write(m)
-      f.close()
-
-      spacegroup_number = lattice_to_spacegroup(lattice)
+    # the results of each chunk, recorded as each one finishes
 
-      job.set_refine_profiles(self._mosflm_refine_profiles)
+    results = { }
 
-      # N.B. for harvesting need to append N to dname.
-
-      if pname is not None and xname is not None and dname is not None:
-        Debug.write('Harvesting: %s/%s/%s' %
-                    (pname, xname, dname))
-        harvest_dir = self.get_working_directory()
-        temp_dname = '%s_%s' % \
-                     (dname, self.get_integrater_sweep_name())
-        job.set_pname_xname_dname(pname, xname, temp_dname)
-
-      job.set_template(os.path.basename(self.get_template()))
-      job.set_directory(self.get_directory())
-
-      # check for ice - and if so, exclude (ranges taken from
-      # XDS documentation)
-      if self.get_integrater_ice() != 0:
-        Debug.write('Excluding ice rings')
-        job.set_exclude_ice(True)
-
-      # exclude specified resolution ranges
-      if len(self.get_integrater_excluded_regions()) != 0:
-        regions = self.get_integrater_excluded_regions()
-        Debug.write('Excluding regions: %s' % `regions`)
-        job.set_exclude_regions(regions)
-
-      mask = standard_mask(self.get_detector())
-      for m in mask:
-        job.add_instruction(m)
-
-      job.set_input_mat_file('xiaintegrate-%s.mat' % l)
+    if mp_params.type == 'qsub':
+      driver_type = 'qsub'
+    else:
+      driver_type = None
 
-      job.set_beam_centre(beam)
-      job.set_distance(distance)
-      job.set_space_group_number(spacegroup_number)
-      job.set_mosaic(mosaic)
+    # a sweep processed in a pool worker (which is daemonic, so may not have
+    # children) runs its chunks in threads, which only wait for Mosflm
 
-      if self.get_wavelength_prov() == 'user':
-        job.set_wavelength(self.get_wavelength())
+    import multiprocessing
+    chunk_scheduler = scheduler(
+      [driver_type] * min(nproc, parallel),
+      threads=multiprocessing.current_process().daemon)
 
-      parameters = self.get_integrater_parameters('mosflm')
-      job.update_parameters(parameters)
+    def add_chunk(j, refine_profiles):
+      wd = os.path.join(self.get_working_directory(), 'chunk-%d' % j)
+      chunk_scheduler.add_task(
+        'mosflm integrate chunk %d' % j, _run_mosflm_integrate,
+        (self._mosflm_parallel_job(wd, chunks[j], refine_profiles), ),
+        callback=lambda result, j=j, refine_profiles=refine_profiles: \
+          chunk_finished(j, refine_profiles, result))
 
-      if self._mosflm_gain:
-        job.set_gain(self._mosflm_gain)
+    def chunk_finished(j, refine_profiles, result):
 
-      # check for resolution limits
-      if self._intgr_reso_high > 0.0:
-        job.set_d_min(self._intgr_reso_high)
-      if self._intgr_reso_low:
-        job.set_d_max(self._intgr_reso_low)
+      if result['integration_error'] is not None:
+        raise IntegrationError, result['integration_error']
 
-      if PhilIndex.params.general.backstop_mask:
-        from xia2.Toolkit.BackstopMask import BackstopMask
-        mask = BackstopMask(PhilIndex.params.general.backstop_mask)
-        mask = mask.calculate_mask_mosflm(self.get_header())
-        job.set_mask(mask)
+      # if a BGSIG or GETPROF error happened try not refining the
+      # profile and running this chunk again...
 
-      detector = self.get_detector()
-      detector_width, detector_height = detector[0].get_image_size_mm()
+      if result['bgsig_too_large']:
+        if not refine_profiles:
+          raise RuntimeError, 'BGSIG error with profiles fixed'
+        Debug.write(
+            'BGSIG error detected in chunk %d - try fixing profile...' % j)
+        add_chunk(j, False)
+        return
 
-      lim_x = 0.5 * detector_width
-      lim_y = 0.5 * detector_height
+      if result['getprof_error']:
+        if not refine_profiles:
+          raise RuntimeError, 'GETPROF error with profiles fixed'
+        Debug.write(
+            'GETPROF error detected in chunk %d - try fixing profile...' % j)
+        add_chunk(j, False)
+        return
 
-      Debug.write('Scanner limits: %.1f %.1f' % (lim_x, lim_y))
-      job.set_limits(lim_x, lim_y)
+      if result['mosaics'] and min(result['mosaics']) < 0:
+        raise IntegrationError, 'negative mosaic spread: %s' % \
+              min(result['mosaics'])
 
-      job.set_fix_mosaic(self._mosflm_postref_fix_mosaic)
+      # look for things that we want to know... the updated value for
+      # the gain (if present,) any warnings, errors, or just interesting
+      # facts.
 
-      job.set_pre_refinement(True)
-      job.set_image_range(chunks[j])
+      if (result['detector_gain_error'] and not
+          (self.get_imageset().get_detector()[0].get_type() == 'SENSOR_PAD')):
+        gain = result['suggested_gain']
+        if gain is not None:
+          self.set_integrater_parameter('mosflm', 'gain', gain)
+          self.set_integrater_export_parameter('mosflm', 'gain', gain)
+          if self._mosflm_gain:
+            Debug.write('GAIN updated to %f' % gain)
+          else:
+            Debug.write('GAIN found to be %f' % gain)
 
+          self._mosflm_gain = gain
+          self._mosflm_rerun_integration = True
 
-      # these are now running so ...
+      Debug.write('Integration output: %s' % result['hklout'])
+      results[j] = result
 
-      jobs.append(job)
+    for j in range(parallel):
+      add_chunk(j, self._mosflm_refine_profiles)
 
-      continue
+    chunk_scheduler.run()
 
     # ok, at this stage I need to ...
     #
     # (i) accumulate the statistics as a function of batch
     # (ii) mong them into a single block
-    #
-    # This is likely to be a pain in the arse!
-
-    first_integrated_batch = 1.0e6
-    last_integrated_batch = -1.0e6
-
-    all_residuals = []
-
-    threads = []
-
-    for j in range(parallel):
-      job = jobs[j]
-
-      # now wait for them to finish - first wait will really be the
-      # first one, then all should be finished...
-
-      thread = Background(job, 'run')
-      thread.start()
-      threads.append(thread)
 
+    hklouts = []
+    nref = 0
     mosaics = []
     postref_result = { }
+    all_residuals = []
 
     integrated_images_first = 1.0e6
     integrated_images_last = -1.0e6
     self._intgr_per_image_statistics = {}
 
     for j in range(parallel):
-      thread = threads[j]
-      thread.stop()
-      job = jobs[j]
-
-      # get the log file
-      output = job.get_all_output()
+      result = results[j]
 
-      # record a copy of it, perhaps - though not if parallel
-      if self.get_integrater_sweep_name() and False:
-        pname, xname, dname = self.get_integrater_project_info()
-        FileHandler.record_log_file(
-            '%s %s %s %s mosflm integrate' % \
-            (self.get_integrater_sweep_name(),
-             pname, xname, '%s_%d' % (dname, j)),
-            job.get_log_file())
-
-      # look for things that we want to know...
-      # that is, the output reflection file name, the updated
-      # value for the gain (if present,) any warnings, errors,
-      # or just interesting facts.
-
-      batches = job.get_batches_out()
+      batches = result['batches']
       integrated_images_first = min(batches[0], integrated_images_first)
       integrated_images_last = max(batches[1], integrated_images_last)
 
-      mosaics.extend(job.get_mosaic_spreads())
-
-      if min(mosaics) < 0:
-        raise IntegrationError, 'negative mosaic spread: %s' % min(mosaic)
-
-      if (job.get_detector_gain_error() and not
-          (self.get_imageset().get_detector()[0].get_type() == 'SENSOR_PAD')):
-        gain = job.get_suggested_gain()
-        if gain is not None:
-          self.set_integrater_parameter('mosflm', 'gain', gain)
-          self.set_integrater_export_parameter('mosflm', 'gain', gain)
-          if self._mosflm_gain:
-            Debug.write('GAIN updated to %f' % gain)
-          else:
-            Debug.write('GAIN found to be %f' % gain)
-
-          self._mosflm_gain = gain
-          self._mosflm_rerun_integration = True
-
-      hklout = job.get_hklout()
-      Debug.write('Integration output: %s' % hklout)
-      hklouts.append(hklout)
-
-      nref += job.get_nref()
-
-      # if a BGSIG error happened try not refining the
-      # profile and running again...
-
-      if job.get_bgsig_too_large():
-        if not self._mosflm_refine_profiles:
-          raise RuntimeError, 'BGSIG error with profiles fixed'
-
-        Debug.write(
-            'BGSIG error detected - try fixing profile...')
-
-        self._mosflm_refine_profiles = False
-        self.set_integrater_done(False)
-
-        return
-
-      if job.get_getprof_error():
-        Debug.write(
-            'GETPROF error detected - try fixing profile...')
-        self._mosflm_refine_profiles = False
-        self.set_integrater_done(False)
-
-        return
+      mosaics.extend(result['mosaics'])
+      hklouts.append(result['hklout'])
+      nref += result['nref']
 
       # here
       # write the report for each image as .*-#$ to Chatter -
       # detailed report will be written automagically to science...
 
-      self._intgr_per_image_statistics.update(job.get_per_image_statistics())
-      postref_result.update(job.get_postref_result())
+      self._intgr_per_image_statistics.update(result['per_image_statistics'])
+      postref_result.update(result['postref_result'])
 
       # inspect the output for e.g. very high weighted residuals
 
-      all_residuals.extend(job.get_residuals())
+      all_residuals.extend(result['residuals'])
 
     self._intgr_batches_out = (integrated_images_first,
                                integrated_images_last)
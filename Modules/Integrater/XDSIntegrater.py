@@ -154,9 +154,12 @@ def Defpix(self):
 
     return defpix
 
-  def Integrate(self):
-    integrate = _Integrate(params=PhilIndex.params.xds.integrate)
-    integrate.set_working_directory(self.get_working_directory())
+  def Integrate(self, working_directory=None, driver_type=None):
+    integrate = _Integrate(DriverType=driver_type,
+                           params=PhilIndex.params.xds.integrate)
+    if working_directory is None:
+      working_directory = self.get_working_directory()
+    integrate.set_working_directory(working_directory)
 
     integrate.setup_from_imageset(self.get_imageset())
 
@@ -364,11 +367,6 @@ def _integrate(self):
                  'ABS.cbf']:
       self._xds_data_files[file] = defpix.get_output_data_file(file)
 
-    integrate = self.Integrate()
-
-    if self._xds_integrate_parameters:
-      integrate.set_updates(self._xds_integrate_parameters)
-
     # decide what images we are going to process, if not already
     # specified
 
@@ -377,28 +375,21 @@ def _integrate(self):
       self.set_integrater_wedge(min(images),
                                 max(images))
 
-    integrate.set_data_range(self._intgr_wedge[0] + self.get_frame_offset(),
-                             self._intgr_wedge[1] + self.get_frame_offset())
+    wedges = self._xds_integrate_wedges()
 
-    for file in ['X-CORRECTIONS.cbf',
-                 'Y-CORRECTIONS.cbf',
-                 'BLANK.cbf',
-                 'BKGPIX.cbf',
-                 'GAIN.cbf']:
-      integrate.set_input_data_file(file, self._xds_data_files[file])
+    if len(wedges) > 1:
+      per_image_statistics, updates, mosaic = \
+        self._xds_integrate_in_wedges(wedges)
 
-    if 'GXPARM.XDS' in self._xds_data_files:
-      Debug.write('Using globally refined parameters')
-      integrate.set_input_data_file(
-          'XPARM.XDS', self._xds_data_files['GXPARM.XDS'])
-      integrate.set_refined_xparm()
     else:
-      integrate.set_input_data_file(
-          'XPARM.XDS', self._xds_data_files['XPARM.XDS'])
+      integrate = self._xds_integrate_job(*self._intgr_wedge)
+      integrate.run()
 
-    integrate.run()
+      per_image_statistics = integrate.get_per_image_statistics()
+      updates = integrate.get_updates()
+      mosaic = integrate.get_mosaic()
 
-    self._intgr_per_image_statistics = integrate.get_per_image_statistics()
+    self._intgr_per_image_statistics = per_image_statistics
     Chatter.write(self.show_per_image_statistics())
 
     # record the log file -
@@ -430,11 +421,11 @@ def _integrate(self):
     # integration or can we assume that the application of a
     # sensible resolution limit will achieve this??
 
-    self._xds_integrate_parameters = integrate.get_updates()
+    self._xds_integrate_parameters = updates
 
     # record the mosaic spread &c.
 
-    m_min, m_mean, m_max = integrate.get_mosaic()
+    m_min, m_mean, m_max = mosaic
     self.set_integrater_mosaic_min_mean_max(m_min, m_mean, m_max)
 
     Chatter.write('Mosaic spread: %.3f < %.3f < %.3f' % \
@@ -442,6 +433,155 @@ def _integrate(self):
 
     return os.path.join(self.get_working_directory(), 'INTEGRATE.HKL')
 
+  def _xds_integrate_job(self, start, end, working_directory=None,
+                         driver_type=None):
+    '''Set up an INTEGRATE job for images start to end.'''
+
+    integrate = self.Integrate(working_directory, driver_type)
+
+    if self._xds_integrate_parameters:
+      integrate.set_updates(self._xds_integrate_parameters)
+
+    integrate.set_data_range(start + self.get_frame_offset(),
+                             end + self.get_frame_offset())
+
+    for file in ['X-CORRECTIONS.cbf',
+                 'Y-CORRECTIONS.cbf',
+                 'BLANK.cbf',
+                 'BKGPIX.cbf',
+                 'GAIN.cbf']:
+      integrate.set_input_data_file(file, self._xds_data_files[file])
+
+    if 'GXPARM.XDS' in self._xds_data_files:
+      Debug.write('Using globally refined parameters')
+      integrate.set_input_data_file(
+          'XPARM.XDS', self._xds_data_files['GXPARM.XDS'])
+      integrate.set_refined_xparm()
+    else:
+      integrate.set_input_data_file(
+          'XPARM.XDS', self._xds_data_files['XPARM.XDS'])
+
+    return integrate
+
+  def _xds_integrate_wedges(self):
+    '''Return the wedges of images to integrate separately, as
+    ((start, end), (integrate_start, integrate_end)) - a single wedge
+    unless xds.integrate.wedge_width is set.'''
+
+    from xia2.Wrappers.XDS.XDSIntegrateHelpers import _wedge_ranges
+
+    first, last = self._intgr_wedge
+    params = PhilIndex.params.xds.integrate
+
+    if not params.wedge_width:
+      return [((first, last), (first, last))]
+
+    # the wedge boundaries fall between the DELPHI blocks of INTEGRATE
+
+    phi_width = self.get_phi_width()
+
+    if params.delphi:
+      delphi = params.delphi
+    elif PhilIndex.params.xia2.settings.small_molecule == True:
+      delphi = PhilIndex.params.xds.delphi_small
+    else:
+      delphi = PhilIndex.params.xds.delphi
+
+    return _wedge_ranges(first, last, params.wedge_width / phi_width,
+                         int(round(delphi / phi_width)),
+                         int(math.ceil(params.wedge_overlap / phi_width)))
+
+  def _xds_integrate_in_wedges(self, wedges):
+    '''Integrate the wedges as separate INTEGRATE jobs in their own
+    directories - at the same time if these are submitted to a cluster -
+    then join the INTEGRATE.HKL and INTEGRATE.LP files. Returns the per
+    image statistics, updated parameters and mosaic spread range.'''
+
+    from multiprocessing.pool import ThreadPool
+    from xia2.Driver.DriverFactory import DriverFactory
+    from xia2.Wrappers.XDS.XDSIntegrateHelpers import _stitch_integrate_hkl
+
+    mp_params = PhilIndex.params.xia2.settings.multiprocessing
+    if mp_params.type == 'qsub':
+      driver_type = 'qsub'
+    else:
+      driver_type = DriverFactory.get_driver_type()
+
+    # each local job already uses all of the processors
+
+    if driver_type == 'qsub' or 'cluster' in driver_type:
+      n_jobs = len(wedges)
+    else:
+      n_jobs = 1
+
+    Debug.write('Integrating %d wedges, %d at a time' % \
+                (len(wedges), n_jobs))
+
+    jobs = []
+    for j, (owned, integrated) in enumerate(wedges):
+      wd = os.path.join(self.get_working_directory(), 'wedge-%d' % j)
+      if not os.path.exists(wd):
+        os.makedirs(wd)
+      Debug.write('Wedge %d: images %d to %d from %d to %d' % \
+                  ((j, ) + owned + integrated))
+      jobs.append(self._xds_integrate_job(
+        integrated[0], integrated[1], working_directory=wd,
+        driver_type=driver_type))
+
+    def run(j):
+      jobs[j].run()
+      return j
+
+    # gather the statistics for the images owned by each wedge as each
+    # job finishes - XDS numbers the frames including the offset
+
+    offset = self.get_frame_offset()
+    owned = [(start + offset, end + offset)
+             for (start, end), integrated in wedges]
+
+    per_image_statistics = { }
+    updates = [ ]
+    mosaics = [ ]
+
+    pool = ThreadPool(n_jobs)
+    try:
+      for j in pool.imap_unordered(run, range(len(jobs))):
+        start, end = owned[j]
+        stats = jobs[j].get_per_image_statistics()
+        for image in stats:
+          if start <= image <= end:
+            per_image_statistics[image] = stats[image]
+        updates.append(jobs[j].get_updates())
+        mosaics.append(jobs[j].get_mosaic())
+        Debug.write('Wedge %d integrated' % j)
+    finally:
+      pool.close()
+      pool.join()
+
+    wd = self.get_working_directory()
+
+    _stitch_integrate_hkl(
+      [(job.get_integrate_hkl(), images) for job, images in zip(jobs, owned)],
+      os.path.join(wd, 'INTEGRATE.HKL'),
+      (self._intgr_wedge[0] + offset, self._intgr_wedge[1] + offset))
+
+    with open(os.path.join(wd, 'INTEGRATE.LP'), 'wb') as fout:
+      for job in jobs:
+        with open(os.path.join(
+          job.get_working_directory(), 'INTEGRATE.LP'), 'rb') as fin:
+          shutil.copyfileobj(fin, fout)
+
+    mean_updates = { }
+    for key in updates[0]:
+      values = [u[key] for u in updates if key in u]
+      mean_updates[key] = sum(values) / len(values)
+
+    mosaic = (min(m[0] for m in mosaics),
+              sum(m[1] for m in mosaics) / len(mosaics),
+              max(m[2] for m in mosaics))
+
+    return per_image_statistics, mean_updates, mosaic
+
   def _integrate_finish(self):
     '''Finish off the integration by running correct.'''
 
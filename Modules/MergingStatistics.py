@@ -0,0 +1,255 @@
+# An in-process "statistics session" for a scaled unmerged reflection file:
+# the file is read once and the binned merging statistics computed once for
+# each distinct set of parameters, then used to answer the resolution limit
+# estimates (CC1/2, Rmerge, completeness, I/sigI, Mn(I/sigI)) and the merging
+# statistics tables computed by the scalers. The sessions are shared by the
+# whole process, keyed by the path of the file, so that the scalers, xia2.report
+# and xia2.html decode each file once - a session is replaced if the file
+# changes on disk, and may be evicted explicitly once it is no longer needed.
+# At most max_sessions are kept, the least recently used being released
+# first, so that multi-crystal or multi-wavelength jobs do not keep every
+# dataset in memory.
+
+from __future__ import absolute_import, division
+
+import collections
+import os
+
+from xia2.Modules.Resolutionizer import read_unmerged_intensities, \
+     select_batch_range, compute_merging_statistics, resolutionizer, \
+     phil_defaults
+
+class statistics_session(object):
+  '''A class to hold the parsed contents of a scaled unmerged reflection
+  file, and the binned merging statistics derived from it.'''
+
+  def __init__(self, scaled_unmerged):
+
+    from iotbx.reflection_file_reader import any_reflection_file
+
+    self._scaled_unmerged = scaled_unmerged
+    self._stat = self._get_stat()
+
+    self._reflection_file = any_reflection_file(scaled_unmerged)
+    self._miller_arrays = self._reflection_file.as_miller_arrays(
+      merge_equivalents=False)
+    self._original_indices = None
+
+    self._i_obs_asu, self._i_obs, self._batches = \
+      read_unmerged_intensities(scaled_unmerged,
+                                hkl_in=self._reflection_file,
+                                miller_arrays=self._miller_arrays)
+
+    self._merging_statistics = { }
+    self._resolutionizer_statistics = { }
+    self._merged_intensities = { }
+
+    return
+
+  def _get_stat(self):
+    st = os.stat(self._scaled_unmerged)
+    return st.st_size, st.st_mtime
+
+  def touch(self):
+    '''Record that the file has been rewritten without changing the
+    reflections (e.g. to add history), so that the session remains
+    current.'''
+
+    self._stat = self._get_stat()
+
+    return
+
+  def is_current(self):
+    '''Return True if the file has not changed since it was read.'''
+
+    try:
+      return self._get_stat() == self._stat
+    except OSError:
+      return False
+
+  def get_file_type(self):
+    return self._reflection_file.file_type()
+
+  def get_miller_arrays(self):
+    '''Return all of the (unmerged) miller arrays in the file, which are
+    shared and should not be modified.'''
+
+    return self._miller_arrays
+
+  def get_mtz_object(self):
+    '''Return the iotbx.mtz object for an MTZ file, which is shared and
+    should not be modified.'''
+
+    return self._reflection_file.file_content()
+
+  def get_original_indices(self):
+    '''Return the original Miller indices of the observations in an MTZ
+    file.'''
+
+    if self._original_indices is None:
+      self._original_indices = \
+        self.get_mtz_object().extract_original_index_miller_indices()
+
+    return self._original_indices
+
+  def get_intensities(self, original_indices=True, batch_range=None):
+    '''Return the unmerged intensities, optionally restricted to a batch
+    range. The intensities with original Miller indices are needed for
+    correct anomalous statistics; the indices as read from the file are
+    those used by iotbx.merging_statistics.select_data.'''
+
+    if original_indices:
+      i_obs = self._i_obs
+    else:
+      i_obs = self._i_obs_asu
+
+    if batch_range is not None:
+      i_obs = select_batch_range(i_obs, self._batches, batch_range)
+
+    return i_obs
+
+  def merging_statistics(self, anomalous=False, d_min=None, d_max=None,
+                         n_bins=20, use_internal_variance=False,
+                         eliminate_sys_absent=False, original_indices=False,
+                         cc_one_half_significance_level=None):
+    '''Return the full merging statistics tables, as computed by
+    iotbx.merging_statistics.dataset_statistics, computing them only once
+    for a given set of parameters. By default the statistics are computed
+    as by the scalers, from the indices as read from the file; with
+    original_indices as by xia2.report, from the original indices (mapped
+    to the asu, for anomalous statistics).'''
+
+    key = (anomalous, d_min, d_max, n_bins, use_internal_variance,
+           eliminate_sys_absent, original_indices,
+           cc_one_half_significance_level)
+
+    if not key in self._merging_statistics:
+      import iotbx.merging_statistics
+
+      if original_indices:
+        i_obs = self.get_intensities(original_indices=True)
+        if anomalous:
+          i_obs = i_obs.as_anomalous_array().map_to_asu().customized_copy(
+            info=i_obs.info())
+      else:
+        i_obs = self.get_intensities(original_indices=False)
+        i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+
+      self._merging_statistics[key] = \
+        iotbx.merging_statistics.dataset_statistics(
+          i_obs=i_obs,
+          d_min=d_min,
+          d_max=d_max,
+          n_bins=n_bins,
+          anomalous=anomalous,
+          use_internal_variance=use_internal_variance,
+          eliminate_sys_absent=eliminate_sys_absent,
+          cc_one_half_significance_level=cc_one_half_significance_level,
+          assert_is_not_unique_set_under_symmetry=False,
+        )
+
+    return self._merging_statistics[key]
+
+  def merged_intensities(self, use_internal_variance=False):
+    '''Return the merged (anomalous) intensities.'''
+
+    if not use_internal_variance in self._merged_intensities:
+      i_obs = self.get_intensities(original_indices=False)
+      i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+      self._merged_intensities[use_internal_variance] = \
+        i_obs.merge_equivalents(
+          use_internal_variance=use_internal_variance).array()
+
+    return self._merged_intensities[use_internal_variance]
+
+  def resolutionizer(self, params, batch_range=None):
+    '''Return a resolutionizer for the given resolutionizer parameters,
+    sharing the binned statistics with any other resolutionizer using
+    the same binning.'''
+
+    key = (params.nbins, params.binning_method, params.anomalous,
+           params.cc_half_method, params.cc_half_significance_level,
+           batch_range)
+
+    if not key in self._resolutionizer_statistics:
+      i_obs = self.get_intensities(batch_range=batch_range)
+      self._resolutionizer_statistics[key] = compute_merging_statistics(
+        i_obs, params)
+
+    return resolutionizer(
+      self._scaled_unmerged, params,
+      merging_statistics=self._resolutionizer_statistics[key])
+
+  def resolution_limits(self, rmerge=None, completeness=None, cc_half=None,
+                        cc_half_significance_level=None, isigma=None,
+                        misigma=None, nbins=100, batch_range=None):
+    '''Compute the resolution limits for every criterion which is set,
+    returning a dictionary keyed by criterion name.'''
+
+    params = phil_defaults.extract().resolutionizer
+    params.rmerge = rmerge
+    params.completeness = completeness
+    params.cc_half = cc_half
+    params.cc_half_significance_level = cc_half_significance_level
+    params.isigma = isigma
+    params.misigma = misigma
+    params.nbins = nbins
+    params.batch_range = batch_range
+
+    m = self.resolutionizer(params, batch_range=batch_range)
+
+    limits = { }
+
+    if rmerge:
+      limits['rmerge'] = m.resolution_rmerge()
+    if completeness:
+      limits['completeness'] = m.resolution_completeness()
+    if cc_half:
+      limits['cc_half'] = m.resolution_cc_half()
+    if isigma:
+      limits['isigma'] = m.resolution_unmerged_isigma()
+    if misigma:
+      limits['misigma'] = m.resolution_merged_isigma()
+
+    return limits
+
+max_sessions = 2
+
+_statistics_sessions = collections.OrderedDict()
+
+def get_statistics_session(scaled_unmerged):
+  '''Return the statistics session for a scaled unmerged reflection file,
+  shared by the whole process, reading the file only if it is new or has
+  changed on disk.'''
+
+  key = os.path.abspath(scaled_unmerged)
+
+  session = _statistics_sessions.pop(key, None)
+  if session is None or not session.is_current():
+    while len(_statistics_sessions) >= max_sessions:
+      _statistics_sessions.popitem(last=False)
+    session = statistics_session(scaled_unmerged)
+  _statistics_sessions[key] = session
+
+  return session
+
+def touch_statistics_session(scaled_unmerged):
+  '''Keep any statistics session for a reflection file which has been
+  rewritten with the same reflections.'''
+
+  session = _statistics_sessions.get(os.path.abspath(scaled_unmerged))
+  if session is not None:
+    session.touch()
+
+  return
+
+def evict_statistics_session(scaled_unmerged=None):
+  '''Release the statistics session for a reflection file, or all of the
+  sessions if no file is given.'''
+
+  if scaled_unmerged is None:
+    _statistics_sessions.clear()
+  else:
+    _statistics_sessions.pop(os.path.abspath(scaled_unmerged), None)
+
+  return
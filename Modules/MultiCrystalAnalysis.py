@@ -2,6 +2,7 @@
 import os
 import sys
 
+import numpy
 import iotbx.phil
 from libtbx.phil import command_line
 from scitbx.array_family import flex
@@ -9,6 +10,8 @@
 from cctbx import crystal, miller, sgtbx, uctbx
 
 from xia2.Handlers.Streams import Chatter, Debug
+from xia2.Toolkit.MillerIndexGroups import miller_index_array, \
+  unique_miller_indices
 
 def get_scipy():
   # make sure we can get scipy, if not try failing over to version in CCP4
@@ -105,6 +108,158 @@ def __init__(self, unmerged_intensities, batches_all, id_to_batches=None):
     self.batches = batches
 
 
+class pairwise_correlation(object):
+  '''The correlation coefficients between all pairs of a set of merged
+  intensity arrays, computed together: each array is resolution filtered and
+  mapped once onto a shared index space of asu Miller indices, and the sums
+  needed for the correlation on the common reflections of every pair are
+  found as products of sparse (dataset, reflection) matrices of the
+  intensities and a presence mask. The sums are kept, so that adding an array
+  computes only the new row of the matrix.'''
+
+  def __init__(self, d_min=None):
+    self._d_min = d_min
+
+    # the column in the shared index space of each Miller index seen, as
+    # parallel arrays sorted by the index
+    self._hkl = numpy.zeros((0, 3), dtype=numpy.int64)
+    self._columns = numpy.zeros(0, dtype=numpy.int64)
+
+    # the columns and intensities of each array, and the keys of the arrays
+    self._rows = []
+    self._labels = []
+
+    # for each pair i, j: the number of common reflections and the sums of
+    # I_i, I_i^2 and I_i * I_j over them
+    self._n = numpy.zeros((0, 0))
+    self._sx = numpy.zeros((0, 0))
+    self._sxx = numpy.zeros((0, 0))
+    self._sxy = numpy.zeros((0, 0))
+
+    self._n_pending = 0
+
+    return
+
+  def _index_columns(self, indices):
+    '''Return the columns of the shared index space for the Miller indices,
+    adding any not seen before.'''
+
+    hkl = miller_index_array(indices)
+    n_known = len(self._hkl)
+
+    # group the indices seen before with these: each of the former is a
+    # group of its own, which keeps its column
+
+    unique_hkl, inverse = unique_miller_indices(
+      numpy.concatenate([self._hkl, hkl]))
+    known = inverse[:n_known]
+
+    if len(unique_hkl) > n_known:
+      new = numpy.ones(len(unique_hkl), dtype=bool)
+      new[known] = False
+      columns = numpy.empty(len(unique_hkl), dtype=numpy.int64)
+      columns[known] = self._columns
+      columns[new] = numpy.arange(n_known, len(unique_hkl), dtype=numpy.int64)
+      self._hkl = unique_hkl
+      self._columns = columns
+
+    return self._columns[inverse[n_known:]]
+
+  def add_dataset(self, label, merged_intensities):
+    '''Add a merged intensity array.'''
+
+    ma = merged_intensities.resolution_filter(d_min=self._d_min).map_to_asu()
+    columns = self._index_columns(ma.indices())
+    values = ma.data().as_numpy_array().astype(numpy.float64)
+    order = numpy.argsort(columns)
+    self._rows.append((columns[order], values[order]))
+    self._labels.append(label)
+    self._n_pending += 1
+
+    return
+
+  def _matrices(self, rows):
+    '''Return sparse matrices of the intensities, their squares and the
+    presence of the reflections for rows.'''
+
+    import scipy.sparse
+
+    shape = (len(rows), len(self._columns))
+    indptr = numpy.cumsum([0] + [len(c) for c, v in rows])
+    if rows:
+      columns = numpy.concatenate([c for c, v in rows])
+      values = numpy.concatenate([v for c, v in rows])
+    else:
+      columns = numpy.zeros(0, dtype=numpy.int64)
+      values = numpy.zeros(0)
+
+    x = scipy.sparse.csr_matrix((values, columns, indptr), shape=shape)
+    xx = scipy.sparse.csr_matrix((values * values, columns, indptr),
+                                 shape=shape)
+    m = scipy.sparse.csr_matrix((numpy.ones(len(values)), columns, indptr),
+                                shape=shape)
+    return x, xx, m
+
+  def _update(self):
+    '''Compute the rows and columns of the sums for the arrays added since
+    the last update.'''
+
+    n_old = len(self._rows) - self._n_pending
+    n_all = len(self._rows)
+
+    x_new, xx_new, m_new = self._matrices(self._rows[n_old:])
+    x_all, xx_all, m_all = self._matrices(self._rows)
+
+    sums = []
+    for matrix, rows, cols in ((self._n, m_new, m_all),
+                               (self._sx, x_new, m_all),
+                               (self._sxx, xx_new, m_all),
+                               (self._sxy, x_new, x_all)):
+      grown = numpy.zeros((n_all, n_all))
+      grown[:n_old,:n_old] = matrix
+      grown[n_old:,:] = (rows * cols.T).toarray()
+      sums.append(grown)
+
+    # the sums of I_i for an old array i over the reflections in common with
+    # a new array j are not the transpose of those already computed
+
+    self._n, self._sx, self._sxx, self._sxy = sums
+    self._n[:n_old,n_old:] = self._n[n_old:,:n_old].T
+    self._sxy[:n_old,n_old:] = self._sxy[n_old:,:n_old].T
+    self._sx[:n_old,n_old:] = (x_all[:n_old] * m_new.T).toarray()
+    self._sxx[:n_old,n_old:] = (xx_all[:n_old] * m_new.T).toarray()
+
+    self._n_pending = 0
+
+    return
+
+  def labels(self):
+    return list(self._labels)
+
+  def correlation_matrix(self):
+    '''Return the matrix of correlation coefficients as a numpy array, zero
+    where the correlation is not defined.'''
+
+    if self._n_pending:
+      self._update()
+
+    n = self._n
+    sx = self._sx
+    sy = sx.T
+    numerator = n * self._sxy - sx * sy
+    denominator = (n * self._sxx - sx * sx) * (n * self._sxx.T - sy * sy)
+
+    cc = numpy.zeros(n.shape)
+    defined = denominator > 0
+    cc[defined] = numerator[defined] / numpy.sqrt(denominator[defined])
+
+    # exactly symmetric, with unit diagonal, as expected of 1 - cc as a
+    # distance matrix
+    cc = numpy.triu(cc, 1) + numpy.triu(cc, 1).T
+    cc[numpy.diag_indices_from(cc)] = defined.diagonal()
+    return cc
+
+
 class multi_crystal_analysis(object):
 
   def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
@@ -125,6 +280,7 @@ def __init__(self, unmerged_intensities, batches_all, n_bins=20, d_min=None,
     self.batches = separate.batches
     run_id_to_batch_id = separate.run_id_to_batch_id
     self.individual_merged_intensities = OrderedDict()
+    self._correlation = None
     for k in self.intensities.keys():
       self.intensities[k] = self.intensities[k].resolution_filter(d_min=d_min)
       self.batches[k] = self.batches[k].resolution_filter(d_min=d_min)
@@ -203,19 +359,21 @@ def compute_correlation_coefficient_matrix(self):
     from scipy.cluster import hierarchy
     import scipy.spatial.distance as ssd
 
-    correlation_matrix = flex.double(
-      flex.grid(len(self.intensities), len(self.intensities)))
-
     d_min = min([ma.d_min() for ma in self.intensities.values()])
 
-    for i_wedge in self.individual_merged_intensities.keys():
-      for j_wedge in self.individual_merged_intensities.keys():
-        if j_wedge < i_wedge: continue
-        ma_i = self.individual_merged_intensities[i_wedge].resolution_filter(d_min=d_min)
-        ma_j = self.individual_merged_intensities[j_wedge].resolution_filter(d_min=d_min)
-        cc_ij = ma_i.correlation(ma_j).coefficient()
-        correlation_matrix[(i_wedge,j_wedge)] = cc_ij
-        correlation_matrix[j_wedge,i_wedge] = cc_ij
+    # the merged arrays are mapped into the engine once, and only those
+    # added since the matrix was last computed contribute new rows
+
+    if self._correlation is None:
+      self._correlation = pairwise_correlation(d_min=d_min)
+    known = set(self._correlation.labels())
+    for k, ma in self.individual_merged_intensities.iteritems():
+      if not k in known:
+        self._correlation.add_dataset(k, ma)
+
+    cc = self._correlation.correlation_matrix()
+    correlation_matrix = flex.double(cc.ravel().tolist())
+    correlation_matrix.reshape(flex.grid(cc.shape))
 
     diffraction_dissimilarity = 1-correlation_matrix
 
@@ -1,11 +1,15 @@
 from __future__ import absolute_import, division
 
-import math
 from collections import Mapping
+
+import numpy
 from cctbx.array_family import flex
 from iotbx.data_plots import table_data
 from libtbx import phil
 
+from xia2.Toolkit.MillerIndexGroups import miller_index_array, \
+  unique_miller_indices
+
 dose_phil_str = """\
 dose {
   remove_gaps = True
@@ -152,8 +156,73 @@ def __contains__(self, hkl):
     return hkl in self._observations
 
 
+def _observation_groups(intensities):
+  '''Return, for each observation, the unique reflection to which it belongs
+  (numbered from 0), whether it is an I- observation and whether the
+  reflection is centric - as unmerged_observations, for all observations at
+  once.'''
+
+  from cctbx import miller
+
+  sg_type = intensities.space_group().type()
+  anomalous_flag = intensities.anomalous_flag()
+
+  # the I- observations of acentric reflections are those which map to the
+  # asu only through the Friedel mate
+
+  indices = intensities.indices().deep_copy()
+  miller.map_to_asu(sg_type, anomalous_flag, indices)
+  asu_indices = intensities.indices().deep_copy()
+  miller.map_to_asu(sg_type, False, asu_indices)
+
+  centric = intensities.customized_copy(
+    indices=asu_indices).centric_flags().data().as_numpy_array()
+  hkl = miller_index_array(asu_indices)
+  minus = ~centric & (miller_index_array(indices) != hkl).any(axis=1)
+
+  unique_hkl, group = unique_miller_indices(hkl)
+
+  return group, minus, centric
+
+def _pair_sums(kind, values, doses, bins, size, n_steps, range_min,
+               range_width):
+  '''Return the sums of |I_i - I_j| and of 0.5 * |I_i + I_j| (kind 'rcp')
+  or 0.5 * (I_i + I_j) (kind 'rd') over all pairs i < j of the observations
+  in each row of values, as histograms of length size: for Rcp by the
+  resolution bin of the row and the dose step of the later observation (each
+  row sorted by dose), for Rd by the difference in dose.'''
+
+  i, j = numpy.triu_indices(values.shape[1], 1)
+  v_i = values[:,i]
+  v_j = values[:,j]
+
+  if kind == 'rcp':
+    index = bins[:,None] * n_steps + doses[:,j]
+    bottom = 0.5 * numpy.abs(v_i + v_j)
+
+  else:
+    # as int(round(x) / range_width), rounding halves away from zero
+    x = numpy.abs(doses[:,i] - doses[:,j]) - range_min
+    x = numpy.sign(x) * numpy.floor(numpy.abs(x) + 0.5)
+    index = numpy.trunc(x / range_width).astype(numpy.int64)
+    index = numpy.where(index < 0, index + n_steps, index)
+    if len(index) and (index.min() < 0 or index.max() >= n_steps):
+      raise IndexError('dose difference out of range')
+    bottom = 0.5 * (v_i + v_j)
+
+  top = numpy.abs(v_i - v_j)
+  index = index.ravel()
+  return (numpy.bincount(index, weights=top.ravel(), minlength=size),
+          numpy.bincount(index, weights=bottom.ravel(), minlength=size))
+
+
 class PyStatistics(object):
 
+  # the maximum number of pairs of observations for which differences are
+  # computed at once
+
+  _chunk_pairs = 1 << 20
+
   def __init__(self, intensities, dose, n_bins=8,
                range_min=None, range_max=None, range_width=1):
 
@@ -180,216 +249,204 @@ def __init__(self, intensities, dose, n_bins=8,
     self.binner = self.intensities.setup_binner_d_star_sq_step(
       d_star_sq_step=(flex.max(self.d_star_sq)-flex.min(self.d_star_sq)+1e-8)/self.n_bins)
 
-    self.observations = unmerged_observations(self.intensities)
+    # the observations as arrays: the unique reflection of each, whether it
+    # is I+ (or centric) or I-, and the resolution bin of each
+
+    self._group, self._minus, centric = _observation_groups(self.intensities)
+    self._n_groups = self._group.max() + 1 if len(self._group) else 0
+    self._centric = numpy.zeros(self._n_groups, dtype=bool)
+    self._centric[self._group] = centric
+    self._i_bin = self.binner.bin_indices().as_numpy_array().astype(
+      numpy.int64) - 1
+    self._dose = self.dose.as_double().as_numpy_array()
 
     self._calc_completeness_vs_dose()
     self._calc_rcp_scp()
     self._calc_rd()
 
-  def _calc_completeness_vs_dose(self):
-
-    iplus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    iminus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    ieither_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
-    iboth_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
+  def _first_bin(self, select):
+    '''Return the resolution bin of the first selected observation of each
+    unique reflection, or -1 if there is none.'''
 
-    for h_uniq, observed in self.observations:
-      #if observed.is_minus():
-        #continue
+    i_bin = numpy.full(self._n_groups, -1, dtype=numpy.int64)
+    groups, first = numpy.unique(
+      self._group[select], return_index=True)
+    i_bin[groups] = self._i_bin[select][first]
+    return i_bin
 
-      #irefs = list(observed.irefs)
-      dose_min_iplus = self.range_max + self.range_width
-      dose_min_iminus = self.range_max + self.range_width
+  def _rows(self, subgroup):
+    '''Yield the observations of the subgroups with more than one member in
+    chunks of rows of equal length, as matrices of indices into
+    subgroup (which is sorted).'''
 
-      if observed.iplus.size():
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
-      else:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
+    counts = numpy.bincount(subgroup)
+    starts = numpy.cumsum(counts) - counts
 
-      if i_bin < 0:
+    for n in numpy.unique(counts):
+      if n < 2:
         continue
+      rows = starts[counts == n]
+      chunk = max(1, self._chunk_pairs // (n * (n - 1) // 2))
+      for k in range(0, len(rows), chunk):
+        yield rows[k:k + chunk,None] + numpy.arange(n)
 
-      for i, i_ref in enumerate(observed.iplus):
-        dose_i = self.dose[i_ref]
-        dose_min_iplus = min(dose_i, dose_min_iplus)
-        if observed.is_centric():
-          dose_min_iminus = min(dose_i, dose_min_iminus)
-
-      for i, i_ref in enumerate(observed.iminus):
-        assert i_ref not in observed.iplus
-        dose_i = self.dose[i_ref]
-        dose_min_iminus = min(dose_i, dose_min_iminus)
-
-      start_iplus = int((dose_min_iplus - self.range_min)/self.range_width)
-      start_iminus = int((dose_min_iminus - self.range_min)/self.range_width)
-
-      if start_iplus < self.n_steps:
-        iplus_count[i_bin][start_iplus] += 1
-      if start_iminus < self.n_steps:
-        iminus_count[i_bin][start_iminus] += 1
-      if min(start_iplus, start_iminus) < self.n_steps:
-        ieither_count[i_bin][min(start_iplus, start_iminus)] += 1
-      if max(start_iplus, start_iminus) < self.n_steps:
-        iboth_count[i_bin][max(start_iplus, start_iminus)] += 1
-
-    # now accumulate as a function of time
+  def _calc_completeness_vs_dose(self):
 
-    for i_bin in xrange(self.n_bins):
-      for j in range(1, self.n_steps):
-        iplus_count[i_bin][j] += iplus_count[i_bin][j - 1]
-        iminus_count[i_bin][j] += iminus_count[i_bin][j - 1]
-        ieither_count[i_bin][j] += ieither_count[i_bin][j - 1]
-        iboth_count[i_bin][j] += iboth_count[i_bin][j - 1]
+    n_steps = self.n_steps
+    plus = ~self._minus
+    dose_max = self.range_max + self.range_width
+
+    # the first dose at which each reflection was observed, as I+ and I-
+
+    dose_min_iplus = numpy.full(self._n_groups, dose_max, dtype=numpy.float64)
+    dose_min_iminus = numpy.full(self._n_groups, dose_max, dtype=numpy.float64)
+    numpy.minimum.at(dose_min_iplus, self._group[plus], self._dose[plus])
+    numpy.minimum.at(dose_min_iminus, self._group[self._minus],
+                     self._dose[self._minus])
+    centric = plus & self._centric[self._group]
+    numpy.minimum.at(dose_min_iminus, self._group[centric],
+                     self._dose[centric])
+
+    i_bin = self._first_bin(plus)
+    i_bin = numpy.where(i_bin < 0, self._first_bin(self._minus), i_bin)
+
+    start_iplus = numpy.trunc(
+      (dose_min_iplus - self.range_min) / self.range_width).astype(numpy.int64)
+    start_iminus = numpy.trunc(
+      (dose_min_iminus - self.range_min) / self.range_width).astype(numpy.int64)
+
+    def count(start):
+      # the cumulative number of reflections first observed by each dose
+      sel = (i_bin >= 0) & (start < n_steps)
+      counts = numpy.bincount(i_bin[sel] * n_steps + start[sel],
+                              minlength=self.n_bins * n_steps)
+      return numpy.cumsum(
+        counts.reshape(self.n_bins, n_steps), axis=1).astype(numpy.float64)
+
+    counts = [count(start_iplus), count(start_iminus),
+              count(numpy.minimum(start_iplus, start_iminus)),
+              count(numpy.maximum(start_iplus, start_iminus))]
 
     # accumulate as a function of dose and resolution
 
-    iplus_comp_overall = flex.double(self.n_steps, 0)
-    iminus_comp_overall = flex.double(self.n_steps, 0)
-    ieither_comp_overall = flex.double(self.n_steps, 0)
-    iboth_comp_overall = flex.double(self.n_steps, 0)
-
     binner_non_anom = self.intensities.as_non_anomalous_array().use_binning(
       self.binner)
-    n_complete = binner_non_anom.counts_complete()[1:-1]
-
-    for i_bin in xrange(self.n_bins):
-      iplus_comp_overall += iplus_count[i_bin]
-      iminus_comp_overall += iminus_count[i_bin]
-      ieither_comp_overall += ieither_count[i_bin]
-      iboth_comp_overall += iboth_count[i_bin]
-
-      iplus_count[i_bin] /= n_complete[i_bin]
-      iminus_count[i_bin] /= n_complete[i_bin]
-      ieither_count[i_bin] /= n_complete[i_bin]
-      iboth_count[i_bin] /= n_complete[i_bin]
-
-    tot_n_complete = sum(n_complete)
-    iplus_comp_overall /= tot_n_complete
-    iminus_comp_overall /= tot_n_complete
-    ieither_comp_overall /= tot_n_complete
-    iboth_comp_overall /= tot_n_complete
-
-    self.iplus_comp_bins = iplus_count
-    self.iminus_comp_bins = iminus_count
-    self.ieither_comp_bins = ieither_count
-    self.iboth_comp_bins = iboth_count
-    self.iplus_comp_overall = iplus_comp_overall
-    self.iminus_comp_overall = iminus_comp_overall
-    self.ieither_comp_overall = ieither_comp_overall
-    self.iboth_comp_overall = iboth_comp_overall
+    n_complete = numpy.array(binner_non_anom.counts_complete()[1:-1],
+                             dtype=numpy.float64)
+
+    comp_bins = [[flex.double(c / n_complete[i_bin])
+                  for i_bin, c in enumerate(counts_i)]
+                 for counts_i in counts]
+    comp_overall = [flex.double(counts_i.sum(axis=0) / n_complete.sum())
+                    for counts_i in counts]
+
+    self.iplus_comp_bins, self.iminus_comp_bins, self.ieither_comp_bins, \
+      self.iboth_comp_bins = comp_bins
+    self.iplus_comp_overall, self.iminus_comp_overall, \
+      self.ieither_comp_overall, self.iboth_comp_overall = comp_overall
 
   def _calc_rcp_scp(self):
 
-    A = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    B = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    isigma = [[0] * self.n_steps for i in xrange(self.n_bins)]
-    count = [[0] * self.n_steps for i in xrange(self.n_bins)]
-
-    intensities_data = self.intensities.data()
-    sigmas = self.intensities.sigmas()
-
-    def accumulate(irefs, i_bin):
-      if i_bin < 0:
-        return
-      for i, i_ref in enumerate(irefs):
-        dose_i = self.dose[i_ref]
-        I_i = intensities_data[i_ref]
-        sigi_i = sigmas[i_ref]
-        for j, j_ref in enumerate(irefs[i+1:]):
-          I_j = intensities_data[j_ref]
-          sigi_j = sigmas[j_ref]
-          A_part = math.fabs(I_i - I_j)
-          B_part = 0.5 * math.fabs(I_i + I_j)
-          dose_j = self.dose[j_ref]
-          dose_0 = int((max(dose_i, dose_j) - self.range_min)/self.range_width)
-          A[i_bin][dose_0] += A_part
-          B[i_bin][dose_0] += B_part
-          isigma[i_bin][dose_0] += ((I_i/sigi_i) + (I_j/sigi_j))
-          count[i_bin][dose_0] += 2
-
-    for h_uniq, observed in self.observations:
-      if len(observed.iplus) > 1:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
-        accumulate(list(observed.iplus), i_bin)
-      if len(observed.iminus) > 1:
-        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
-        accumulate(list(observed.iminus), i_bin)
+    n_steps = self.n_steps
+    size = self.n_bins * n_steps
+
+    intensities_data = self.intensities.data().as_numpy_array()
+    sigmas = self.intensities.sigmas().as_numpy_array()
+    step = numpy.trunc(
+      (self._dose - self.range_min) / self.range_width).astype(numpy.int64)
+
+    # I+ and I- observations of each reflection, in order of dose
+
+    subgroup = self._group * 2 + self._minus
+    order = numpy.lexsort((self._dose, subgroup))
+    subgroup = subgroup[order]
+    n_subgroups = subgroup.max() + 1 if len(subgroup) else 0
+    i_bin = numpy.full(n_subgroups, -1, dtype=numpy.int64)
+    present = numpy.unique(subgroup)
+    i_bin[present] = self._i_bin[
+      numpy.minimum.reduceat(order, numpy.searchsorted(subgroup, present))]
+
+    # the sums of I/sigI and the counts over pairs, from cumulative sums: an
+    # observation pairs with every earlier observation of its subgroup, at
+    # the dose step of the later of the two
+
+    counts = numpy.bincount(subgroup, minlength=n_subgroups)
+    starts = numpy.cumsum(counts) - counts
+    rank = numpy.arange(len(order)) - starts[subgroup]
+    isig = intensities_data[order] / sigmas[order]
+    before = numpy.cumsum(isig) - isig
+    before -= before[starts[subgroup]]
+
+    index = i_bin[subgroup] * n_steps + step[order]
+    sel = (i_bin[subgroup] >= 0) & (rank > 0)
+    isigma = numpy.bincount(index[sel], weights=(rank * isig + before)[sel],
+                            minlength=size)
+    count = numpy.bincount(index[sel], weights=2 * rank[sel], minlength=size)
+
+    # the sums of differences over pairs
+
+    valid = i_bin >= 0
+    A = numpy.zeros(size)
+    B = numpy.zeros(size)
+    for rows in self._rows(subgroup):
+      rows = rows[valid[subgroup[rows[:,0]]]]
+      if not len(rows):
+        continue
+      top, bottom = _pair_sums(
+        'rcp', intensities_data[order[rows]], step[order[rows]],
+        i_bin[subgroup[rows[:,0]]], size, n_steps,
+        self.range_min, self.range_width)
+      A += top
+      B += bottom
 
     # now accumulate as a function of time
 
-    for i_bin in xrange(self.n_bins):
-      for j in xrange(1, self.n_steps):
-        A[i_bin][j] += A[i_bin][j-1]
-        B[i_bin][j] += B[i_bin][j-1]
-        isigma[i_bin][j] += isigma[i_bin][j-1]
-        count[i_bin][j] += count[i_bin][j-1]
+    A = numpy.cumsum(A.reshape(self.n_bins, n_steps), axis=1)
+    B = numpy.cumsum(B.reshape(self.n_bins, n_steps), axis=1)
+    isigma = numpy.cumsum(isigma.reshape(self.n_bins, n_steps), axis=1)
+    count = numpy.cumsum(count.reshape(self.n_bins, n_steps), axis=1)
 
     # accumulate as a function of dose and resolution
 
-    rcp_overall = flex.double(self.n_steps, 0)
-    rcp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
-    scp_overall = flex.double(self.n_steps, 0)
-    scp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
+    rcp = numpy.zeros(A.shape)
+    scp = numpy.zeros(A.shape)
+    sel = B > 0
+    rcp[sel] = A[sel] / B[sel]
+    sel &= count > 100
+    scp[sel] = rcp[sel] / (1.1284 / (isigma[sel] / count[sel]))
 
-    for j in xrange(self.n_steps):
+    ot = A.sum(axis=0)
+    ob = B.sum(axis=0)
+    rcp_overall = numpy.zeros(n_steps)
+    rcp_overall[ob > 0] = ot[ob > 0] / ob[ob > 0]
 
-      for i_bin in xrange(self.n_bins):
-        top = A[i_bin][j]
-        bottom = B[i_bin][j]
+    self.rcp_bins = [flex.double(r) for r in rcp]
+    self.rcp = flex.double(rcp_overall)
+    self.scp_bins = [flex.double(s) for s in scp]
+    self.scp = flex.double(scp.sum(axis=0) / self.n_bins)
 
-        rcp = 0.0
-        scp = 0.
-
-        if bottom > 0:
-          rcp = top/bottom
-          if count[i_bin][j] > 100:
-            isig = isigma[i_bin][j] / count[i_bin][j]
-            scp = rcp / (1.1284 / isig)
-
-          rcp_bins[i_bin][j] = rcp
-          scp_bins[i_bin][j] = scp
-
-      ot = sum(A[i_bin][j] for i_bin in xrange(self.n_bins))
-      ob = sum(B[i_bin][j] for i_bin in xrange(self.n_bins))
-
-      if ob > 0:
-        overall = ot/ob
-      else:
-        overall = 0.
-      rcp_overall[j] = overall
-
-      scp_overall[j] = sum(scp_bins[i_bin][j] for i_bin in xrange(self.n_bins))/self.n_bins
+  def _calc_rd(self):
 
-    self.rcp_bins = rcp_bins
-    self.rcp = rcp_overall
-    self.scp_bins = scp_bins
-    self.scp = scp_overall
+    intensities_data = self.intensities.data().as_numpy_array()
 
-  def _calc_rd(self):
+    # all observations of each reflection, I+ and I- together
 
-    rd_top = [0] * self.n_steps
-    rd_bottom = [0] * self.n_steps
+    order = numpy.argsort(self._group, kind='mergesort')
+    group = self._group[order]
 
-    intensities_data = self.intensities.data()
+    rd_top = numpy.zeros(self.n_steps)
+    rd_bottom = numpy.zeros(self.n_steps)
+    for rows in self._rows(group):
+      top, bottom = _pair_sums(
+        'rd', intensities_data[order[rows]], self._dose[order[rows]], None,
+        self.n_steps, self.n_steps, self.range_min, self.range_width)
+      rd_top += top
+      rd_bottom += bottom
 
-    for h_uniq, observed in self.observations:
-      irefs = list(observed.iplus) + list(observed.iminus)
-      if len(irefs) == 1:
-        # lone observation, no pairs
-        continue
-      for i, i_ref in enumerate(irefs):
-        dose_i = self.dose[i_ref]
-        I_i = intensities_data[i_ref]
-        for j, j_ref in enumerate(irefs[i+1:]):
-          I_j = intensities_data[j_ref]
-          dose_j = self.dose[j_ref]
-          d_dose = int(
-            round(math.fabs(dose_i - dose_j) - self.range_min)/self.range_width)
-          rd_top[d_dose] += math.fabs(I_i - I_j)
-          rd_bottom[d_dose] += 0.5 * (I_i + I_j)
-
-    self.rd = flex.double(rd_top[i]/rd_bottom[i] if rd_bottom[i] > 0 else 0
-                          for i in xrange(self.n_steps))
+    rd = numpy.zeros(self.n_steps)
+    sel = rd_bottom > 0
+    rd[sel] = rd_top[sel] / rd_bottom[sel]
+    self.rd = flex.double(rd)
 
   def print_completeness_vs_dose(self):
 
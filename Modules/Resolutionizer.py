@@ -283,64 +283,94 @@ def savefig(self, filename):
     self.fig.savefig(filename)
 
 
+def read_unmerged_intensities(scaled_unmerged, hkl_in=None,
+                              miller_arrays=None):
+  '''Read the unmerged intensities and batches from a scaled unmerged
+  reflection file (or the reflection file and its miller arrays, if already
+  read). Returns the intensities as read, the same intensities with the
+  original Miller indices (where available) and the batches.'''
+
+  from iotbx import reflection_file_reader
+  from libtbx.utils import Sorry
+  if hkl_in is None:
+    hkl_in = reflection_file_reader.any_reflection_file(scaled_unmerged)
+  if miller_arrays is None:
+    miller_arrays = hkl_in.as_miller_arrays(merge_equivalents=False)
+  i_obs = None
+  batches = None
+  all_i_obs = []
+  for array in miller_arrays :
+    labels = array.info().label_string()
+    if (array.is_xray_intensity_array()) :
+      all_i_obs.append(array)
+    if (labels == 'BATCH'):
+      assert batches is None
+      batches = array
+  if (i_obs is None) :
+    if (len(all_i_obs) == 0) :
+      raise Sorry("No intensities found in %s." % scaled_unmerged)
+    elif (len(all_i_obs) > 1) :
+      raise Sorry("Multiple intensity arrays - please specify one:\n%s" %
+        "\n".join(["  labels=%s"%a.info().label_string() for a in all_i_obs]))
+    else :
+      i_obs = all_i_obs[0]
+  i_obs_original = i_obs
+  if hkl_in.file_type() == 'ccp4_mtz':
+    # need original miller indices otherwise we don't get correct anomalous
+    # merging statistics
+    mtz_object = hkl_in.file_content()
+    if "M_ISYM" in mtz_object.column_labels():
+      indices = mtz_object.extract_original_index_miller_indices()
+      i_obs_original = i_obs.customized_copy(
+        indices=indices, info=i_obs.info())
+
+  return i_obs, i_obs_original, batches
+
+def select_batch_range(i_obs, batches, batch_range):
+  '''Select the observations with batch_min <= batch <= batch_max.'''
+
+  batch_min, batch_max = batch_range
+  assert batches is not None
+  sel = (batches.data() >= batch_min) & (batches.data() <= batch_max)
+  return i_obs.select(sel).set_info(i_obs.info())
+
+def compute_merging_statistics(i_obs, params):
+  '''Compute the binned merging statistics used for the resolution
+  estimates, for observations already restricted to any batch range.'''
+
+  import iotbx.merging_statistics
+
+  i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+
+  return iotbx.merging_statistics.dataset_statistics(
+    i_obs=i_obs,
+    n_bins=params.nbins,
+    cc_one_half_significance_level=params.cc_half_significance_level,
+    cc_one_half_method=params.cc_half_method,
+    binning_method=params.binning_method,
+    anomalous=params.anomalous,
+    use_internal_variance=False,
+    eliminate_sys_absent=False,
+    assert_is_not_unique_set_under_symmetry=False,
+  )
+
+
 class resolutionizer(object):
   '''A class to calculate things from merging reflections.'''
 
-  def __init__(self, scaled_unmerged, params):
+  def __init__(self, scaled_unmerged, params, merging_statistics=None):
 
     self._params = params
 
-    import iotbx.merging_statistics
+    if merging_statistics is None:
+      i_obs_asu, i_obs, batches = read_unmerged_intensities(scaled_unmerged)
 
-    from iotbx import reflection_file_reader
-    hkl_in = reflection_file_reader.any_reflection_file(scaled_unmerged)
-    miller_arrays = hkl_in.as_miller_arrays(merge_equivalents=False)
-    i_obs = None
-    batches = None
-    all_i_obs = []
-    for array in miller_arrays :
-      labels = array.info().label_string()
-      if (array.is_xray_intensity_array()) :
-        all_i_obs.append(array)
-      if (labels == 'BATCH'):
-        assert batches is None
-        batches = array
-    if (i_obs is None) :
-      if (len(all_i_obs) == 0) :
-        raise Sorry("No intensities found in %s." % file_name)
-      elif (len(all_i_obs) > 1) :
-        raise Sorry("Multiple intensity arrays - please specify one:\n%s" %
-          "\n".join(["  labels=%s"%a.info().label_string() for a in all_i_obs]))
-      else :
-        i_obs = all_i_obs[0]
-    if hkl_in.file_type() == 'ccp4_mtz':
-      # need original miller indices otherwise we don't get correct anomalous
-      # merging statistics
-      mtz_object = hkl_in.file_content()
-      if "M_ISYM" in mtz_object.column_labels():
-        indices = mtz_object.extract_original_index_miller_indices()
-        i_obs = i_obs.customized_copy(indices=indices, info=i_obs.info())
-
-    i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
-
-    if self._params.batch_range is not None:
-      batch_min, batch_max = self._params.batch_range
-      assert batches is not None
-      sel = (batches.data() >= batch_min) & (batches.data() <= batch_max)
-      batches = batches.select(sel).set_info(batches.info())
-      i_obs = i_obs.select(sel).set_info(i_obs.info())
-
-    self._merging_statistics = iotbx.merging_statistics.dataset_statistics(
-      i_obs=i_obs,
-      n_bins=self._params.nbins,
-      cc_one_half_significance_level=self._params.cc_half_significance_level,
-      cc_one_half_method=self._params.cc_half_method,
-      binning_method=self._params.binning_method,
-      anomalous=params.anomalous,
-      use_internal_variance=False,
-      eliminate_sys_absent=False,
-      assert_is_not_unique_set_under_symmetry=False,
-    )
+      if self._params.batch_range is not None:
+        i_obs = select_batch_range(i_obs, batches, self._params.batch_range)
+
+      merging_statistics = compute_merging_statistics(i_obs, params)
+
+    self._merging_statistics = merging_statistics
 
     return
 
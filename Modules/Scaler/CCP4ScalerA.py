@@ -949,6 +949,7 @@ def _scale(self):
 
     highest_resolution = 100.0
     highest_suggested_resolution = None
+    analysed = set()
 
     # check in here that there is actually some data to scale..!
 
@@ -978,6 +979,7 @@ def _scale(self):
       hklin = sc.get_unmerged_reflection_file()
       limit, reasoning = self._estimate_resolution_limit(
         hklin, batch_range=(start, end))
+      analysed.add(hklin)
 
       if PhilIndex.params.xia2.settings.resolution.keep_all_reflections == True:
         suggested = limit
@@ -1007,6 +1009,9 @@ def _scale(self):
         Chatter.write('Resolution limit for %s/%s: %5.2f (%5.2f suggested)' % \
                       (dname, sname, limit, suggested))
 
+    for hklin in analysed:
+      self._evict_statistics_session(hklin)
+
     if highest_suggested_resolution is not None and \
         highest_resolution >= (highest_suggested_resolution - 0.004):
       Debug.write('Dropping resolution cut-off suggestion since it is'
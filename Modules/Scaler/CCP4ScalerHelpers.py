@@ -17,6 +17,7 @@
 import os
 import sys
 import math
+import numpy
 from iotbx import mtz
 
 from xia2.Wrappers.CCP4.Mtzdump import Mtzdump
@@ -113,14 +114,26 @@ def ersatz_resolution(reflection_file, batch_ranges):
   ipr_values = ipr_column.extract_values()
   sigipr_values = sigipr_column.extract_values()
   batch_values = batch_column.extract_values()
-  batches = batch_values.as_double().iround()
+
+  # the resolution bins and I/sigma are computed once for all observations,
+  # which are then sorted by batch so that each batch range is a contiguous
+  # segment
+
+  batches = batch_values.as_double().iround().as_numpy_array()
+  bins = _resolution_bins(dmax, dmin, uc.d(miller).as_numpy_array())
+  isig = (ipr_values / sigipr_values).as_double().as_numpy_array()
+
+  order = numpy.argsort(batches, kind='mergesort')
+  batches = batches[order]
+  bins = bins[order]
+  isig = isig[order]
+
   resolutions = { }
 
   for start, end in batch_ranges:
-    sel = (batches >= start) & (batches <= end)
-    d = uc.d(miller.select(sel))
-    isig = ipr_values.select(sel) / sigipr_values.select(sel)
-    resolutions[(start, end)] = compute_resolution(dmax, dmin, d, isig)
+    first, last = numpy.searchsorted(batches, [start, end + 1])
+    resolutions[(start, end)] = _binned_resolution(
+      dmax, dmin, bins[first:last], isig[first:last])
 
   return resolutions
 
@@ -129,51 +142,55 @@ def meansd(values):
   var = sum([(v - mean) * (v - mean) for v in values]) / len(values)
   return mean, math.sqrt(var)
 
-def compute_resolution(dmax, dmin, d, isig):
-  # XXX As far as I can tell this function doesn't do anything useful as it
-  # just returns the unmodified dmin that was passed as input! Please refer
-  # to return 1.0 / math.sqrt(s) below & remove comment when you are happy...
-  if False:
-    return dmin
-
-  bins = { }
+def _resolution_bins(dmax, dmin, d):
+  '''Return the bins in 1/d^2 (100 between dmax and dmin) of the
+  reflections with resolutions d, as nint() of each.'''
 
   smax = 1.0 / (dmax * dmax)
   smin = 1.0 / (dmin * dmin)
 
-  for j in range(len(d)):
-    s = 1.0 / (d[j] * d[j])
-    n = nint(100.0 * (s - smax) / (smin - smax))
-    if not n in bins:
-      bins[n] = []
-    bins[n].append(isig[j])
+  a = 100.0 * (1.0 / (d * d) - smax) / (smin - smax)
+  n = (numpy.sign(a) * numpy.floor(numpy.abs(a) + 0.5)).astype(numpy.int64)
+  return numpy.where(a > 0, numpy.maximum(n, 1), n)
 
-  # compute starting point i.e. maximum point on the curve, to cope with
-  # cases where low resolution has low I / sigma - see #1690.
+def _binned_resolution(dmax, dmin, bins, isig):
+  '''Return the resolution at which the mean I/sigma in resolution bins
+  falls below 1, starting from the bin with the largest mean I/sigma (to
+  cope with cases where low resolution has low I / sigma - see #1690),
+  or dmin if it does not.'''
 
-  max_misig = 0.0
-  max_bin = 0
+  if not len(bins):
+    return dmin
 
-  for b in sorted(bins):
-    s = smax + b * (smin - smax) / 100.0
-    misig = meansd(bins[b])[0]
+  smax = 1.0 / (dmax * dmax)
+  smin = 1.0 / (dmin * dmin)
 
-    if misig > max_misig:
-      max_misig = misig
-      max_bin = b
+  offset = bins.min()
+  counts = numpy.bincount(bins - offset)
+  sums = numpy.bincount(bins - offset, weights=isig)
+  present = numpy.nonzero(counts)[0]
+  misig = sums[present] / counts[present]
 
-  for b in sorted(bins):
+  # the first bin with the largest mean I/sigma, if greater than zero
 
-    if b < max_bin:
-      continue
+  if misig.max() > 0.0:
+    start = numpy.argmax(misig)
+  else:
+    start = numpy.searchsorted(present + offset, 0)
 
+  below = numpy.nonzero(misig[start:] < 1.0)[0]
+  if len(below):
+    b = present[start + below[0]] + offset
     s = smax + b * (smin - smax) / 100.0
-    misig = meansd(bins[b])[0]
-    if misig < 1.0:
-      return 1.0 / math.sqrt(s)
+    return 1.0 / math.sqrt(s)
 
   return dmin
 
+def compute_resolution(dmax, dmin, d, isig):
+  return _binned_resolution(
+    dmax, dmin, _resolution_bins(dmax, dmin, numpy.asarray(d)),
+    numpy.asarray(isig))
+
 def _prepare_pointless_hklin(working_directory,
                              hklin,
                              phi_width):
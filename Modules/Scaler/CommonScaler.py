@@ -22,12 +22,37 @@
 
 from xia2.Handlers.Files import FileHandler
 
-# new resolution limit code
-from xia2.Wrappers.XIA.Merger import Merger
-
 def clean_reindex_operator(reindex_operator):
   return reindex_operator.replace('[', '').replace(']', '')
 
+def compute_anomalous_signals(reflection_files):
+  '''Return the anomalous signals (dF/F, dI/s(dI)) of the reflection files,
+  as a dictionary of (file, signals) by wavelength, with None for the
+  signals of a centric space group.'''
+
+  signals = { }
+  for key in reflection_files:
+    f = reflection_files[key]
+    if mtz.object(f).space_group().is_centric():
+      signals[key] = (f, None)
+    else:
+      signals[key] = (f, anomalous_signals(f))
+  return signals
+
+def compute_twinning_score(hklin):
+  '''Return the E4 twinning score of a merged reflection file, or None if
+  the space group is centric.'''
+
+  # FIXME in here should be able to just drop down to the lowest symmetry
+  # space group with the rotational elements for this calculation? I.e.
+  # P422 for P4/mmm?
+  if mtz.object(hklin).space_group().is_centric():
+    return None
+
+  from xia2.Toolkit.E4 import E4_mtz
+  E4s = E4_mtz(hklin, native = True)
+  return E4s.items()[0][1]
+
 class CommonScaler(Scaler):
   '''Unified bits which the scalers have in common over the interface.'''
 
@@ -537,15 +562,34 @@ def _sort_together_data_xds_one_sweep(self):
 
   def _scale_finish(self):
 
-    # compute anomalous signals if anomalous
+    if not self._scalr_scaled_refl_files:
+      raise RuntimeError, 'no reflection files stored'
+
+    pool = self._scale_finish_pool()
+    try:
+      self._scale_finish_steps(pool)
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+  def _scale_finish_steps(self, pool):
+
+    # the finishing steps form a small graph: the analyses which only read
+    # the scaled reflection files run in the background while the merged
+    # reflection file which later steps depend on is made
+
+    anomalous = None
+
+    # compute anomalous signals if anomalous, from the reflection files as
+    # they are before truncation
+
     if self.get_scaler_anomalous():
-      self._scale_finish_chunk_1_compute_anomalous()
+      anomalous = self._scale_finish_analyse(
+        pool, compute_anomalous_signals, dict(self._scalr_scaled_refl_files))
 
     # next transform to F's from I's etc.
 
-    if not self._scalr_scaled_refl_files:
-      raise RuntimeError, 'no reflection files stored'
-
     # run xia2.report on each unmerged mtz file
     #self._scale_finish_chunk_2_report()
 
@@ -557,45 +601,130 @@ def _scale_finish(self):
     if PhilIndex.params.xia2.settings.small_molecule == True:
       self._scale_finish_chunk_5_finish_small_molecule()
       self._scale_finish_export_shelxt()
+      signals, = self._scale_finish_wait([anomalous])
+      self._scale_finish_chunk_1_record_anomalous(signals)
 
       return
 
     # finally add a FreeR column, and record the new merged reflection
-    # file with the free column added.
+    # file with the free column added - then add xia2 version to the
+    # history of this and the unmerged reflection files
 
     self._scale_finish_chunk_6_add_free_r()
+    self._scale_finish_add_history(
+      [self._scalr_scaled_reflection_files['mtz']])
 
-    self._scale_finish_chunk_7_twinning()
+    twinning = self._scale_finish_analyse(
+      pool, compute_twinning_score,
+      self._scalr_scaled_reflection_files['mtz'])
 
     # next have a look for radiation damage... if more than one wavelength
 
+    raddam = None
     if len(self._scalr_scaled_refl_files.keys()) > 1:
-      self._scale_finish_chunk_8_raddam()
+      raddam = self._scale_finish_start('_scale_finish_chunk_8_raddam')
 
-    # finally add xia2 version to mtz history
-    from iotbx.reflection_file_reader import any_reflection_file
+    self._scale_finish_add_history(
+      self._scalr_scaled_reflection_files['mtz_unmerged'].values())
+
+    signals, twinning_score, status = self._scale_finish_wait(
+      [anomalous, twinning, raddam])
+    self._scale_finish_chunk_1_record_anomalous(signals)
+    self._scale_finish_chunk_7_record_twinning(twinning_score)
+
+    Chatter.write('Overall twinning score: %4.2f' % self._scalr_twinning_score)
+    Chatter.write(self._scalr_twinning_conclusion)
+
+    if raddam is not None:
+      if status:
+        Chatter.write('')
+        Chatter.banner('Local Scaling %s' % self._scalr_xname)
+        for s in status:
+          Chatter.write('%s %s' % s)
+        Chatter.banner('')
+      else:
+        Debug.write('Local scaling failed')
+
+  def _scale_finish_pool(self):
+    '''Return a pool of processes for the finishing analyses if more than
+    one job is allowed, unless this is itself a pool worker (which may not
+    have children).'''
+
+    import multiprocessing
+
+    if PhilIndex.params.xia2.settings.multiprocessing.njob > 1 and \
+       not multiprocessing.current_process().daemon:
+      return multiprocessing.Pool(2)
+    return None
+
+  def _scale_finish_analyse(self, pool, function, *arguments):
+    '''Start one of the analyses of the reflection files which are computed
+    in python - in the pool of processes if there is one, since a thread
+    would hold the interpreter lock throughout, else now.'''
+
+    if pool is not None:
+      return pool.apply_async(function, arguments)
+    return (function(*arguments), )
+
+  def _scale_finish_start(self, method, arguments=None):
+    '''Start one of the finishing steps which runs an external program and
+    does not write anything needed by the steps which follow it - in a
+    background thread (which only waits for the program) if more than one
+    job is allowed, else now.'''
+
+    if PhilIndex.params.xia2.settings.multiprocessing.njob > 1:
+      from xia2.Background.Background import Background
+      task = Background(self, method, arguments)
+      task.start()
+      return task
+
+    if arguments:
+      return (getattr(self, method)(arguments), )
+    return (getattr(self, method)(), )
+
+  def _scale_finish_wait(self, tasks):
+    '''Wait for the finishing steps started with _scale_finish_start or
+    _scale_finish_analyse, returning their results.'''
+
+    from multiprocessing.pool import ApplyResult
+
+    results = []
+    for task in tasks:
+      if task is None:
+        results.append(None)
+      elif isinstance(task, tuple):
+        results.append(task[0])
+      elif isinstance(task, ApplyResult):
+        results.append(task.get())
+      else:
+        results.append(task.stop())
+
+    return results
+
+  def _scale_finish_add_history(self, mtz_files):
+    '''Add the xia2 version to the history of the reflection files, by
+    rewriting only the headers.'''
+
+    from xia2.Modules.MergingStatistics import touch_statistics_session
+    from xia2.Modules.Scaler.tools import add_mtz_history
     from xia2.XIA2Version import Version
     import time
-    mtz_files = [self._scalr_scaled_reflection_files['mtz']]
-    mtz_files.extend(
-      self._scalr_scaled_reflection_files['mtz_unmerged'].values())
+
+    date_str = time.strftime('%d/%m/%Y at %H:%M:%S', time.gmtime())
+
     for mtz_file in mtz_files:
-      reader = any_reflection_file(mtz_file)
-      mtz_object = reader.file_content()
-      date_str = time.strftime('%d/%m/%Y at %H:%M:%S', time.gmtime())
-      mtz_object.add_history(
-        'From %s, run on %s' %(Version, date_str))
-      mtz_object.write(mtz_file)
-
-  def _scale_finish_chunk_1_compute_anomalous(self):
-    for key in self._scalr_scaled_refl_files:
-      f = self._scalr_scaled_refl_files[key]
-      m = mtz.object(f)
-      if m.space_group().is_centric():
+      add_mtz_history(mtz_file, ['From %s, run on %s' %(Version, date_str)])
+      touch_statistics_session(mtz_file)
+
+  def _scale_finish_chunk_1_record_anomalous(self, signals):
+    if signals is None:
+      return
+    for key in signals:
+      f, a_s = signals[key]
+      if a_s is None:
         Debug.write('Spacegroup is centric: %s' % f)
         continue
-      Debug.write('Running anomalous signal analysis on %s' % f)
-      a_s = anomalous_signals(f)
+      Debug.write('Anomalous signal analysis of %s' % f)
       self._scalr_statistics[
         (self._scalr_pname, self._scalr_xname, key)
         ]['dF/F'] = [a_s[0]]
@@ -743,7 +872,6 @@ def _scale_finish_export_shelxt(self):
     '''Read hklin (unmerged reflection file) and generate SHELXT input file
     and HKL file'''
 
-    from iotbx.reflection_file_reader import any_reflection_file
     from iotbx.shelx import writer
     from iotbx.shelx.hklf import miller_array_export_as_shelx_hklf
     from cctbx.xray.structure import structure
@@ -756,13 +884,13 @@ def _scale_finish_export_shelxt(self):
       prefixpath = os.path.join(self.get_working_directory(), prefix)
 
       mtz_unmerged = self._scalr_scaled_reflection_files['mtz_unmerged'][wavelength_name]
-      reader = any_reflection_file(mtz_unmerged)
-      intensities = [ma for ma in reader.as_miller_arrays(merge_equivalents=False)
+      session = self._get_statistics_session(mtz_unmerged)
+      intensities = [ma for ma in session.get_miller_arrays()
                      if ma.info().labels == ['I', 'SIGI']][0]
 
       # FIXME do I need to reindex to a conventional setting here
 
-      indices = reader.file_content().extract_original_index_miller_indices()
+      indices = session.get_original_indices()
       intensities = intensities.customized_copy(indices=indices, info=intensities.info())
 
       with open('%s.hkl' % prefixpath, 'wb') as hkl_file_handle:
@@ -904,17 +1032,9 @@ def _scale_finish_chunk_6_add_free_r(self):
     # record this for future reference
     FileHandler.record_data_file(hklout)
 
-  def _scale_finish_chunk_7_twinning(self):
-    hklout = self._scalr_scaled_reflection_files['mtz']
-
-    m = mtz.object(hklout)
-    # FIXME in here should be able to just drop down to the lowest symmetry
-    # space group with the rotational elements for this calculation? I.e.
-    # P422 for P4/mmm?
-    if not m.space_group().is_centric():
-      from xia2.Toolkit.E4 import E4_mtz
-      E4s = E4_mtz(hklout, native = True)
-      self._scalr_twinning_score = E4s.items()[0][1]
+  def _scale_finish_chunk_7_record_twinning(self, twinning_score):
+    if twinning_score is not None:
+      self._scalr_twinning_score = twinning_score
 
       if self._scalr_twinning_score > 1.9:
         self._scalr_twinning_conclusion = 'Your data do not appear twinned'
@@ -927,9 +1047,6 @@ def _scale_finish_chunk_7_twinning(self):
       self._scalr_twinning_conclusion = 'Data are centric'
       self._scalr_twinning_score = 0
 
-    Chatter.write('Overall twinning score: %4.2f' % self._scalr_twinning_score)
-    Chatter.write(self._scalr_twinning_conclusion)
-
   def _scale_finish_chunk_8_raddam(self):
     crd = CCP4InterRadiationDamageDetector()
 
@@ -945,62 +1062,67 @@ def _scale_finish_chunk_8_raddam(self):
 
     crd.set_hklout(hklout)
 
-    status = crd.detect()
+    return crd.detect()
 
-    if status:
-      Chatter.write('')
-      Chatter.banner('Local Scaling %s' % self._scalr_xname)
-      for s in status:
-        Chatter.write('%s %s' % s)
-      Chatter.banner('')
-    else:
-      Debug.write('Local scaling failed')
+  def _get_statistics_session(self, hklin):
+    '''Return the statistics session for a scaled unmerged reflection
+    file, reading the file only if it is new or has changed on disk.'''
+
+    from xia2.Modules.MergingStatistics import get_statistics_session
+
+    return get_statistics_session(hklin)
+
+  def _evict_statistics_session(self, hklin):
+    '''Release the statistics session for a reflection file which will
+    not be needed again.'''
+
+    from xia2.Modules.MergingStatistics import evict_statistics_session
+
+    evict_statistics_session(hklin)
+
+    return
 
   def _estimate_resolution_limit(self, hklin, batch_range=None):
     params = PhilIndex.params.xia2.settings.resolution
-    m = Merger()
-    m.set_working_directory(self.get_working_directory())
-    from xia2.lib.bits import auto_logfiler
-    auto_logfiler(m)
-    m.set_hklin(hklin)
-    m.set_limit_rmerge(params.rmerge)
-    m.set_limit_completeness(params.completeness)
-    m.set_limit_cc_half(params.cc_half)
-    m.set_cc_half_significance_level(params.cc_half_significance_level)
-    m.set_limit_isigma(params.isigma)
-    m.set_limit_misigma(params.misigma)
+    nbins = 100
     if PhilIndex.params.xia2.settings.small_molecule == True:
-      m.set_nbins(20)
-    if batch_range is not None:
-      start, end = batch_range
-      m.set_batch_range(start, end)
-    m.run()
+      nbins = 20
+    Debug.write('Resolution analysis: %s %s' % (hklin, batch_range))
+    limits = self._get_statistics_session(hklin).resolution_limits(
+      rmerge=params.rmerge,
+      completeness=params.completeness,
+      cc_half=params.cc_half,
+      cc_half_significance_level=params.cc_half_significance_level,
+      isigma=params.isigma,
+      misigma=params.misigma,
+      nbins=nbins,
+      batch_range=batch_range)
 
     resolution_limits = []
     reasoning = []
 
     if params.completeness is not None:
-      r_comp = m.get_resolution_completeness()
+      r_comp = limits['completeness']
       resolution_limits.append(r_comp)
       reasoning.append('completeness > %s' %params.completeness)
 
     if params.cc_half is not None:
-      r_cc_half = m.get_resolution_cc_half()
+      r_cc_half = limits['cc_half']
       resolution_limits.append(r_cc_half)
       reasoning.append('cc_half > %s' %params.cc_half)
 
     if params.rmerge is not None:
-      r_rm = m.get_resolution_rmerge()
+      r_rm = limits['rmerge']
       resolution_limits.append(r_rm)
       reasoning.append('rmerge > %s' %params.rmerge)
 
     if params.isigma is not None:
-      r_uis = m.get_resolution_isigma()
+      r_uis = limits['isigma']
       resolution_limits.append(r_uis)
       reasoning.append('unmerged <I/sigI> > %s' %params.isigma)
 
     if params.misigma is not None:
-      r_mis = m.get_resolution_misigma()
+      r_mis = limits['misigma']
       resolution_limits.append(r_mis)
       reasoning.append('merged <I/sigI> > %s' %params.misigma)
 
@@ -1118,27 +1240,22 @@ def _compute_scaler_statistics(self, scaled_unmerged_mtz, selected_band=None, wa
     return stats
 
   def _iotbx_merging_statistics(self, scaled_unmerged_mtz, anomalous=False, d_min=None, d_max=None, n_bins=None):
-    import iotbx.merging_statistics
-
     params = PhilIndex.params.xia2.settings.merging_statistics
 
-    i_obs = iotbx.merging_statistics.select_data(scaled_unmerged_mtz, data_labels=None)
-    i_obs = i_obs.customized_copy(anomalous_flag=True, info=i_obs.info())
+    session = self._get_statistics_session(scaled_unmerged_mtz)
 
-    result = iotbx.merging_statistics.dataset_statistics(
-      i_obs=i_obs,
+    result = session.merging_statistics(
+      anomalous=anomalous,
       d_min=d_min,
       d_max=d_max,
       n_bins=n_bins or params.n_bins,
-      anomalous=anomalous,
       use_internal_variance=params.use_internal_variance,
       eliminate_sys_absent=params.eliminate_sys_absent,
-      assert_is_not_unique_set_under_symmetry=False,
     )
 
     if anomalous:
-      merged_intensities = i_obs.merge_equivalents(
-        use_internal_variance=params.use_internal_variance).array()
+      merged_intensities = session.merged_intensities(
+        use_internal_variance=params.use_internal_variance)
       slope, intercept, n_pairs = anomalous_probability_plot(merged_intensities)
 
       Debug.write('Anomalous difference normal probability plot:')
@@ -1148,6 +1148,7 @@ def _scale(self):
             resolution, reasoning = self._estimate_resolution_limit(hklin)
         else:
           resolution, reasoning = self._estimate_resolution_limit(hklin)
+        self._evict_statistics_session(hklin)
 
       reasoning_str = ''
       if reasoning:
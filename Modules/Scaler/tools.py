@@ -25,6 +25,94 @@ def patch_mtz_unit_cell(mtzfile, unit_cell_parameters):
   f.write(file_name=mtzfile)
 
 
+#
+# Add lines to the history of an .mtz file, by rewriting only the headers
+# (which follow the reflection data) rather than reading and writing the
+# whole file - the history follows the END record of the main header, as
+# MTZHIST n and n records, then any batch headers.
+#
+
+_mtz_record_length = 80
+
+def _read_mtz_header_offset(f):
+  '''Return the byte offset of the headers of the open .mtz file f, or
+  None if this cannot be read.'''
+
+  import struct
+
+  f.seek(0)
+  stamp = f.read(12)
+  if len(stamp) < 12 or stamp[:4] != 'MTZ ':
+    return None
+
+  # the machine stamp gives the byte order of the header position
+
+  if (ord(stamp[8]) >> 4) == 4:
+    position = struct.unpack('<i', stamp[4:8])[0]
+  else:
+    position = struct.unpack('>i', stamp[4:8])[0]
+
+  if position <= 0:
+    return None
+
+  return (position - 1) * 4
+
+def _patch_mtz_history(f, history):
+  '''Add history to the open .mtz file f, returning False if the headers
+  could not be found.'''
+
+  n = _mtz_record_length
+
+  offset = _read_mtz_header_offset(f)
+  if offset is None:
+    return False
+
+  f.seek(offset)
+  headers = f.read()
+
+  # find the END record of the main header
+
+  for j in range(0, len(headers) - n + 1, n):
+    if headers[j:j + n].rstrip() == 'END':
+      end = j + n
+      break
+  else:
+    return False
+
+  old_history = []
+  rest = headers[end:]
+  if rest.startswith('MTZHIST'):
+    n_history = int(rest[7:n])
+    old_history = [rest[n * (j + 1):n * (j + 2)] for j in range(n_history)]
+    rest = rest[n * (n_history + 1):]
+
+  lines = [line[:n].ljust(n) for line in history] + old_history
+
+  f.seek(offset)
+  f.write(headers[:end])
+  f.write(('MTZHIST %3d' % len(lines)).ljust(n))
+  f.write(''.join(lines))
+  f.write(rest)
+  f.truncate()
+
+  return True
+
+def add_mtz_history(mtzfile, history):
+  '''Add the lines in history to the start of the history of mtzfile, as
+  mtz.object.add_history() would.'''
+
+  with open(mtzfile, 'r+b') as f:
+    if _patch_mtz_history(f, history):
+      return
+
+  from iotbx import mtz
+
+  m = mtz.object(file_name=mtzfile)
+  m.add_history(list(history))
+  m.write(file_name=mtzfile)
+
+  return
+
 #
 # Replacement function centralised to replace the use of cellparm.
 #
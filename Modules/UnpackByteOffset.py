@@ -1,104 +1,179 @@
 from __future__ import absolute_import, division
 
 import binascii
+import os
 import struct
 import sys
 import random
 
+import numpy
+
+# The byte offset compression used in CBF images stores the difference
+# between each pixel and the previous one in one byte if it will fit, else
+# the escape code -128 followed by two bytes, else -128, -32768 and four
+# bytes, else -128, -32768, -2147483648 and eight bytes. Packing and
+# unpacking is done on whole numpy arrays, with only the (usually rare)
+# escape codes examined individually.
+
+_escape_sizes = {2:3, 4:7, 8:15}
+
 def pack_values(data):
-  current = 0
-  packed = ''
-
-  for d in data:
-    delta = d - current
-    if -127 < delta < 127:
-      packed += struct.pack('b', delta)
-      current = d
-      continue
+  '''Pack the integer pixel values in data into a byte offset compressed
+  string.'''
 
-    packed += struct.pack('b', -128)
-    if -32767 < delta < 32767:
-      packed += struct.pack('<h', delta)
-      current = d
-      continue
+  values = numpy.asarray(data, dtype=numpy.int64)
+  deltas = numpy.empty_like(values)
+  if len(values):
+    deltas[0] = values[0]
+    deltas[1:] = values[1:] - values[:-1]
+
+  # the number of bytes needed for each delta, with the escape codes
 
-    packed += struct.pack('<h', -32768)
-    if -2147483647 < delta < 2147483647:
-      packed += struct.pack('<i', delta)
-      current = d
+  sizes = numpy.ones(len(deltas), dtype=numpy.int64)
+  sizes[(deltas <= -127) | (deltas >= 127)] = 3
+  sizes[(deltas <= -32767) | (deltas >= 32767)] = 7
+  sizes[(deltas <= -2147483647) | (deltas >= 2147483647)] = 15
+
+  offsets = numpy.cumsum(sizes) - sizes
+  packed = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+
+  small = sizes == 1
+  packed[offsets[small]] = deltas[small].astype(numpy.int8).view(numpy.uint8)
+
+  for size, dtype, escape in ((3, '<i2', 0), (7, '<i4', 2), (15, '<i8', 6)):
+    selected = sizes == size
+    if not selected.any():
       continue
+    offset = offsets[selected]
+
+    # escape codes: -128 (0x80), -32768 (0x00 0x80), -2147483648
+    # (0x00 0x00 0x00 0x80) as far as are needed for this size
 
-    packed += struct.pack('<i', -2147483648)
-    packed += struct.pack('<q', delta)
-    current = d
+    packed[offset] = 0x80
+    if size >= 7:
+      packed[offset + 2] = 0x80
+    if size == 15:
+      packed[offset + 6] = 0x80
 
-  return packed
+    payload = deltas[selected].astype(dtype).view(numpy.uint8).reshape(
+      -1, numpy.dtype(dtype).itemsize)
+    for k in range(payload.shape[1]):
+      packed[offset + 1 + escape + k] = payload[:, k]
+
+  return packed.tostring()
 
-def unpack_values(data, length):
-  # unpack data stream
+def _read_little_endian(raw, offsets, nbytes):
+  '''Read the signed little endian integers of nbytes at offsets in the
+  unsigned byte array raw.'''
 
-  values = []
+  value = numpy.zeros(len(offsets), dtype=numpy.uint64)
+  for k in range(nbytes):
+    value |= raw[offsets + k].astype(numpy.uint64) << numpy.uint64(8 * k)
+  value = value.view(numpy.int64)
+  if nbytes < 8:
+    sign = 1 << (8 * nbytes - 1)
+    value = numpy.where(value >= sign, value - 2 * sign, value)
+  return value
 
-  pixel = 0
-  ptr = 0
+def _unpack_values(data, length):
+  '''Unpack length values from the byte offset compressed string data,
+  returning the values as a numpy array and the number of bytes used.'''
 
-  while len(values) < length:
+  raw = numpy.frombuffer(data, dtype=numpy.int8)
 
-    delta = struct.unpack('b', data[ptr])[0]
-    ptr += 1
+  # read the value following every byte equal to -128 as though it were an
+  # escape code, from a padded copy so that reads past the end are safe
 
-    if delta != -128:
-      pixel += delta
-      values.append(pixel)
-      continue
+  candidates = numpy.flatnonzero(raw == -128)
+  padded = numpy.zeros(len(raw) + 15, dtype=numpy.uint8)
+  padded[:len(raw)] = raw.view(numpy.uint8)
 
-    delta = struct.unpack('<h', data[ptr:ptr + 2])[0]
-    ptr += 2
+  deltas = _read_little_endian(padded, candidates + 1, 2)
+  sizes = numpy.empty(len(candidates), dtype=numpy.int64)
+  sizes[:] = 3
 
-    if delta != -32768:
-      pixel += delta
-      values.append(pixel)
-      continue
+  escaped = numpy.flatnonzero(deltas == -32768)
+  deltas[escaped] = _read_little_endian(padded, candidates[escaped] + 3, 4)
+  sizes[escaped] = 7
 
-    delta = struct.unpack('<i', data[ptr:ptr + 4])[0]
-    ptr += 4
+  escaped = escaped[deltas[escaped] == -2147483648]
+  deltas[escaped] = _read_little_endian(padded, candidates[escaped] + 7, 8)
+  sizes[escaped] = 15
 
-    if delta != -2147483648:
-      pixel += delta
-      values.append(pixel)
-      continue
+  # a candidate is an escape code unless it is within a longer value which
+  # starts at an earlier escape code: any candidate after the end of all of
+  # the earlier candidates certainly is, so only candidates which overlap
+  # earlier ones need to be examined in turn
 
-    delta = struct.unpack('<q', data[ptr:ptr + 8])[0]
-    ptr += 8
-    pixel += delta
-    values.append(pixel)
+  ends = candidates + sizes
+  real = numpy.ones(len(candidates), dtype=bool)
 
-  return values
+  if len(candidates) > 1:
+    overlap = numpy.flatnonzero(
+      candidates[1:] < numpy.maximum.accumulate(ends[:-1])) + 1
 
-def unpack_tiff(filename):
-  data = open(filename, 'rb'),read()
-  header = data[:4096]
-  data = data[4096:]
+    # (as plain lists, which are much faster to index one at a time)
 
-  values = struct.unpack('<i', data)
+    starts = candidates.tolist()
+    stops = ends.tolist()
+    within = []
 
-  print min(values), max(values)
+    next_start = 0
+    previous = None
+    for j in overlap.tolist():
+      if previous != j - 1:
+        next_start = stops[j - 1]
+      if starts[j] < next_start:
+        within.append(j)
+      else:
+        next_start = stops[j]
+      previous = j
 
-def work():
-  values = [int(random.random() * 65536) for j in range(1024 * 1024)]
+    real[within] = False
 
-  l = len(values)
+  starts = candidates[real]
+  sizes = sizes[real]
+  deltas = deltas[real]
 
-  packed = pack_values(values)
+  # and only the escape codes within the first length values count
 
-  unpacked = unpack_values(packed, l)
+  skipped = numpy.cumsum(sizes - 1)
+  within = (starts - skipped + sizes - 1) < length
+  starts = starts[within]
+  sizes = sizes[within]
+  deltas = deltas[within]
 
-  for j in range(l):
-    assert(unpacked[j] == values[j])
+  nbytes = length + int((sizes - 1).sum())
+  if nbytes > len(raw):
+    raise RuntimeError, 'byte offset data too short for %d values' % length
 
-  return
+  values = raw[:nbytes].astype(numpy.int64)
 
-def unpackbyteoffset(filename):
+  if len(starts):
+    values[starts] = deltas
+
+    # mask out the bytes following each escape code
+
+    keep = numpy.ones(nbytes, dtype=bool)
+    for k in range(1, 15):
+      selected = starts[sizes > k]
+      if not len(selected):
+        break
+      keep[selected + k] = False
+    values = values[keep]
+
+  return numpy.cumsum(values), nbytes
+
+def unpack_values(data, length):
+  '''Unpack length values from the byte offset compressed string data,
+  returning a numpy array.'''
+
+  return _unpack_values(data, length)[0]
+
+def read_cbf(filename):
+  '''Read the pixel values from a byte offset compressed CBF image,
+  returning the text header, the values, the image size (fast, slow) and
+  any data following the binary section.'''
 
   data = open(filename, 'rb').read()
 
@@ -106,61 +181,129 @@ def unpackbyteoffset(filename):
 
   data_offset = data.find(start_tag) + 4
 
-  header = data[:data.find(start_tag)].split('\n')
+  cbf_header = data[:data.find(start_tag)]
 
   fast = 0
   slow = 0
   length = 0
 
-  for record in header:
+  for record in cbf_header.split('\n'):
     if 'X-Binary-Size-Fastest-Dimension' in record:
       fast = int(record.split()[-1])
-    if 'X-Binary-Size-Second-Dimension' in record:
+    elif 'X-Binary-Size-Second-Dimension' in record:
       slow = int(record.split()[-1])
-    if 'X-Binary-Number-of-Elements' in record:
+    elif 'X-Binary-Number-of-Elements' in record:
       length = int(record.split()[-1])
 
   assert(length == fast * slow)
 
-  values = unpack_values(data[data_offset:], length)
-  hist = [0 for j in range(min(0, min(values)), max(values) + 1)]
+  values, nbytes = _unpack_values(data[data_offset:], length)
 
-  for i in range(slow):
-    for j in range(fast):
-      k = i * fast + j
-      hist[values[k]] += 1
+  return cbf_header, values, (fast, slow), data[data_offset + nbytes:]
 
-  return hist, min(values), max(values)
+def write_cbf(filename, cbf_header, values, trailer=''):
+  '''Write a byte offset compressed CBF image with the header from
+  read_cbf, updating the size and checksum of the binary section.'''
 
-def sumbyteoffset(filename):
+  import base64
+  import hashlib
 
-  data = open(filename, 'rb').read()
+  packed = pack_values(values)
+
+  records = []
+  for record in cbf_header.split('\n'):
+    if record.startswith('X-Binary-Size:'):
+      record = 'X-Binary-Size: %d' % len(packed) + \
+               record[len(record.rstrip('\r')):]
+    elif record.startswith('Content-MD5:'):
+      record = 'Content-MD5: %s' % \
+               base64.b64encode(hashlib.md5(packed).digest()) + \
+               record[len(record.rstrip('\r')):]
+    records.append(record)
 
   start_tag = binascii.unhexlify('0c1a04d5')
 
-  data_offset = data.find(start_tag) + 4
+  with open(filename, 'wb') as f:
+    f.write('\n'.join(records))
+    f.write(start_tag)
+    f.write(packed)
+    f.write(trailer)
 
-  header = data[:data.find(start_tag)].split('\n')
+  return
 
-  fast = 0
-  slow = 0
-  length = 0
+def _transform_image(args):
+  filename_in, filename_out, function = args
 
-  for record in header:
-    if 'X-Binary-Size-Fastest-Dimension' in record:
-      fast = int(record.split()[-1])
-    if 'X-Binary-Size-Second-Dimension' in record:
-      slow = int(record.split()[-1])
-    if 'X-Binary-Number-of-Elements' in record:
-      length = int(record.split()[-1])
+  cbf_header, values, size, trailer = read_cbf(filename_in)
+  write_cbf(filename_out, cbf_header, function(values), trailer)
 
-  assert(length == fast * slow)
+  return filename_out
+
+def transform_images(filenames, output_directory, function, nproc=None):
+  '''Rewrite the CBF images in filenames to output_directory with the
+  pixel values transformed by function(values) - which must return the
+  new values and be picklable - in a pool of nproc processes. Yields the
+  names of the images written as each one is finished.'''
+
+  import multiprocessing
+
+  jobs = [(filename, os.path.join(output_directory,
+                                  os.path.split(filename)[-1]), function)
+          for filename in filenames]
+
+  if nproc == 1:
+    for job in jobs:
+      yield _transform_image(job)
+    return
+
+  pool = multiprocessing.Pool(nproc)
+  try:
+    for filename in pool.imap_unordered(_transform_image, jobs):
+      yield filename
+  finally:
+    pool.close()
+    pool.join()
+
+  return
+
+def unpack_tiff(filename):
+  data = open(filename, 'rb'),read()
+  header = data[:4096]
+  data = data[4096:]
+
+  values = struct.unpack('<i', data)
+
+  print min(values), max(values)
+
+def work():
+  values = [int(random.random() * 65536) for j in range(1024 * 1024)]
+
+  l = len(values)
+
+  packed = pack_values(values)
+
+  unpacked = unpack_values(packed, l)
+
+  for j in range(l):
+    assert(unpacked[j] == values[j])
+
+  return
+
+def unpackbyteoffset(filename):
+
+  cbf_header, values, (fast, slow), trailer = read_cbf(filename)
+
+  hist = numpy.bincount(values - min(0, values.min()))
+
+  return list(hist), values.min(), values.max()
+
+def sumbyteoffset(filename):
 
-  values = unpack_values(data[data_offset:], length)
+  cbf_header, values, (fast, slow), trailer = read_cbf(filename)
 
-  assert(len(values) == length)
+  assert(len(values) == fast * slow)
 
-  return sum(values), length
+  return values.sum(), len(values)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# XDSReflections.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# A reader for the reflection files written by XDS (INTEGRATE.HKL and
+# XDS_ASCII.HKL): the ! header is parsed once for the keywords and the
+# names of the columns, then the body is decoded in a single bulk numpy
+# parse into a two dimensional array, from which typed columns are taken
+# (hkl, i, sigma, xyz, rlp, peak, corr, psi). Optionally the decoded body is
+# kept in a binary .npy sidecar next to the file, named for the size of the
+# file, which is memory mapped by later reads as long as it is newer than the
+# file and the size is unchanged.
+
+from __future__ import absolute_import, division
+import os
+import re
+
+import numpy
+
+# the columns of INTEGRATE.HKL and XDS_ASCII.HKL under common names, as the
+# first of the alternative XDS names found in the file
+
+column_names = {
+  'hkl':(('H', 'K', 'L'),),
+  'i':(('IOBS',),),
+  'sigma':(('SIGMA(IOBS)',), ('SIGMA',)),
+  'xyz':(('XD', 'YD', 'ZD'), ('XCAL', 'YCAL', 'ZCAL')),
+  'rlp':(('RLP',),),
+  'peak':(('PEAK',),),
+  'corr':(('CORR',),),
+  'psi':(('PSI',),),
+  }
+
+_keyword = re.compile(r"([^\s=]+)=")
+_column_list = re.compile(r'^[A-Z0-9_()]+(,[A-Z0-9_()]*)+$')
+
+def read_header(filename):
+  '''Read the ! header of an XDS reflection file, returning a dictionary of
+  keyword: list of values, the names of the columns, and the header lines
+  (including the line endings) and their length in bytes.'''
+
+  header = { }
+  items = { }
+  column_list = []
+  lines = []
+  size = 0
+
+  with open(filename, 'rb') as f:
+    for record in f:
+      if not record.startswith('!'):
+        break
+      lines.append(record)
+      size += len(record)
+
+      text = record[1:].strip()
+
+      if _column_list.match(text):
+        column_list.extend(n for n in text.split(',') if n)
+        continue
+
+      tokens = _keyword.split(text)
+      for j in range(1, len(tokens) - 1, 2):
+        header[tokens[j]] = tokens[j + 1].split()
+
+  # XDS_ASCII.HKL names the columns with ITEM_NAME=column keywords, while
+  # INTEGRATE.HKL lists them
+
+  for keyword in header:
+    if keyword.startswith('ITEM_'):
+      items[int(header[keyword][0]) - 1] = keyword[5:]
+
+  if items:
+    columns = [items.get(j) for j in range(max(items) + 1)]
+  else:
+    columns = column_list
+
+  return header, columns, lines, size
+
+class xds_reflections(object):
+  '''The contents of an XDS reflection file, as a two dimensional array of
+  values (one row per reflection) with named columns.'''
+
+  def __init__(self, filename, sidecar=False):
+
+    self._filename = filename
+    self.header, self.columns, self.header_lines, header_size = \
+      read_header(filename)
+
+    n_items = int(self.header.get(
+      'NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD', [len(self.columns)])[0])
+
+    self.data = None
+
+    st = os.stat(filename)
+    sidecar_file = '%s.%d.npy' % (filename, st.st_size)
+
+    if sidecar and os.path.exists(sidecar_file) and \
+           os.stat(sidecar_file).st_mtime >= st.st_mtime:
+      try:
+        self.data = numpy.load(sidecar_file, mmap_mode='r')
+      except (IOError, ValueError):
+        self.data = None
+
+    if self.data is None:
+      with open(filename, 'rb') as f:
+        f.seek(header_size)
+        body = f.read()
+
+      end = body.find('!END_OF_DATA')
+      if end >= 0:
+        body = body[:end]
+
+      values = numpy.fromstring(body, dtype=numpy.float64, sep=' ')
+      if len(values) % n_items:
+        raise RuntimeError, 'error reading %s: %d values for %d columns' % \
+              (filename, len(values), n_items)
+      self.data = values.reshape(-1, n_items)
+
+      if sidecar:
+        self._write_sidecar(sidecar_file)
+
+    self._index = dict((name, j) for j, name in enumerate(self.columns))
+
+    return
+
+  def _write_sidecar(self, sidecar_file):
+    tmp_file = '%s.tmp.npy' % self._filename
+    try:
+      # remove any sidecar for an earlier version of the file
+      directory, name = os.path.split(self._filename)
+      for f in os.listdir(directory or os.curdir):
+        if f.startswith('%s.' % name) and f.endswith('.npy') and \
+               f[len(name) + 1:-4].isdigit():
+          os.remove(os.path.join(directory, f))
+      numpy.save(tmp_file, self.data)
+      os.rename(tmp_file, sidecar_file)
+    except (IOError, OSError):
+      if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    return
+
+  def __len__(self):
+    return self.data.shape[0]
+
+  def get_column(self, name):
+    '''Return the column with the XDS name given.'''
+
+    return self.data[:, self._index[name]]
+
+  def has_column(self, name):
+    for names in column_names[name]:
+      if all(n in self._index for n in names):
+        return True
+    return False
+
+  def get(self, name):
+    '''Return the column(s) with the common name given (see column_names)
+    - hkl as integers.'''
+
+    for names in column_names[name]:
+      if all(n in self._index for n in names):
+        break
+    else:
+      raise KeyError('%s not found in %s' % (name, self._filename))
+
+    if len(names) == 1:
+      return self.data[:, self._index[names[0]]]
+
+    columns = self.data[:, [self._index[n] for n in names]]
+    if name == 'hkl':
+      return numpy.rint(columns).astype(numpy.int32)
+    return columns
+
+def read_xds_reflections(filename, sidecar=False):
+  '''Read an XDS reflection file, keeping the decoded body in a .npy
+  sidecar file if sidecar is set.'''
+
+  return xds_reflections(filename, sidecar=sidecar)
@@ -15,6 +15,33 @@
 from __future__ import absolute_import, division
 import os
 
+# number of records decoded at a time
+
+_block_size = 10000
+
+def _write_fitting(records, fout, n_items, sigma):
+  '''Write the records with sigma > 0 to fout, returning the number of
+  misfits - the records are decoded together.'''
+
+  import numpy
+
+  if not records:
+    return 0
+
+  values = numpy.fromstring(''.join(records), dtype=numpy.float64, sep=' ')
+  if len(values) == n_items * len(records):
+    keep = values.reshape(-1, n_items)[:, sigma] > 0.0
+  else:
+    keep = [float(record.split()[sigma]) > 0.0 for record in records]
+
+  n_kept = 0
+  for record, k in zip(records, keep):
+    if k:
+      fout.write(record)
+      n_kept += 1
+
+  return len(records) - n_kept
+
 def remove_misfits(xdsin, xdsout):
   '''Read through the XDS_ASCII input file and remove the misfit
   reflections (SD < 0.0) - write out the remains to xdsout.'''
@@ -25,20 +52,32 @@ def remove_misfits(xdsin, xdsout):
   if not os.path.exists(xdsin):
     raise RuntimeError, 'xdsin does not exist'
 
+  from xia2.Modules.XDSReflections import read_header
+
+  header, columns, header_lines, header_size = read_header(xdsin)
+  n_items = int(header.get(
+    'NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD', [len(columns)])[0])
+  if 'SIGMA(IOBS)' in columns:
+    sigma = columns.index('SIGMA(IOBS)')
+  else:
+    sigma = 4
+
   ignored = 0
 
   with open(xdsin, 'r') as fin, open(xdsout, 'w') as fout:
-    for record in fin.readlines():
+    block = []
+    for record in fin:
       if not record.strip():
         continue
       if record[0] == '!':
+        ignored += _write_fitting(block, fout, n_items, sigma)
+        block = []
         fout.write(record)
         continue
-      values = map(float, record.split())
-      if values[4] > 0.0:
-        fout.write(record)
-        continue
-      else:
-        ignored += 1
+      block.append(record)
+      if len(block) >= _block_size:
+        ignored += _write_fitting(block, fout, n_items, sigma)
+        block = []
+    ignored += _write_fitting(block, fout, n_items, sigma)
 
   return ignored
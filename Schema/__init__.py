@@ -96,16 +96,41 @@ def load_imagesets(template, directory, id_image=None, image_range=None,
 
       if read_all_image_headers:
         paths = sorted(locate_files_matching_template_string(full_template_path))
-        unhandled = []
-        datablocks = DataBlockFactory.from_filenames(
-          paths, verbose=False, unhandled=unhandled,
-          compare_beam=compare_beam,
-          compare_detector=compare_detector,
-          compare_goniometer=compare_goniometer,
-          scan_tolerance=scan_tolerance,
-          format_kwargs=format_kwargs)
-        assert len(unhandled) == 0, "unhandled image files identified: %s" % \
-            unhandled
+
+        # the imageset is cached against the name, size and modification
+        # time of every image, along with the settings used to compare them
+        # and the version of the dxtbx code which reads them
+        import dxtbx.datablock
+        from xia2.Handlers.DiskCache import DiskCache, file_key
+        from xia2.Handlers.StartupCache import module_source, source_key
+        tolerance = params.input.tolerance
+        cache_key = file_key(paths, [
+          source_key(paths=[module_source(dxtbx.datablock.__file__)]),
+          tolerance.beam.wavelength, tolerance.beam.direction,
+          tolerance.beam.polarization_normal,
+          tolerance.beam.polarization_fraction,
+          tolerance.detector.fast_axis, tolerance.detector.slow_axis,
+          tolerance.detector.origin, tolerance.goniometer.rotation_axis,
+          tolerance.goniometer.fixed_rotation,
+          tolerance.goniometer.setting_rotation, scan_tolerance,
+          sorted(format_kwargs.items())])
+        cached = DiskCache.get('imageset', cache_key)
+
+        if cached is not None:
+          datablocks = DataBlockFactory.from_dict(cached)
+        else:
+          unhandled = []
+          datablocks = DataBlockFactory.from_filenames(
+            paths, verbose=False, unhandled=unhandled,
+            compare_beam=compare_beam,
+            compare_detector=compare_detector,
+            compare_goniometer=compare_goniometer,
+            scan_tolerance=scan_tolerance,
+            format_kwargs=format_kwargs)
+          assert len(unhandled) == 0, "unhandled image files identified: %s" % \
+              unhandled
+          DiskCache.put(
+            'imageset', cache_key, [db.to_dict() for db in datablocks])
         assert len(datablocks) == 1, "1 datablock expected, %d found" % \
             len(datablocks)
 
@@ -0,0 +1,154 @@
+from __future__ import absolute_import, division
+
+import os
+import time
+
+# the tasks, which are run in forked worker processes
+
+def timed(name, seconds):
+  '''Return (name, start, end) for a task which takes seconds.'''
+
+  start = time.time()
+  time.sleep(seconds)
+  return name, start, time.time()
+
+def fail(exception):
+  raise exception
+
+class unpicklable_error(Exception):
+  def __init__(self, value, other):
+    Exception.__init__(self, value)
+    self.other = other
+
+def fail_unpicklable():
+  raise unpicklable_error('cannot be unpickled', None)
+
+def exit_worker():
+  os._exit(1)
+
+def make_scheduler(n_slots, threads=False):
+  from xia2.Applications.xia2_scheduler import scheduler
+  return scheduler([None] * n_slots, threads=threads)
+
+def exercise_local_task_overlaps_pool():
+  # while a slow local task runs in the main process, slots freed by
+  # finished pool tasks must still be refilled
+
+  for threads in (False, True):
+    s = make_scheduler(2, threads=threads)
+    first = s.add_task('first', timed, ('first', 0.1))
+    local = s.add_task('local', timed, ('local', 2.0), depends_on=[first],
+                       local=True)
+    others = [s.add_task('other %d' % j, timed, ('other %d' % j, 0.3))
+              for j in range(4)]
+    s.run()
+
+    local_start, local_end = local.result[1:]
+    assert first.result[2] <= local_start
+    for t in others:
+      assert t.result[2] < local_end, (threads, t.name)
+  print 'OK'
+
+def exercise_dependencies():
+  # a diamond, and a chain which includes a local task; each task must
+  # start after the tasks it depends on, and callbacks run in the main
+  # process in an order consistent with the graph
+
+  s = make_scheduler(3)
+  order = []
+  def add(name, seconds, depends_on=(), local=False):
+    return s.add_task(name, timed, (name, seconds), depends_on=depends_on,
+                      local=local,
+                      callback=lambda result: order.append(result[0]))
+
+  a = add('a', 0.3)
+  b = add('b', 0.1, [a])
+  c = add('c', 0.2, [a])
+  d = add('d', 0.1, [b, c])
+  e = add('e', 0.1, [d], local=True)
+  f = add('f', 0.1, [e])
+  g = add('g', 0.1)
+
+  results = s.run()
+  tasks = [a, b, c, d, e, f, g]
+  assert results == [t.result for t in tasks]
+  for t in tasks:
+    assert t.result[0] == t.name
+    for u in t.depends_on:
+      assert u.result[2] <= t.result[1], (u.name, t.name)
+      assert order.index(u.name) < order.index(t.name)
+  assert sorted(order) == sorted(t.name for t in tasks)
+  print 'OK'
+
+def exercise_errors():
+  from xia2.Applications.xia2_scheduler import scheduler
+
+  # an exception in a pool task is raised again as itself, and the tasks
+  # which depend on it are never run
+  ran = []
+  s = make_scheduler(2)
+  bad = s.add_task('bad', fail, (ValueError('bad value'), ))
+  s.add_task('after', timed, ('after', 0), depends_on=[bad],
+             callback=lambda result: ran.append(result))
+  try:
+    s.run()
+    assert False
+  except ValueError, e:
+    assert str(e) == 'bad value'
+  assert not ran
+
+  # one which cannot be passed back is raised as a RuntimeError
+  s = make_scheduler(1)
+  s.add_task('unpicklable', fail_unpicklable, ())
+  try:
+    s.run()
+    assert False
+  except RuntimeError, e:
+    assert 'cannot be unpickled' in str(e)
+
+  # as is an exception in a callback or a local task
+  s = make_scheduler(1)
+  s.add_task('callback', timed, ('callback', 0),
+             callback=lambda result: fail(KeyError('callback')))
+  try:
+    s.run()
+    assert False
+  except KeyError:
+    pass
+
+  s = make_scheduler(1)
+  s.add_task('local', fail, (IndexError('local'), ), local=True)
+  try:
+    s.run()
+    assert False
+  except IndexError:
+    pass
+
+  # a worker which dies is noticed rather than waited for
+  s = make_scheduler(1)
+  s.add_task('exit', exit_worker, ())
+  try:
+    s.run()
+    assert False
+  except RuntimeError, e:
+    assert 'lost' in str(e), str(e)
+
+  # and a task which can never be ready is reported
+  s = make_scheduler(1)
+  missing = scheduler([None]).add_task('missing', timed, ('missing', 0))
+  s.add_task('orphan', timed, ('orphan', 0), depends_on=[missing],
+             local=True)
+  try:
+    s.run()
+    assert False
+  except RuntimeError, e:
+    assert 'unsatisfiable' in str(e)
+  print 'OK'
+
+def run():
+  exercise_local_task_overlaps_pool()
+  exercise_dependencies()
+  exercise_errors()
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,130 @@
+from __future__ import absolute_import, division
+
+def make_store(records, memory_limit=None, tail_size=None, block_size=None,
+               write_size=None):
+  from xia2.Driver.OutputStore import OutputStore
+  store = OutputStore()
+  if memory_limit is not None:
+    store._memory_limit = memory_limit
+  if tail_size is not None:
+    store._tail_size = tail_size
+    import collections
+    store._tail = collections.deque(maxlen=tail_size)
+  if block_size is not None:
+    store._block_size = block_size
+  if write_size is not None:
+    store._write_size = write_size
+  store.extend(records)
+  return store
+
+def make_records(n):
+  return ['record %d%s\n' % (j, ' $TABLE' if j % 7 == 0 else '')
+          for j in range(n)]
+
+def exercise_in_memory():
+  records = make_records(50)
+  store = make_store(records)
+  assert store._file is None
+  assert len(store) == 50
+  assert list(store) == records
+  assert store[3] == records[3]
+  assert store[-1] == records[-1]
+  assert store[10:20] == records[10:20]
+  assert store.find('$TABLE') == [j for j in range(50) if j % 7 == 0]
+  print 'OK'
+
+def exercise_spill():
+  records = make_records(1000)
+  store = make_store(records, memory_limit=1000, tail_size=10,
+                     block_size=64, write_size=100)
+  assert store._file is not None
+  assert store._records is None
+  assert len(store) == 1000
+  assert len(store._offsets) == 1001
+
+  # every record, from the file, the read block and the tail
+  for j in range(1000):
+    assert store[j] == records[j], j
+  for j in range(1, 1001):
+    assert store[-j] == records[-j], j
+  assert list(store) == records
+  assert store[0:1000] == records
+  assert store[995:1000] == records[995:1000]
+  assert store[100:900:7] == records[100:900:7]
+  assert store[500:400] == []
+  assert records[5] in store
+  assert store == records
+
+  try:
+    store[1000]
+    assert False
+  except IndexError:
+    pass
+  print 'OK'
+
+def exercise_append_after_read():
+  records = make_records(500)
+  store = make_store(records[:300], memory_limit=1000, tail_size=10,
+                     block_size=64, write_size=1000)
+
+  # reading back moves the file away from its end: records added after
+  # this must still be written at the end, and buffered records must be
+  # readable before they are written
+  for j in range(300, 500):
+    store.append(records[j])
+    assert store[j - 150] == records[j - 150]
+    assert store[j] == records[j]
+  assert list(store) == records
+  assert [store[j] for j in range(500)] == records
+  print 'OK'
+
+def exercise_find():
+  records = make_records(400)
+  store = make_store(records[:200], memory_limit=1000, tail_size=10,
+                     block_size=64, write_size=500)
+  expected = [j for j in range(200) if j % 7 == 0]
+  assert store.find('$TABLE') == expected
+
+  # the search is extended to the records added since
+  store.extend(records[200:])
+  expected = [j for j in range(400) if j % 7 == 0]
+  assert store.find('$TABLE') == expected
+  assert store.find('record 399') == [399]
+  assert store.find('no such record') == []
+  print 'OK'
+
+def exercise_reads_by_block():
+  # searching, iterating and slicing read at most a block at a time
+  records = make_records(1000)
+  store = make_store(records, memory_limit=1000, tail_size=10,
+                     block_size=64, write_size=100)
+  reads = []
+  read = store._read
+  def counted_read(start, stop):
+    reads.append((start, stop))
+    return read(start, stop)
+  store._read = counted_read
+
+  assert store.find('$TABLE') == [j for j in range(1000) if j % 7 == 0]
+  assert list(store) == records
+  assert store[10:990] == records[10:990]
+  assert store[100:101] == records[100:101]
+  assert reads
+  for start, stop in reads:
+    assert 0 < stop - start <= 64, (start, stop)
+
+  # and the slice reads only the records in it
+  del reads[:]
+  assert store[130:200] == records[130:200]
+  assert reads == [(130, 194), (194, 200)]
+  print 'OK'
+
+def run():
+  exercise_in_memory()
+  exercise_spill()
+  exercise_append_after_read()
+  exercise_find()
+  exercise_reads_by_block()
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division
+
+import os
+import tempfile
+import threading
+
+class fake_process(object):
+  '''A stand-in for the child process, with the output read from a file
+  so that every read but the last returns a whole chunk.'''
+
+  def __init__(self, text):
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, text)
+    os.close(fd)
+    self.stdout = open(filename, 'rb')
+    os.remove(filename)
+
+  def poll(self):
+    return 0
+
+def pump(driver, text, chunk_size=None):
+  '''Stream text through the driver as the output of a child process, and
+  wait for it all to be read.'''
+
+  if chunk_size is not None:
+    driver._chunk_size = chunk_size
+  driver._popen = fake_process(text)
+  driver._finished = False
+  driver._pump = threading.Thread(target=driver._pump_output)
+  driver._pump.start()
+  assert driver.output() == ''
+  assert driver.finished()
+
+def make_driver():
+  from xia2.Driver.StreamingDriver import StreamingDriver
+  return StreamingDriver()
+
+def expected_lines(text):
+  return text.replace('\r\n', '\n').replace('\r', '\n').splitlines(True)
+
+def exercise_chunk_boundaries():
+  # a long line across the first boundary, then a CR LF split across the
+  # second, and a last line with no end
+  chunk = 1 << 16
+  text = 'short\n' + 'x' * (chunk + 100) + '\n'
+  text += 'y' * (2 * chunk - len(text) - 1) + '\r\n'
+  text += 'after\rcarriage\r\nreturns\n\nlast'
+  assert text[2 * chunk - 1:2 * chunk + 1] == '\r\n'
+
+  driver = make_driver()
+  pump(driver, text)
+  lines = list(driver.get_all_output())
+  assert lines == expected_lines(text)
+  assert lines[3] == 'after\n'
+  assert lines[-1] == 'last'
+
+  # and with chunks small enough to split every line, and line end
+  text = ''.join('line %d%s' % (j, ('\n', '\r\n', '\r')[j % 3])
+                 for j in range(200))
+  for chunk_size in (1, 2, 3, 7, 64):
+    driver = make_driver()
+    pump(driver, text, chunk_size=chunk_size)
+    assert list(driver.get_all_output()) == expected_lines(text), chunk_size
+  print 'OK'
+
+def exercise_callbacks():
+  text = ''.join('image %d\n%s' % (j, 'WARNING %d\n' % j if j % 10 == 0
+                                  else '') for j in range(100))
+  driver = make_driver()
+  images = []
+  warnings = []
+  driver.add_output_callback(r'^image (\d+)',
+                             lambda line, match: images.append(
+                               int(match.group(1))))
+  driver.add_output_callback('WARNING',
+                             lambda line, match: warnings.append(line))
+  pump(driver, text, chunk_size=13)
+  assert images == range(100)
+  assert warnings == ['WARNING %d\n' % j for j in range(0, 100, 10)]
+
+  # no callbacks once they are cleared
+  driver = make_driver()
+  driver.add_output_callback('image', lambda line, match: images.append(-1))
+  driver.clear_output_callbacks()
+  pump(driver, text)
+  assert not -1 in images
+  print 'OK'
+
+def exercise_tail_and_log_file():
+  text = ''.join('record %d\n' % j for j in range(200))
+  lines = expected_lines(text)
+
+  # kept in memory
+  driver = make_driver()
+  pump(driver, text, chunk_size=100)
+  assert list(driver._output_tail) == lines[-driver._tail_size:]
+  assert list(driver.get_all_output()) == lines
+  assert driver.output() == ''
+
+  # written to the log file, with only the tail in memory
+  tmp_dir = tempfile.mkdtemp()
+  log_file = os.path.join(tmp_dir, 'streaming.log')
+  driver = make_driver()
+  driver.write_log_file(log_file)
+  driver._output_in_memory = False
+  pump(driver, text, chunk_size=100)
+  assert len(driver._standard_output_records) == 0
+  assert list(driver._output_tail) == lines[-driver._tail_size:]
+  assert driver.get_all_output() == lines
+  driver.check_for_errors()
+  driver._log_file.close()
+  driver._log_file = None
+  assert open(log_file).readlines() == lines
+  print 'OK'
+
+def run():
+  exercise_chunk_boundaries()
+  exercise_callbacks()
+  exercise_tail_and_log_file()
+
+if __name__ == '__main__':
+  run()
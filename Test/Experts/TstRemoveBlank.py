@@ -0,0 +1,128 @@
+from __future__ import absolute_import, division
+
+import os
+
+from libtbx.test_utils import open_tmp_directory
+
+def make_unmerged_mtz(filename, n_batches=30, blank=range(24, 31)):
+  '''Write an unmerged MTZ file with one batch header and three reflections
+  for every batch, those in blank with I/sigma = 0.1.'''
+
+  from cctbx import sgtbx, uctbx
+  from cctbx.array_family import flex
+  from iotbx import mtz
+
+  unit_cell = uctbx.unit_cell((40, 50, 60, 90, 90, 90))
+
+  m = mtz.object()
+  m.set_title('blank batches')
+  m.set_space_group_info(sgtbx.space_group_info('P 21 21 21'))
+  m.set_hkl_base(unit_cell)
+
+  for batch in range(1, n_batches + 1):
+    m.add_batch().set_num(batch).set_nbsetid(1).set_ncryst(1).set_title(
+      'batch %d' % batch)
+
+  x = m.add_crystal('crystal', 'project', unit_cell)
+  d = x.add_dataset('dataset', 1.0)
+
+  columns = { }
+  for label in 'H', 'K', 'L', 'M_ISYM', 'BATCH', 'I', 'SIGI':
+    columns[label] = flex.double()
+  for batch in range(1, n_batches + 1):
+    for j in range(3):
+      for label, value in zip(('H', 'K', 'L', 'M_ISYM', 'BATCH', 'SIGI'),
+                              (j + 1, batch, 1, 1, batch, 1)):
+        columns[label].append(value)
+      columns['I'].append(0.1 if batch in blank else 10 + j)
+
+  n = len(columns['H'])
+  for label, column_type in (('H', 'H'), ('K', 'H'), ('L', 'H'),
+                             ('M_ISYM', 'Y'), ('BATCH', 'B'), ('I', 'J'),
+                             ('SIGI', 'Q')):
+    d.add_column(label, column_type).set_values(columns[label].as_float())
+  m.adjust_column_array_sizes(n)
+  m.set_n_reflections(n)
+  m.write(filename)
+
+def batch_headers(mtz_object):
+  return [(batch.num(), batch.title().strip())
+          for batch in mtz_object.batches()]
+
+def exercise_remove_blank():
+  from iotbx import mtz
+  from xia2.Experts.ResolutionExperts import find_blank, remove_blank
+  from xia2.Wrappers.CCP4.Rebatch import Rebatch
+
+  tmp_dir = os.path.abspath(open_tmp_directory())
+  hklin = os.path.join(tmp_dir, 'blank.mtz')
+  make_unmerged_mtz(hklin)
+
+  blanks, goods = find_blank(hklin)
+  assert blanks == range(24, 31)
+  assert goods == range(1, 24)
+
+  hklout = os.path.join(tmp_dir, 'removed.mtz')
+  assert remove_blank(hklin, hklout) == hklout
+
+  # the same as the file from Rebatch, as remove_blank used to make it
+
+  rebatch_hklout = os.path.join(tmp_dir, 'rebatch.mtz')
+  rb = Rebatch()
+  rb.set_working_directory(tmp_dir)
+  rb.set_hklin(hklin)
+  rb.set_hklout(rebatch_hklout)
+  for batch in blanks:
+    rb.exclude_batch(batch)
+  rb.exclude_batches()
+
+  removed = mtz.object(hklout)
+  rebatched = mtz.object(rebatch_hklout)
+
+  assert batch_headers(removed) == batch_headers(rebatched)
+  assert [num for num, title in batch_headers(removed)] == goods
+  assert removed.n_reflections() == rebatched.n_reflections() == 3 * 23
+  assert list(removed.extract_miller_indices()) == \
+    list(rebatched.extract_miller_indices())
+  for label in 'M_ISYM', 'BATCH', 'I', 'SIGI':
+    assert list(removed.get_column(label).extract_values()) == \
+      list(rebatched.get_column(label).extract_values()), label
+  assert removed.space_group() == rebatched.space_group()
+
+  # with no blank batches the file is returned unchanged
+  hklin = os.path.join(tmp_dir, 'not_blank.mtz')
+  make_unmerged_mtz(hklin, blank=[])
+  assert remove_blank(hklin, hklout) == hklin
+  print 'OK'
+
+def exercise_remove_batch_headers():
+  from iotbx import mtz
+  from xia2.Experts.ResolutionExperts import remove_batch_headers
+
+  tmp_dir = os.path.abspath(open_tmp_directory())
+  filename = os.path.join(tmp_dir, 'headers.mtz')
+  make_unmerged_mtz(filename, blank=[])
+  original = mtz.object(filename)
+  original.add_history(['BATCH 3 in the history', 'MTZBATS too'])
+  original.write(filename)
+  original = mtz.object(filename)
+
+  remove_batch_headers(filename, [3, 4, 17, 30])
+  removed = mtz.object(filename)
+  assert batch_headers(removed) == [
+    (num, title) for num, title in batch_headers(original)
+    if not num in (3, 4, 17, 30)]
+  assert removed.n_batches() == 26
+  assert list(removed.history()) == list(original.history())
+  assert removed.n_reflections() == original.n_reflections()
+  for label in 'H', 'K', 'L', 'M_ISYM', 'BATCH', 'I', 'SIGI':
+    assert list(removed.get_column(label).extract_values()) == \
+      list(original.get_column(label).extract_values()), label
+  print 'OK'
+
+def run():
+  exercise_remove_blank()
+  exercise_remove_batch_headers()
+
+if __name__ == '__main__':
+  run()
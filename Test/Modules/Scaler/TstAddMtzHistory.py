@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division
+
+import os
+
+from libtbx.test_utils import open_tmp_directory
+
+def make_mtz(filename, history=None):
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  cs = crystal.symmetry(unit_cell=(40, 50, 60, 90, 90, 90),
+                        space_group_symbol='P 21 21 21')
+  ms = miller.build_set(cs, anomalous_flag=False, d_min=3)
+  intensities = miller.array(
+    ms, data=flex.double(range(ms.size())),
+    sigmas=flex.double(ms.size(), 1.5)).set_observation_type_xray_intensity()
+  mtz_object = intensities.as_mtz_dataset(column_root_label='I').mtz_object()
+  if history:
+    mtz_object.add_history(history)
+  mtz_object.write(file_name=filename)
+
+  from iotbx import mtz
+  return mtz.object(file_name=filename)
+
+def history(mtz_object):
+  return [line.strip() for line in mtz_object.history()]
+
+def assert_same_reflections(a, b):
+  assert a.n_reflections() == b.n_reflections()
+  assert list(a.column_labels()) == list(b.column_labels())
+  assert list(a.extract_miller_indices()) == list(b.extract_miller_indices())
+  for label in a.column_labels():
+    assert list(a.get_column(label).extract_values()) == \
+      list(b.get_column(label).extract_values()), label
+  assert a.space_group() == b.space_group()
+  for ca, cb in zip(a.crystals(), b.crystals()):
+    assert ca.unit_cell().is_similar_to(cb.unit_cell())
+
+def exercise_add_mtz_history():
+  from iotbx import mtz
+  from xia2.Modules.Scaler.tools import add_mtz_history
+
+  tmp_dir = os.path.abspath(open_tmp_directory())
+
+  # a file with a history, stamped twice
+
+  filename = os.path.join(tmp_dir, 'history.mtz')
+  original = make_mtz(filename, history=['old line one', 'old line two'])
+  assert history(original)[:2] == ['old line one', 'old line two']
+
+  add_mtz_history(filename, ['From xia2', 'second line'])
+  stamped = mtz.object(file_name=filename)
+  assert history(stamped) == ['From xia2', 'second line'] + history(original)
+  assert_same_reflections(original, stamped)
+
+  add_mtz_history(filename, ['again'])
+  stamped = mtz.object(file_name=filename)
+  assert history(stamped) == \
+    ['again', 'From xia2', 'second line'] + history(original)
+  assert_same_reflections(original, stamped)
+
+  # a file without one
+
+  filename = os.path.join(tmp_dir, 'no_history.mtz')
+  original = make_mtz(filename)
+  add_mtz_history(filename, ['From xia2'])
+  stamped = mtz.object(file_name=filename)
+  assert history(stamped) == ['From xia2'] + history(original)
+  assert_same_reflections(original, stamped)
+
+  print 'OK'
+
+def run():
+  exercise_add_mtz_history()
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division
+import math
+
+from libtbx.test_utils import approx_equal
+
+from xia2.Modules.DeltaCcHalf import leave_one_out_cc_half
+
+class recorded_split(leave_one_out_cc_half):
+  '''leave_one_out_cc_half keeping the random halves of the observations,
+  so that the half_dataset CC1/2 may be computed again from them.'''
+
+  def _split(self, refl, n_refl):
+    self.halves = leave_one_out_cc_half._split(refl, n_refl)
+    return self.halves
+
+def synthetic_groups(n_groups=6, n_obs=600, seed=0):
+  '''Return groups of random unmerged intensities, with the indices of
+  random symmetry equivalents and Friedel mates, measuring a true intensity
+  for each unique reflection with noise.'''
+
+  import random
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  random.seed(seed)
+  cs = crystal.symmetry(unit_cell=(40, 50, 60, 90, 90, 90),
+                        space_group_symbol='P 21 21 21')
+  p1 = miller.build_set(cs, anomalous_flag=True, d_min=4).expand_to_p1()
+  asu = miller.set(cs, p1.indices(), anomalous_flag=False).map_to_asu()
+  true = dict((h, random.uniform(10, 1000)) for h in asu.indices())
+
+  groups = []
+  for j in range(n_groups):
+    sel = flex.size_t([random.randrange(p1.size()) for k in range(n_obs)])
+    ms = miller.set(cs, p1.indices().select(sel), anomalous_flag=False)
+    sigmas = flex.double([random.uniform(1, 20) for k in range(n_obs)])
+    data = flex.double([random.gauss(true[asu.indices()[k]], sigma)
+                        for k, sigma in zip(sel, sigmas)])
+    groups.append(miller.array(ms, data=data, sigmas=sigmas))
+  return groups
+
+def direct_cc_one_half(groups, n_bins, method, halves=None, exclude=None):
+  '''CC1/2 for the groups but exclude, computed from scratch with loops
+  over the observations of each reflection, in the resolution shells chosen
+  from the observations of all of the groups and with the observations
+  (in order over all of the groups) in the given halves.'''
+
+  observations = []
+  for j, unmerged in enumerate(groups):
+    unmerged = unmerged.map_to_asu()
+    observations.extend(
+      (j, h, i, sigma, d) for h, i, sigma, d in zip(
+        unmerged.indices(), unmerged.data(), unmerged.sigmas(),
+        unmerged.d_spacings().data()))
+  if halves is None:
+    halves = [None] * len(observations)
+
+  # the shells, with equal numbers of observations
+
+  d_all = sorted((d for j, h, i, sigma, d in observations), reverse=True)
+  limits = [d_all[(k * len(d_all)) // n_bins] for k in range(1, n_bins)]
+
+  reflections = { }
+  for (j, h, i, sigma, d), half in zip(observations, halves):
+    if j != exclude:
+      reflections.setdefault(h, []).append((i, sigma, d, half))
+
+  shells = [[] for k in range(n_bins)]
+  for h in reflections:
+    measured = reflections[h]
+    shell = len([limit for limit in limits if limit >= measured[0][2]])
+
+    if method == 'sigma_tau':
+      if len(measured) < 2:
+        continue
+      sum_w = sum(1 / sigma ** 2 for i, sigma, d, half in measured)
+      y = sum(i / sigma ** 2 for i, sigma, d, half in measured) / sum_w
+      var_e = sum((i - y) ** 2 / sigma ** 2
+                  for i, sigma, d, half in measured) / (
+        (len(measured) - 1) * sum_w)
+      shells[shell].append((y, var_e))
+
+    else:
+      first = [i for i, sigma, d, half in measured if half == 0]
+      second = [i for i, sigma, d, half in measured if half == 1]
+      if first and second:
+        shells[shell].append((sum(first) / len(first),
+                              sum(second) / len(second)))
+
+  cc = []
+  weights = []
+  for values in shells:
+    n = len(values)
+    if n < 2:
+      continue
+    if method == 'sigma_tau':
+      mean_y = sum(y for y, var_e in values) / n
+      var_y = sum((y - mean_y) ** 2 for y, var_e in values) / (n - 1)
+      var_e = sum(var_e for y, var_e in values) / n
+      cc.append((var_y - var_e) / (var_y + var_e))
+    else:
+      mean_1 = sum(y1 for y1, y2 in values) / n
+      mean_2 = sum(y2 for y1, y2 in values) / n
+      s12 = sum((y1 - mean_1) * (y2 - mean_2) for y1, y2 in values)
+      s11 = sum((y1 - mean_1) ** 2 for y1, y2 in values)
+      s22 = sum((y2 - mean_2) ** 2 for y1, y2 in values)
+      cc.append(s12 / math.sqrt(s11 * s22))
+    weights.append(n)
+
+  return sum(c * w for c, w in zip(cc, weights)) / sum(weights)
+
+def exercise_leave_one_out():
+  groups = synthetic_groups()
+
+  for method in ('sigma_tau', 'half_dataset'):
+    cc_half = recorded_split(groups, n_bins=8, cc_one_half_method=method)
+    halves = getattr(cc_half, 'halves', None)
+    assert cc_half.n_groups == len(groups)
+
+    cc_all = cc_half.cc_one_half()
+    assert 0.5 < cc_all < 1, cc_all
+    assert approx_equal(
+      cc_all, direct_cc_one_half(groups, 8, method, halves), eps=1e-8)
+
+    for j in range(len(groups)):
+      assert approx_equal(
+        cc_half.cc_one_half(exclude=j),
+        direct_cc_one_half(groups, 8, method, halves, exclude=j),
+        eps=1e-8), (method, j)
+  print 'OK'
+
+def run():
+  exercise_leave_one_out()
+
+if __name__ == '__main__':
+  run()
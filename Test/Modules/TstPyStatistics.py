@@ -0,0 +1,286 @@
+from __future__ import absolute_import, division
+import math
+
+from cctbx.array_family import flex
+from libtbx.test_utils import approx_equal
+
+from xia2.Modules.PyChef2.PyChef import PyStatistics, unmerged_observations
+
+class LoopStatistics(PyStatistics):
+  '''PyStatistics with the accumulators computed by the original loops over
+  the observation groups of each unique reflection, for comparison.'''
+
+  def _calc_completeness_vs_dose(self):
+
+    # as PyStatistics.__init__ did, before the accumulators were vectorised
+    self.observations = unmerged_observations(self.intensities)
+
+    iplus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
+    iminus_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
+    ieither_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
+    iboth_count = [flex.double(self.n_steps, 0) for i in xrange(self.n_bins)]
+
+    for h_uniq, observed in self.observations:
+      #if observed.is_minus():
+        #continue
+
+      #irefs = list(observed.irefs)
+      dose_min_iplus = self.range_max + self.range_width
+      dose_min_iminus = self.range_max + self.range_width
+
+      if observed.iplus.size():
+        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
+      else:
+        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
+
+      if i_bin < 0:
+        continue
+
+      for i, i_ref in enumerate(observed.iplus):
+        dose_i = self.dose[i_ref]
+        dose_min_iplus = min(dose_i, dose_min_iplus)
+        if observed.is_centric():
+          dose_min_iminus = min(dose_i, dose_min_iminus)
+
+      for i, i_ref in enumerate(observed.iminus):
+        assert i_ref not in observed.iplus
+        dose_i = self.dose[i_ref]
+        dose_min_iminus = min(dose_i, dose_min_iminus)
+
+      start_iplus = int((dose_min_iplus - self.range_min)/self.range_width)
+      start_iminus = int((dose_min_iminus - self.range_min)/self.range_width)
+
+      if start_iplus < self.n_steps:
+        iplus_count[i_bin][start_iplus] += 1
+      if start_iminus < self.n_steps:
+        iminus_count[i_bin][start_iminus] += 1
+      if min(start_iplus, start_iminus) < self.n_steps:
+        ieither_count[i_bin][min(start_iplus, start_iminus)] += 1
+      if max(start_iplus, start_iminus) < self.n_steps:
+        iboth_count[i_bin][max(start_iplus, start_iminus)] += 1
+
+    # now accumulate as a function of time
+
+    for i_bin in xrange(self.n_bins):
+      for j in range(1, self.n_steps):
+        iplus_count[i_bin][j] += iplus_count[i_bin][j - 1]
+        iminus_count[i_bin][j] += iminus_count[i_bin][j - 1]
+        ieither_count[i_bin][j] += ieither_count[i_bin][j - 1]
+        iboth_count[i_bin][j] += iboth_count[i_bin][j - 1]
+
+    # accumulate as a function of dose and resolution
+
+    iplus_comp_overall = flex.double(self.n_steps, 0)
+    iminus_comp_overall = flex.double(self.n_steps, 0)
+    ieither_comp_overall = flex.double(self.n_steps, 0)
+    iboth_comp_overall = flex.double(self.n_steps, 0)
+
+    binner_non_anom = self.intensities.as_non_anomalous_array().use_binning(
+      self.binner)
+    n_complete = binner_non_anom.counts_complete()[1:-1]
+
+    for i_bin in xrange(self.n_bins):
+      iplus_comp_overall += iplus_count[i_bin]
+      iminus_comp_overall += iminus_count[i_bin]
+      ieither_comp_overall += ieither_count[i_bin]
+      iboth_comp_overall += iboth_count[i_bin]
+
+      iplus_count[i_bin] /= n_complete[i_bin]
+      iminus_count[i_bin] /= n_complete[i_bin]
+      ieither_count[i_bin] /= n_complete[i_bin]
+      iboth_count[i_bin] /= n_complete[i_bin]
+
+    tot_n_complete = sum(n_complete)
+    iplus_comp_overall /= tot_n_complete
+    iminus_comp_overall /= tot_n_complete
+    ieither_comp_overall /= tot_n_complete
+    iboth_comp_overall /= tot_n_complete
+
+    self.iplus_comp_bins = iplus_count
+    self.iminus_comp_bins = iminus_count
+    self.ieither_comp_bins = ieither_count
+    self.iboth_comp_bins = iboth_count
+    self.iplus_comp_overall = iplus_comp_overall
+    self.iminus_comp_overall = iminus_comp_overall
+    self.ieither_comp_overall = ieither_comp_overall
+    self.iboth_comp_overall = iboth_comp_overall
+
+  def _calc_rcp_scp(self):
+
+    A = [[0] * self.n_steps for i in xrange(self.n_bins)]
+    B = [[0] * self.n_steps for i in xrange(self.n_bins)]
+    isigma = [[0] * self.n_steps for i in xrange(self.n_bins)]
+    count = [[0] * self.n_steps for i in xrange(self.n_bins)]
+
+    intensities_data = self.intensities.data()
+    sigmas = self.intensities.sigmas()
+
+    def accumulate(irefs, i_bin):
+      if i_bin < 0:
+        return
+      for i, i_ref in enumerate(irefs):
+        dose_i = self.dose[i_ref]
+        I_i = intensities_data[i_ref]
+        sigi_i = sigmas[i_ref]
+        for j, j_ref in enumerate(irefs[i+1:]):
+          I_j = intensities_data[j_ref]
+          sigi_j = sigmas[j_ref]
+          A_part = math.fabs(I_i - I_j)
+          B_part = 0.5 * math.fabs(I_i + I_j)
+          dose_j = self.dose[j_ref]
+          dose_0 = int((max(dose_i, dose_j) - self.range_min)/self.range_width)
+          A[i_bin][dose_0] += A_part
+          B[i_bin][dose_0] += B_part
+          isigma[i_bin][dose_0] += ((I_i/sigi_i) + (I_j/sigi_j))
+          count[i_bin][dose_0] += 2
+
+    for h_uniq, observed in self.observations:
+      if len(observed.iplus) > 1:
+        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iplus[0]]) - 1
+        accumulate(list(observed.iplus), i_bin)
+      if len(observed.iminus) > 1:
+        i_bin = self.binner.get_i_bin(self.d_star_sq[observed.iminus[0]]) - 1
+        accumulate(list(observed.iminus), i_bin)
+
+    # now accumulate as a function of time
+
+    for i_bin in xrange(self.n_bins):
+      for j in xrange(1, self.n_steps):
+        A[i_bin][j] += A[i_bin][j-1]
+        B[i_bin][j] += B[i_bin][j-1]
+        isigma[i_bin][j] += isigma[i_bin][j-1]
+        count[i_bin][j] += count[i_bin][j-1]
+
+    # accumulate as a function of dose and resolution
+
+    rcp_overall = flex.double(self.n_steps, 0)
+    rcp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
+    scp_overall = flex.double(self.n_steps, 0)
+    scp_bins = [flex.double(self.n_steps, 0) for i in range(self.n_bins)]
+
+    for j in xrange(self.n_steps):
+
+      for i_bin in xrange(self.n_bins):
+        top = A[i_bin][j]
+        bottom = B[i_bin][j]
+
+        rcp = 0.0
+        scp = 0.
+
+        if bottom > 0:
+          rcp = top/bottom
+          if count[i_bin][j] > 100:
+            isig = isigma[i_bin][j] / count[i_bin][j]
+            scp = rcp / (1.1284 / isig)
+
+          rcp_bins[i_bin][j] = rcp
+          scp_bins[i_bin][j] = scp
+
+      ot = sum(A[i_bin][j] for i_bin in xrange(self.n_bins))
+      ob = sum(B[i_bin][j] for i_bin in xrange(self.n_bins))
+
+      if ob > 0:
+        overall = ot/ob
+      else:
+        overall = 0.
+      rcp_overall[j] = overall
+
+      scp_overall[j] = sum(scp_bins[i_bin][j] for i_bin in xrange(self.n_bins))/self.n_bins
+
+    self.rcp_bins = rcp_bins
+    self.rcp = rcp_overall
+    self.scp_bins = scp_bins
+    self.scp = scp_overall
+
+  def _calc_rd(self):
+
+    rd_top = [0] * self.n_steps
+    rd_bottom = [0] * self.n_steps
+
+    intensities_data = self.intensities.data()
+
+    for h_uniq, observed in self.observations:
+      irefs = list(observed.iplus) + list(observed.iminus)
+      if len(irefs) == 1:
+        # lone observation, no pairs
+        continue
+      for i, i_ref in enumerate(irefs):
+        dose_i = self.dose[i_ref]
+        I_i = intensities_data[i_ref]
+        for j, j_ref in enumerate(irefs[i+1:]):
+          I_j = intensities_data[j_ref]
+          dose_j = self.dose[j_ref]
+          d_dose = int(
+            round(math.fabs(dose_i - dose_j) - self.range_min)/self.range_width)
+          rd_top[d_dose] += math.fabs(I_i - I_j)
+          rd_bottom[d_dose] += 0.5 * (I_i + I_j)
+
+    self.rd = flex.double(rd_top[i]/rd_bottom[i] if rd_bottom[i] > 0 else 0
+                          for i in xrange(self.n_steps))
+
+def synthetic_intensities(anomalous_flag, n_obs=4000, seed=0):
+  '''Return random unmerged intensities, with the indices of random
+  symmetry equivalents and Friedel mates, and random integer doses.'''
+
+  import random
+  from cctbx import crystal, miller
+  from cctbx.array_family import flex
+
+  random.seed(seed)
+  cs = crystal.symmetry(unit_cell=(40, 50, 60, 90, 90, 90),
+                        space_group_symbol='P 21 21 21')
+  p1 = miller.build_set(cs, anomalous_flag=True, d_min=3.5).expand_to_p1()
+  sel = flex.size_t([random.randrange(p1.size()) for j in range(n_obs)])
+  ms = miller.set(cs, p1.indices().select(sel), anomalous_flag=anomalous_flag)
+
+  data = flex.double([random.gauss(100, 30) for j in range(n_obs)])
+  sigmas = flex.double([random.uniform(1, 10) for j in range(n_obs)])
+  intensities = miller.array(ms, data=data, sigmas=sigmas)
+  dose = flex.int([random.randint(1, 25) for j in range(n_obs)])
+  return intensities, dose
+
+def compare(a, b):
+  for name in ('iplus_comp_bins', 'iminus_comp_bins', 'ieither_comp_bins',
+               'iboth_comp_bins', 'rcp_bins', 'scp_bins'):
+    for bin_a, bin_b in zip(getattr(a, name), getattr(b, name)):
+      assert approx_equal(list(bin_a), list(bin_b), eps=1e-8), name
+  for name in ('iplus_comp_overall', 'iminus_comp_overall',
+               'ieither_comp_overall', 'iboth_comp_overall',
+               'rcp', 'scp', 'rd'):
+    assert approx_equal(list(getattr(a, name)), list(getattr(b, name)),
+                        eps=1e-8), name
+
+def exercise_loops_vs_arrays():
+  for anomalous_flag in (True, False):
+    intensities, dose = synthetic_intensities(anomalous_flag)
+    loops = LoopStatistics(intensities, dose, n_bins=4)
+    arrays = PyStatistics(intensities, dose, n_bins=4)
+    compare(loops, arrays)
+
+    # a dose range narrower than the doses observed
+    loops = LoopStatistics(intensities, dose, n_bins=4,
+                           range_min=5, range_max=20, range_width=2)
+    arrays = PyStatistics(intensities, dose, n_bins=4,
+                          range_min=5, range_max=20, range_width=2)
+    compare(loops, arrays)
+  print 'OK'
+
+def exercise_unique_miller_indices():
+  import numpy
+  from xia2.Toolkit.MillerIndexGroups import unique_miller_indices
+
+  # indices of 512 and more must not be merged with others
+  hkl = numpy.array([(0, 0, 0), (0, 0, 1024), (0, 1, -512), (0, 0, 512),
+                     (0, 0, 1024), (-2000, 3, 0), (0, 0, 0)])
+  unique_hkl, inverse = unique_miller_indices(hkl)
+  assert len(unique_hkl) == 5
+  assert (unique_hkl[inverse] == hkl).all()
+  assert list(inverse) == [1, 3, 4, 2, 3, 0, 1]
+  print 'OK'
+
+def run():
+  exercise_unique_miller_indices()
+  exercise_loops_vs_arrays()
+
+if __name__ == '__main__':
+  run()
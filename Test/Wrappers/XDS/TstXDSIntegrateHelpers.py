@@ -0,0 +1,157 @@
+from __future__ import absolute_import, division
+
+import os
+import random
+import tempfile
+
+from xia2.Wrappers.XDS.XDSIntegrateHelpers import _wedge_ranges, \
+  _stitch_integrate_hkl
+
+header = '''!OUTPUT_FILE=INTEGRATE.HKL    DATE=18-Oct-2016
+!Generated by INTEGRATE   (VERSION Nov 1, 2016)
+!DATA_RANGE=%6d%6d
+!NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD=21
+!H,K,L,IOBS,SIGMA,XCAL,YCAL,ZCAL,RLP,PEAK,CORR,MAXC,
+!             XOBS,YOBS,ZOBS,ALF0,BET0,ALF1,BET1,PSI,ISEG
+!END_OF_HEADER
+'''
+
+def record(h, zcal):
+  '''An INTEGRATE.HKL record for reflection (h, 0, 0) at zcal.'''
+
+  return '%6d%6d%6d %10.3E %10.3E %7.1f %7.1f %9.3f %9.5f %4d %3d %4d' \
+         ' %7.1f %7.1f %8.1f %7.2f %7.2f %7.2f %7.2f %7.2f %3d\n' % (
+           h, 0, 0, 100.0, 10.0, 1000.0, 1000.0, zcal, 1.0, 100, 90, 50,
+           1000.0, 1000.0, zcal, 0.1, 0.2, 0.3, 0.4, 5.0, 1)
+
+def write_integrate_hkl(filename, data_range, records):
+  with open(filename, 'wb') as f:
+    f.write(header % data_range)
+    f.writelines(records)
+    f.write('!END_OF_DATA\n')
+
+def exercise_wedge_ranges():
+  # wedges of whole blocks, integrated with the overlap either side except
+  # at the ends of the sweep
+
+  assert _wedge_ranges(1, 90, 30, 5, 3) == [
+    ((1, 30), (1, 33)), ((31, 60), (28, 63)), ((61, 90), (58, 90))]
+  assert _wedge_ranges(11, 100, 30, 5, 20) == [
+    ((11, 40), (11, 60)), ((41, 70), (21, 90)), ((71, 100), (51, 100))]
+
+  # the wedge size is rounded to whole blocks
+  assert _wedge_ranges(1, 90, 32, 5, 0) == _wedge_ranges(1, 90, 30, 5, 0)
+  assert _wedge_ranges(1, 90, 28, 5, 0) == _wedge_ranges(1, 90, 30, 5, 0)
+  assert _wedge_ranges(1, 10, 3, 0, 0) == _wedge_ranges(1, 10, 3, 1, 0)
+
+  # a short final wedge is merged into the one before, a longer one kept
+  assert _wedge_ranges(1, 100, 30, 5, 0) == [
+    ((1, 30), (1, 30)), ((31, 60), (31, 60)), ((61, 100), (61, 100))]
+  assert _wedge_ranges(1, 110, 30, 5, 0) == [
+    ((1, 30), (1, 30)), ((31, 60), (31, 60)), ((61, 90), (61, 90)),
+    ((91, 110), (91, 110))]
+
+  # a sweep shorter than a wedge is a single wedge
+  assert _wedge_ranges(1, 20, 30, 5, 3) == [((1, 20), (1, 20))]
+  assert _wedge_ranges(1, 40, 30, 5, 3) == [((1, 40), (1, 40))]
+
+  # in general the owned images tile the sweep, and the images integrated
+  # cover them and the overlap, within the sweep
+  for first, last, wedge, block, overlap in [
+    (1, 360, 45, 1, 5), (5, 724, 90, 4, 8), (1, 1800, 200, 10, 0),
+    (101, 150, 10, 3, 50)]:
+    wedges = _wedge_ranges(first, last, wedge, block, overlap)
+    assert wedges[0][0][0] == first
+    assert wedges[-1][0][1] == last
+    for ((start, end), (i_start, i_end)), next_wedge in zip(
+      wedges, wedges[1:] + [None]):
+      if next_wedge is not None:
+        assert next_wedge[0][0] == end + 1
+        assert (end + 1 - start) % max(1, block) == 0
+      assert i_start == max(first, start - overlap)
+      assert i_end == min(last, end + overlap)
+  print 'OK'
+
+def exercise_stitch_integrate_hkl():
+  random.seed(0)
+  tmp_dir = tempfile.mkdtemp()
+
+  # reflections all through the sweep, with some on the boundaries of the
+  # images and some predicted just outside the sweep
+
+  first, last = 1, 90
+  zcal = [random.uniform(first - 1, last) for j in range(2000)]
+  zcal += [float(z) for z in range(first - 1, last + 1)]
+  zcal += [z - 0.001 for z in range(first, last + 1)]
+  zcal += [first - 1.2, first - 1.001, last + 0.001, last + 0.4]
+  reflections = sorted((z, j + 1) for j, z in enumerate(zcal))
+
+  wedges = _wedge_ranges(first, last, 30, 5, 3)
+
+  # each wedge has the reflections on the images it integrates, those on
+  # the overlaps in two of them, and those beyond the sweep at its ends
+
+  files = []
+  for j, ((start, end), (i_start, i_end)) in enumerate(wedges):
+    records = []
+    for z, h in reflections:
+      if (z >= i_start - 1 or j == 0) and \
+         (z <= i_end or j == len(wedges) - 1):
+        records.append(record(h, z))
+    filename = os.path.join(tmp_dir, 'INTEGRATE-%d.HKL' % j)
+    write_integrate_hkl(filename, (i_start, i_end), records)
+    files.append((filename, (start, end)))
+
+  hklout = os.path.join(tmp_dir, 'INTEGRATE.HKL')
+  _stitch_integrate_hkl(files, hklout, (first, last))
+
+  lines = open(hklout, 'rb').readlines()
+  expected_header = (header % (first, last)).splitlines(True)
+  assert lines[:len(expected_header)] == expected_header
+  assert lines[-1] == '!END_OF_DATA\n'
+  body = lines[len(expected_header):-1]
+
+  # every reflection once, in order, from the wedge owning its ZCAL, and
+  # the records copied unchanged
+
+  assert body == [record(h, z) for z, h in reflections]
+
+  from xia2.Modules.XDSReflections import read_xds_reflections
+  stitched = read_xds_reflections(hklout)
+  h = list(stitched.get('hkl')[:, 0])
+  assert sorted(h) == range(1, len(zcal) + 1)
+
+  source = { }
+  for j, (filename, (start, end)) in enumerate(files):
+    for line in open(filename, 'rb'):
+      if not line.startswith('!'):
+        source.setdefault(line, []).append(j)
+  for line, z in zip(body, stitched.get_column('ZCAL')):
+    owner = [j for j, ((start, end), integrated) in enumerate(wedges)
+             if (z >= start - 1 or j == 0) and
+             (z < end or j == len(wedges) - 1)]
+    assert len(owner) == 1, z
+    assert owner[0] in source[line], z
+  print 'OK'
+
+def exercise_stitch_errors():
+  # a record with missing values is not silently read as another
+  tmp_dir = tempfile.mkdtemp()
+  filename = os.path.join(tmp_dir, 'INTEGRATE-0.HKL')
+  write_integrate_hkl(filename, (1, 10), [
+    record(1, 0.5), ' '.join(record(2, 1.5).split()[:-1]) + '\n'])
+  try:
+    _stitch_integrate_hkl([(filename, (1, 10))],
+                          os.path.join(tmp_dir, 'INTEGRATE.HKL'), (1, 10))
+    assert False
+  except RuntimeError, e:
+    assert 'error reading' in str(e)
+  print 'OK'
+
+def run():
+  exercise_wedge_ranges()
+  exercise_stitch_integrate_hkl()
+  exercise_stitch_errors()
+
+if __name__ == '__main__':
+  run()
@@ -26,9 +26,9 @@
 
 import math
 import sys
-import binascii
 
-from xia2.Modules.UnpackByteOffset import unpack_values, pack_values
+from xia2.Modules.UnpackByteOffset import read_cbf, write_cbf, \
+     transform_images
 
 def mmcc(ds, xs, ys):
   '''Fit a straight line
@@ -262,53 +262,52 @@ def calculate_mask_mosflm(self, header):
     return tuple([self.to_mosflm_frame(header, p) \
                   for p in self.calculate_mask(header)])
 
-  def apply_mask_xds(self, header, cbf_in, cbf_out):
-    '''Apply the calculated backstop mask to a BKGINIT.cbf - do this
-    immediately after the INIT step.'''
+  def mask_pixels(self, header):
+    '''Return the indices in the image array of the pixels within the
+    backstop region.'''
 
     r = self.rectangle(header)
+    fast = int(header['size'][0])
 
-    data = open(cbf_in, 'rb').read()
+    # or perhaps mask it out a little more cleverly
 
-    start_tag = binascii.unhexlify('0c1a04d5')
+    limits = r.limits()
 
-    data_offset = data.find(start_tag) + 4
+    pixels = []
 
-    cbf_header = data[:data.find(start_tag)]
+    for x in range(int(limits[0]), int(limits[1]) + 1):
+      for y in range(int(limits[2]), int(limits[3]) + 1):
+        if r.is_inside((x + 0.5, y + 0.5)):
+          pixels.append(y * fast + x)
+
+    return pixels
 
-    fast = 0
-    slow = 0
-    length = 0
+  def apply_mask_xds(self, header, cbf_in, cbf_out):
+    '''Apply the calculated backstop mask to a BKGINIT.cbf - do this
+    immediately after the INIT step.'''
 
-    for record in cbf_header.split('\n'):
-      if 'X-Binary-Size-Fastest-Dimension' in record:
-        fast = int(record.split()[-1])
-      elif 'X-Binary-Size-Second-Dimension' in record:
-        slow = int(record.split()[-1])
-      elif 'X-Binary-Number-of-Elements' in record:
-        length = int(record.split()[-1])
+    cbf_header, values, (fast, slow), trailer = read_cbf(cbf_in)
 
-    assert(length == fast * slow)
     assert(fast == int(header['size'][0]))
     assert(slow == int(header['size'][1]))
 
-    values = unpack_values(data[data_offset:], length)
-
-    # or perhaps mask it out a little more cleverly
+    values[self.mask_pixels(header)] = -3
 
-    limits = r.limits()
+    # and write out the updated file
 
-    for x in range(int(limits[0]), int(limits[1]) + 1):
-      for y in range(int(limits[2]), int(limits[3]) + 1):
-        j = y * fast + x
-        if r.is_inside((x + 0.5, y + 0.5)):
-          values[j] = -3
+    write_cbf(cbf_out, cbf_header, values, trailer)
 
-    # and write out the updated file
+    return
 
-    result = cbf_header + start_tag + pack_values(values)
+  def apply_mask_images(self, header, images, output_directory, nproc=None):
+    '''Apply the calculated backstop mask to a sweep of CBF images, writing
+    the masked images to output_directory, with the images read, masked
+    and written in a pool of nproc processes.'''
 
-    open(cbf_out, 'w').write(result)
+    for image in transform_images(images, output_directory,
+                                  set_pixels(self.mask_pixels(header), -3),
+                                  nproc=nproc):
+      pass
 
     return
 
@@ -326,6 +325,20 @@ def rectangle(self, header):
 
     return rectangle(p1, p2, p3, p4)
 
+class set_pixels(object):
+  '''Set the given pixels in an image to value - a picklable function for
+  transform_images().'''
+
+  def __init__(self, pixels, value):
+    self._pixels = pixels
+    self._value = value
+
+    return
+
+  def __call__(self, values):
+    values[self._pixels] = self._value
+    return values
+
 class rectangle(object):
   '''A class to represent a rectange.'''
 
@@ -35,8 +35,11 @@
 import itertools
 import copy
 
+import numpy
+
 from cctbx.array_family import flex
 from iotbx import mtz
+from cctbx import miller
 from cctbx.miller import build_set
 from cctbx.miller import map_to_asu
 from cctbx.crystal import symmetry as crystal_symmetry
@@ -221,17 +224,224 @@ def ism(x): return not x[0] % 2
 
     return result
 
+class columnar_intensities(object):
+  '''A columnar representation of a set of unmerged observations: typed
+  numpy arrays of h, k, l, M_ISYM, I, SIGI and batch sorted by Miller index,
+  with the offsets of the contiguous run of observations belonging to each
+  unique reflection (i.e. in CSR layout). All of the per-reflection
+  quantities computed by the unmerged_intensity class are computed here as
+  grouped reductions over these runs. Instances are not modified once
+  constructed: scaling, selecting, reindexing and accumulating observations
+  return a new instance.'''
+
+  def __init__(self, hkl, m_isym, i, sigi, b, presorted = False):
+    hkl = numpy.asarray(hkl, dtype = numpy.int32).reshape(-1, 3)
+    m_isym = numpy.asarray(m_isym, dtype = numpy.int32)
+    i = numpy.asarray(i, dtype = numpy.float64)
+    sigi = numpy.asarray(sigi, dtype = numpy.float64)
+    b = numpy.asarray(b, dtype = numpy.float64)
+
+    # sort permutation by Miller index, stable so that observations of
+    # a given reflection keep the order in which they were read - unless
+    # derived from an instance which was already sorted
+
+    if presorted:
+      self.hkl, self.m_isym, self.i, self.sigi, self.b = \
+        hkl, m_isym, i, sigi, b
+    else:
+      perm = numpy.lexsort((hkl[:, 2], hkl[:, 1], hkl[:, 0]))
+      self.hkl = hkl[perm]
+      self.m_isym = m_isym[perm]
+      self.i = i[perm]
+      self.sigi = sigi[perm]
+      self.b = b[perm]
+
+    n = len(self.i)
+
+    if n:
+      change = numpy.any(self.hkl[1:] != self.hkl[:-1], axis = 1)
+      starts = numpy.concatenate(([0], numpy.nonzero(change)[0] + 1))
+    else:
+      starts = numpy.zeros(0, dtype = numpy.int64)
+
+    self.offsets = numpy.concatenate((starts, [n])).astype(numpy.int64)
+    self.unique_hkl = self.hkl[starts]
+    self.multiplicity = numpy.diff(self.offsets)
+    self.group = numpy.repeat(
+        numpy.arange(len(starts), dtype = numpy.int32), self.multiplicity)
+
+    self._lookup = None
+    self._miller_indices = None
+    self._compute()
+
+    return
+
+  @staticmethod
+  def from_unmerged(unmerged_reflections):
+    '''Construct from a dictionary of unmerged_intensity objects keyed
+    by Miller index.'''
+
+    hkl = []
+    observations = []
+
+    for h in unmerged_reflections:
+      for o in unmerged_reflections[h].get():
+        hkl.append(h)
+        observations.append(o)
+
+    if not observations:
+      return columnar_intensities([], [], [], [], [])
+
+    m_isym, i, sigi, b = zip(*observations)
+    return columnar_intensities(hkl, m_isym, i, sigi, b)
+
+  def _reduce(self, values):
+    '''Sum values over the contiguous run of each unique reflection.'''
+
+    if not len(values):
+      return numpy.zeros(0, dtype = numpy.float64)
+    return numpy.add.reduceat(values, self.offsets[:-1])
+
+  def _compute(self):
+    '''Compute the merged and anomalous merged intensities and the per
+    reflection contributions to Rmerge and I/sigma.'''
+
+    w = 1.0 / (self.sigi * self.sigi)
+    wi = w * self.i
+    plus = (self.m_isym % 2).astype(bool)
+    minus = ~plus
+
+    sum_w = self._reduce(w)
+    self.i_mean = self._reduce(wi) / sum_w
+    self.sigi_mean = numpy.sqrt(1.0 / sum_w)
+
+    sum_w_p = self._reduce(numpy.where(plus, w, 0.0))
+    sum_w_m = self._reduce(numpy.where(minus, w, 0.0))
+    sum_wi_p = self._reduce(numpy.where(plus, wi, 0.0))
+    sum_wi_m = self._reduce(numpy.where(minus, wi, 0.0))
+
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+      self.i_mean_p = numpy.where(sum_w_p > 0, sum_wi_p / sum_w_p, 0.0)
+      self.sigi_mean_p = numpy.where(
+          sum_w_p > 0, numpy.sqrt(1.0 / sum_w_p), 0.0)
+      self.i_mean_m = numpy.where(sum_w_m > 0, sum_wi_m / sum_w_m, 0.0)
+      self.sigi_mean_m = numpy.where(
+          sum_w_m > 0, numpy.sqrt(1.0 / sum_w_m), 0.0)
+
+    self.multiplicity_p = self._reduce(plus.astype(numpy.int64))
+    self.multiplicity_m = self._reduce(minus.astype(numpy.int64))
+
+    i_mean_obs = self.i_mean[self.group]
+    self.rmerge = self._reduce(numpy.fabs(self.i - i_mean_obs))
+    self.rmerge_p = self._reduce(numpy.where(
+        plus, numpy.fabs(self.i - self.i_mean_p[self.group]), 0.0))
+    self.rmerge_m = self._reduce(numpy.where(
+        minus, numpy.fabs(self.i - self.i_mean_m[self.group]), 0.0))
+    self.isigma = self._reduce(self.i / self.sigi)
+    self.chisq = (self.i - i_mean_obs) / self.sigi
+
+    return
+
+  def size(self):
+    return len(self.multiplicity)
+
+  def concatenate(self, other):
+    '''Return the observations of this instance followed by those of
+    other.'''
+
+    return columnar_intensities(
+        numpy.concatenate((self.hkl, other.hkl)),
+        numpy.concatenate((self.m_isym, other.m_isym)),
+        numpy.concatenate((self.i, other.i)),
+        numpy.concatenate((self.sigi, other.sigi)),
+        numpy.concatenate((self.b, other.b)))
+
+  def scaled(self, scales):
+    '''Return the observations with the intensities and sigmas of each
+    unique reflection multiplied by the corresponding value in scales.'''
+
+    s = numpy.asarray(scales, dtype = numpy.float64)[self.group]
+
+    return columnar_intensities(self.hkl, self.m_isym, s * self.i,
+                                s * self.sigi, self.b, presorted = True)
+
+  def selected(self, keep):
+    '''Return the observations of the unique reflections for which the
+    corresponding value in keep is True.'''
+
+    sel = numpy.asarray(keep, dtype = bool)[self.group]
+
+    return columnar_intensities(self.hkl[sel], self.m_isym[sel], self.i[sel],
+                                self.sigi[sel], self.b[sel], presorted = True)
+
+  def reindexed(self, unique_hkl):
+    '''Return the observations with the Miller index of each unique
+    reflection replaced by the corresponding index in unique_hkl.'''
+
+    unique_hkl = numpy.asarray(unique_hkl, dtype = numpy.int32).reshape(-1, 3)
+
+    return columnar_intensities(unique_hkl[self.group], self.m_isym, self.i,
+                                self.sigi, self.b)
+
+  def miller_indices(self):
+    '''Return the unique Miller indices as a flex.miller_index.'''
+
+    if self._miller_indices is None:
+      self._miller_indices = flex.miller_index(
+          [tuple(int(x) for x in h) for h in self.unique_hkl])
+
+    return self._miller_indices
+
+  def _get_lookup(self):
+    if self._lookup is None:
+      self._lookup = dict((tuple(int(x) for x in h), j)
+                          for j, h in enumerate(self.unique_hkl))
+    return self._lookup
+
+  def contains(self, hkl):
+    return tuple(hkl) in self._get_lookup()
+
+  def groups(self, hkl_list = None):
+    '''Return the indices of the unique reflections in hkl_list, or of
+    all unique reflections if this is empty.'''
+
+    if not hkl_list:
+      return numpy.arange(self.size())
+
+    self._get_lookup()
+
+    return numpy.array([self._lookup[tuple(hkl)] for hkl in hkl_list],
+                       dtype = numpy.int64)
+
+  def observations(self, groups):
+    '''Return a selection of the observations belonging to groups.'''
+
+    selected = numpy.zeros(self.size(), dtype = bool)
+    selected[groups] = True
+    return selected[self.group]
+
+  def binned_sum(self, values, bins, nbins):
+    '''Sum per-reflection values into nbins bins in a single pass.'''
+
+    return numpy.bincount(bins, weights = values, minlength = nbins)
+
 class merger(object):
   '''A class to calculate things from merging reflections.'''
 
   def __init__(self, hklin):
 
     self._mf = mtz_file(hklin)
-    self._unmerged_reflections = { }
-    self._merged_reflections = { }
-    self._merged_reflections_anomalous = { }
+    self._engine = None
+    self._unmerged_reflections = None
+    self._merged_reflections = None
+    self._merged_reflections_anomalous = None
     self._unmerged_di = { }
 
+    self._hkl_ranges = None
+    self._resolution_ranges = None
+    self._bin_of_group = None
+    self._bin_engine = None
+
     all_columns = self._mf.get_column_names()
 
     assert('M_ISYM' in all_columns)
@@ -246,8 +456,6 @@ def __init__(self, hklin):
       raise RuntimeError, 'no baseline column (DOSE or BATCH) found'
 
     self._read_unmerged_reflections()
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
 
     # self._calculate_unmerged_di()
 
@@ -257,26 +465,14 @@ def debug_info(self):
     '''Pull out some information for debugging, namely total intensity,
     number of reflections &c.'''
 
-    n = 0
-    I = 0.0
-
-    for hkl in self._unmerged_reflections:
-      for o in self._unmerged_reflections[hkl].get():
-        n += 1
-        I += o[1]
+    engine = self._get_engine()
 
-    return n, I
+    return len(engine.i), float(numpy.sum(engine.i))
 
   def reload(self):
     '''Reload the reflection list &c.'''
 
-    self._unmerged_reflections = { }
-    self._merged_reflections = { }
-    self._merged_reflections_anomalous = { }
-
     self._read_unmerged_reflections()
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
 
     return
 
@@ -284,28 +480,13 @@ def accumulate(self, other_merger):
     '''Accumulate all of the measurements from another merger class
     instance.'''
 
-    # self._unmerged_reflections = { }
-    # self._merged_reflections = { }
-    # self._merged_reflections_anomalous = { }
-
-    # self._read_unmerged_reflections()
-
-    other_unmerged_reflections = other_merger.get_unmerged_reflections()
-
-    for hkl in other_unmerged_reflections:
-      if not hkl in self._unmerged_reflections:
-        self._unmerged_reflections[hkl] = unmerged_intensity()
-      for observation in other_unmerged_reflections[hkl].get():
-        m_isym, i, sigi, b = observation
-        self._unmerged_reflections[hkl].add(m_isym, i, sigi, b)
-
-    self._merge_reflections()
-    self._merge_reflections_anomalous()
+    self._set_engine(self._get_engine().concatenate(
+        other_merger._get_engine()))
 
     return
 
   def _read_unmerged_reflections(self):
-    '''Actually read the reflections in to memory.'''
+    '''Actually read the reflections in to memory, as columns.'''
 
     mi = self._mf.get_miller_indices()
     m_isym = self._mf.get_column_values('M_ISYM')
@@ -313,38 +494,70 @@ def _read_unmerged_reflections(self):
     sigi = self._mf.get_column_values('SIGI')
     b = self._mf.get_column_values(self._b_column)
 
-    for j in range(len(i)):
-      hkl = mi[j]
-      if not hkl in self._unmerged_reflections:
-        self._unmerged_reflections[hkl] = unmerged_intensity()
-      self._unmerged_reflections[hkl].add(
-          m_isym[j], i[j], sigi[j], b[j])
+    self._set_engine(columnar_intensities(
+        mi.as_vec3_double().as_numpy_array(), m_isym.as_numpy_array(),
+        i.as_numpy_array(), sigi.as_numpy_array(), b.as_numpy_array()))
+
+    return
+
+  def _set_engine(self, engine):
+    '''Replace the columnar representation of the observations, so that
+    any values derived from the previous observations are out of date.'''
+
+    self._engine = engine
+    self._unmerged_reflections = None
+    self._merged_reflections = None
+    self._merged_reflections_anomalous = None
 
     return
 
+  def _get_engine(self):
+    '''Return the columnar representation of the observations.'''
+
+    return self._engine
+
+  def _resolutions(self):
+    '''Return the resolution of every unique reflection.'''
+
+    engine = self._get_engine()
+
+    return self._mf.get_unit_cell().d(
+        engine.miller_indices()).as_numpy_array()
+
   def _merge_reflections(self):
     '''Merge the currently recorded unmerged reflections.'''
 
-    for hkl in self._unmerged_reflections:
-      self._merged_reflections[hkl] = self._unmerged_reflections[
-          hkl].merge()
+    engine = self._get_engine()
+
+    self._merged_reflections = { }
+
+    for j, hkl in enumerate(engine.miller_indices()):
+      self._merged_reflections[hkl] = (float(engine.i_mean[j]),
+                                       float(engine.sigi_mean[j]))
 
     return
 
   def _merge_reflections_anomalous(self):
     '''Merge the currently recorded unmerged reflections.'''
 
-    for hkl in self._unmerged_reflections:
-      self._merged_reflections_anomalous[
-          hkl] = self._unmerged_reflections[hkl].merge_anomalous()
+    engine = self._get_engine()
+
+    self._merged_reflections_anomalous = { }
+
+    for j, hkl in enumerate(engine.miller_indices()):
+      self._merged_reflections_anomalous[hkl] = (
+          float(engine.i_mean_p[j]), float(engine.sigi_mean_p[j]),
+          float(engine.i_mean_m[j]), float(engine.sigi_mean_m[j]))
 
     return
 
   def _calculate_unmerged_di(self):
     '''Calculate a set of unmerged intensity differences.'''
 
-    for hkl in self._unmerged_reflections:
-      self._unmerged_di[hkl] = self._unmerged_reflections[
+    unmerged_reflections = self.get_unmerged_reflections()
+
+    for hkl in unmerged_reflections:
+      self._unmerged_di[hkl] = unmerged_reflections[
           hkl].calculate_unmerged_di()
 
     return
@@ -353,23 +566,10 @@ def apply_kb(self, k, b):
     '''Apply kB scale factors to the recorded measurements, for all
     merged and unmerged observations.'''
 
-    for hkl in self._merged_reflections:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      i, sigi = self._merged_reflections[hkl]
-      self._merged_reflections[hkl] = (i * scale, sigi * scale)
-
-    for hkl in self._merged_reflections_anomalous:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      ip, sigip, im, sigim = self._merged_reflections_anomalous[hkl]
-      self._merged_reflections_anomalous[hkl] = (
-          ip * scale, sigip * scale, im * scale, sigim * scale)
+    d = self._resolutions()
 
-    for hkl in self._unmerged_reflections:
-      d = self.resolution(hkl)
-      scale = k * math.exp(-1 * b / (d * d))
-      self._unmerged_reflections[hkl].apply_scale(scale)
+    self._set_engine(self._get_engine().scaled(
+        k * numpy.exp(-1 * b / (d * d))))
 
     return
 
@@ -378,68 +578,49 @@ def reindex(self, reindex_operation):
 
     R = rt_mx(reindex_operation).inverse()
 
-    # first construct mapping table - native, anomalous
+    engine = self._get_engine()
 
-    map_native = { }
+    # first transform the unique Miller indices, then move the actual
+    # measurements with them
 
-    hkls = flex.miller_index()
+    r = numpy.array(R.r().as_double()).reshape(3, 3)
+    t = numpy.array(R.t().as_double())
 
-    for hkl in self._merged_reflections:
-      Fhkl = R * hkl
-      Rhkl = nint(Fhkl[0]), nint(Fhkl[1]), nint(Fhkl[2])
-      hkls.append(Rhkl)
+    Fhkl = numpy.dot(engine.unique_hkl, r.T) + t
+    Rhkl = numpy.sign(Fhkl) * numpy.floor(numpy.fabs(Fhkl) + 0.5)
 
+    hkls = flex.miller_index([tuple(int(x) for x in h) for h in Rhkl])
     map_to_asu(self._mf.get_space_group().type(), False, hkls)
 
-    for j, hkl in enumerate(self._merged_reflections):
-      map_native[hkl] = hkls[j]
-
-    map_anomalous = { }
-
-    hkls = flex.miller_index()
-
-    for hkl in self._merged_reflections_anomalous:
-      Fhkl = R * hkl
-      Rhkl = nint(Fhkl[0]), nint(Fhkl[1]), nint(Fhkl[2])
-      hkls.append(Rhkl)
-
-    map_to_asu(self._mf.get_space_group().type(), True, hkls)
-
-    for j, hkl in enumerate(self._merged_reflections_anomalous):
-      map_anomalous[hkl] = hkls[j]
-
-    # then remap the actual measurements
-
-    merged_reflections = { }
-
-    for hkl in self._merged_reflections:
-      Rhkl = map_native[hkl]
-      merged_reflections[Rhkl] = self._merged_reflections[hkl]
-
-    self._merged_reflections = merged_reflections
-
-    merged_reflections = { }
-
-    for hkl in self._merged_reflections_anomalous:
-      Rhkl = map_anomalous[hkl]
-      merged_reflections[Rhkl] = self._merged_reflections_anomalous[hkl]
-
-    self._merged_reflections_anomalous = merged_reflections
-
-    unmerged_reflections = { }
-
-    for hkl in self._unmerged_reflections:
-      Rhkl = map_native[hkl]
-      unmerged_reflections[Rhkl] = self._unmerged_reflections[hkl]
-
-    self._unmerged_reflections = unmerged_reflections
+    self._set_engine(engine.reindexed(
+        numpy.rint(hkls.as_vec3_double().as_numpy_array())))
 
     return
 
   def get_merged_reflections(self):
+    if self._merged_reflections is None:
+      self._merge_reflections()
     return self._merged_reflections
 
+  def get_merged_reflections_anomalous(self):
+    if self._merged_reflections_anomalous is None:
+      self._merge_reflections_anomalous()
+    return self._merged_reflections_anomalous
+
   def get_unmerged_reflections(self):
+    '''Return the observations as a dictionary of unmerged_intensity
+    objects keyed by Miller index - built from the columns on demand.'''
+
+    if self._unmerged_reflections is None:
+      engine = self._get_engine()
+      self._unmerged_reflections = { }
+      for j, hkl in enumerate(engine.miller_indices()):
+        u = unmerged_intensity()
+        for k in range(engine.offsets[j], engine.offsets[j + 1]):
+          u.add(int(engine.m_isym[k]), float(engine.i[k]),
+                float(engine.sigi[k]), float(engine.b[k]))
+        self._unmerged_reflections[hkl] = u
+
     return self._unmerged_reflections
 
   def resolution(self, hkl):
@@ -447,31 +628,45 @@ def resolution(self, hkl):
 
     return self._mf.get_unit_cell().d(hkl)
 
+  def _symmetry_flags(self):
+    '''Return centric and systematic absence flags for every unique
+    reflection, computed once per set of observations.'''
+
+    engine = self._get_engine()
+
+    if not hasattr(engine, 'centric'):
+      ms = miller.set(crystal_symmetry(
+          unit_cell = self._mf.get_unit_cell(),
+          space_group = self._mf.get_space_group()),
+                      engine.miller_indices(), anomalous_flag = False)
+      engine.centric = ms.centric_flags().data().as_numpy_array()
+      engine.absent = ms.sys_absent_flags().data().as_numpy_array()
+
+    return engine.centric, engine.absent
+
   def calculate_resolution_ranges(self, nbins = 20):
     '''Calculate semi-useful resolution ranges for analysis.'''
 
-    miller_indices = list(self._merged_reflections)
+    engine = self._get_engine()
     uc = self._mf.get_unit_cell()
 
-    d_mi = []
+    miller_indices = engine.miller_indices()
+    d = uc.d(miller_indices).as_numpy_array()
+    hkl = engine.unique_hkl
 
-    for mi in miller_indices:
-      d = uc.d(mi)
-      d_mi.append((d, mi))
+    # sort on resolution then Miller index
 
-    d_mi.sort()
+    order = numpy.lexsort((hkl[:, 2], hkl[:, 1], hkl[:, 0], d))
 
-    chunk_size = int(round(float(len(d_mi)) / nbins))
+    chunk_size = int(round(float(len(order)) / nbins))
 
     hkl_ranges = []
     resolution_ranges = []
 
-    for chunk in [d_mi[i:i + chunk_size] \
-                  for i in range(0, len(d_mi), chunk_size)]:
-      mi = [c[1] for c in chunk]
-      d = [c[0] for c in chunk]
-      hkl_ranges.append(mi)
-      resolution_ranges.append((min(d), max(d)))
+    for start in range(0, len(order), chunk_size):
+      chunk = order[start:start + chunk_size]
+      hkl_ranges.append([miller_indices[j] for j in chunk])
+      resolution_ranges.append((float(d[chunk[0]]), float(d[chunk[-1]])))
 
     # stitch together the two low res bins
 
@@ -483,6 +678,8 @@ def calculate_resolution_ranges(self, nbins = 20):
     self._resolution_ranges[-1] = (self._resolution_ranges[-1][0],
                                    resolution_ranges[-1][1])
 
+    self._bin_engine = None
+
     return
 
   def get_resolution_bins(self):
@@ -493,32 +690,73 @@ def get_resolution_bins(self):
     return list(reversed(self._hkl_ranges)), \
            list(reversed(self._resolution_ranges))
 
-  def apply_resolution_limit(self, dmin):
-    '''Remove reflections with resolution < dmin.'''
+  def _get_bin_of_group(self):
+    '''Return the resolution bin of every unique reflection in the
+    columnar representation, or -1 if it is in no bin.'''
+
+    engine = self._get_engine()
+
+    if self._bin_engine is not engine:
+      self._bin_of_group = - numpy.ones(engine.size(), dtype = numpy.int64)
+      for j, hkl_list in enumerate(self._hkl_ranges):
+        present = [hkl for hkl in hkl_list if engine.contains(hkl)]
+        if present:
+          self._bin_of_group[engine.groups(present)] = j
+      self._bin_engine = engine
 
-    delete = []
-    for hkl in self._merged_reflections:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
+    return self._bin_of_group
 
-    for hkl in delete:
-      del(self._merged_reflections[hkl])
+  def _binned(self, values):
+    '''Sum per-reflection values over every resolution bin in one pass,
+    returning the sums in the order of get_resolution_bins.'''
 
-    delete = []
-    for hkl in self._merged_reflections_anomalous:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
+    engine = self._get_engine()
+    bin_of_group = self._get_bin_of_group()
+    valid = bin_of_group >= 0
 
-    for hkl in delete:
-      del(self._merged_reflections_anomalous[hkl])
+    values = numpy.asarray(values, dtype = numpy.float64)
+    sums = engine.binned_sum(values[valid], bin_of_group[valid],
+                             len(self._hkl_ranges))
 
-    delete = []
-    for hkl in self._unmerged_reflections:
-      if self.resolution(hkl) < dmin:
-        delete.append(hkl)
+    return sums[::-1]
 
-    for hkl in delete:
-      del(self._unmerged_reflections[hkl])
+  def _binned_rmerge(self):
+    '''Calculate Rmerge for every resolution bin at once.'''
+
+    engine = self._get_engine()
+    multiple = engine.multiplicity > 1
+
+    t = self._binned(numpy.where(multiple, engine.rmerge, 0.0))
+    b = self._binned(numpy.where(
+        multiple, engine.multiplicity * engine.i_mean, 0.0))
+
+    return [float(_t / _b) if _b else 0.0 for _t, _b in zip(t, b)]
+
+  def _binned_unmerged_isigma(self):
+    '''Calculate the unmerged I/sigma for every resolution bin at once.'''
+
+    engine = self._get_engine()
+
+    t = self._binned(engine.isigma)
+    n = self._binned(engine.multiplicity)
+
+    return [float(_t / _n) for _t, _n in zip(t, n)]
+
+  def _binned_merged_isigma(self):
+    '''Calculate the merged I/sigma for every resolution bin at once.'''
+
+    engine = self._get_engine()
+
+    t = self._binned(engine.i_mean / engine.sigi_mean)
+    n = self._binned(numpy.ones(engine.size()))
+
+    return [float(_t / _n) for _t, _n in zip(t, n)]
+
+  def apply_resolution_limit(self, dmin):
+    '''Remove reflections with resolution < dmin.'''
+
+    self._set_engine(self._get_engine().selected(
+        self._resolutions() >= dmin))
 
     return
 
@@ -526,12 +764,14 @@ def calculate_completeness(self, resolution_bin = None):
     '''Calculate the completeness of observations in a named
     resolution bin.'''
 
+    engine = self._get_engine()
+
     if resolution_bin is None:
       resolution_range = self._mf.get_resolution_range()
-      hkl_list = list(self._merged_reflections)
+      groups = engine.groups()
     else:
       resolution_range = self._resolution_ranges[resolution_bin]
-      hkl_list = self._hkl_ranges[resolution_bin]
+      groups = engine.groups(self._hkl_ranges[resolution_bin])
 
     uc = self._mf.get_unit_cell()
     sg = self._mf.get_space_group()
@@ -540,33 +780,29 @@ def calculate_completeness(self, resolution_bin = None):
     dmax = max(resolution_range)
 
     cs = crystal_symmetry(unit_cell = uc, space_group = sg)
-    hkl_calc = [hkl for hkl in build_set(
-        cs, False, d_min = dmin, d_max = dmax).indices()]
+    n_calc = build_set(cs, False, d_min = dmin, d_max = dmax).size()
 
     # remove systematically absent reflections
 
-    hkl_list = [hkl for hkl in
-                itertools.ifilterfalse(sg.is_sys_absent, hkl_list)]
+    centric, absent = self._symmetry_flags()
+    n_obs = int(numpy.count_nonzero(~absent[groups]))
 
-    return float(len(hkl_list)) / float(len(hkl_calc))
+    return float(n_obs) / float(n_calc)
 
   def calculate_rmerge(self, hkl_list = None):
     '''Calculate the overall Rmerge.'''
 
-    t = 0.0
-    b = 0.0
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    # if we have only one observation, do not include in the
+    # rmerge calculations
+
+    groups = groups[engine.multiplicity[groups] > 1]
 
-    for hkl in hkl_list:
-      # if we have only one observation, do not include in the
-      # rmerge calculations
-      if self._unmerged_reflections[hkl].multiplicity() > 1:
-        i_mean = self._merged_reflections[hkl][0]
-        t += self._unmerged_reflections[hkl].rmerge_contribution(
-            i_mean)
-        b += self._unmerged_reflections[hkl].multiplicity() * i_mean
+    t = float(numpy.sum(engine.rmerge[groups]))
+    b = float(numpy.sum(engine.multiplicity[groups] *
+                        engine.i_mean[groups]))
 
     if not b:
       return 0.0
@@ -576,31 +812,21 @@ def calculate_rmerge(self, hkl_list = None):
   def calculate_rmerge_anomalous(self, hkl_list = None):
     '''Calculate the overall Rmerge, separating anomalous pairs.'''
 
-    t = 0.0
-    b = 0.0
-
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    for hkl in hkl_list:
-      is_pm = self._merged_reflections_anomalous[hkl]
-      i_mean_p, i_mean_m = is_pm[0], is_pm[2]
-      r_pm = self._unmerged_reflections[
-          hkl].rmerge_contribution_anomalous(i_mean_p, i_mean_m)
-      t += r_pm[0] + r_pm[1]
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-      # if we have only one observation, do not include in the
-      # rmerge calculations
+    t = float(numpy.sum(engine.rmerge_p[groups] + engine.rmerge_m[groups]))
 
-      mult_p, mult_m = self._unmerged_reflections[
-          hkl].multiplicity_anomalous()
+    # if we have only one observation, do not include in the
+    # rmerge calculations
 
-      if mult_p == 1:
-        mult_p = 0
-      if mult_m == 1:
-        mult_m = 0
+    mult_p = engine.multiplicity_p[groups]
+    mult_m = engine.multiplicity_m[groups]
+    mult_p = numpy.where(mult_p == 1, 0, mult_p)
+    mult_m = numpy.where(mult_m == 1, 0, mult_m)
 
-      b += mult_p * i_mean_p + mult_m * i_mean_m
+    b = float(numpy.sum(mult_p * engine.i_mean_p[groups] +
+                        mult_m * engine.i_mean_m[groups]))
 
     if not b:
       return 0.0
@@ -610,84 +836,64 @@ def calculate_rmerge_anomalous(self, hkl_list = None):
   def calculate_chisq(self, hkl_list = None):
     '''Calculate the overall ersatz chi^2.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
-
-    deltas = []
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-    for hkl in hkl_list:
-      i_mean = self._merged_reflections[hkl][0]
-      for d in self._unmerged_reflections[hkl].chisq_contribution(
-          i_mean):
-        deltas.append(d)
+    deltas = engine.chisq[engine.observations(groups)]
 
-    mean = sum(deltas) / len(deltas)
-    var = sum([(d - mean) * (d - mean) for d in deltas]) / len(deltas)
+    mean = float(numpy.sum(deltas)) / len(deltas)
+    var = float(numpy.sum((deltas - mean) * (deltas - mean))) / len(deltas)
 
     return mean, math.sqrt(var)
 
   def calculate_multiplicity(self, hkl_list = None):
     '''Calculate the overall average multiplicity.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-    multiplicity = [float(self._unmerged_reflections[hkl].multiplicity()) \
-                    for hkl in hkl_list]
-
-    return sum(multiplicity) / len(multiplicity)
+    return float(numpy.sum(engine.multiplicity[groups])) / len(groups)
 
   def calculate_merged_isigma(self, hkl_list = None):
     '''Calculate the average merged I/sigma.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-    isigma_values = [self._merged_reflections[hkl][0] / \
-                     self._merged_reflections[hkl][1] \
-                     for hkl in hkl_list]
+    isigma_values = engine.i_mean[groups] / engine.sigi_mean[groups]
 
-    return sum(isigma_values) / len(isigma_values)
+    return float(numpy.sum(isigma_values)) / len(isigma_values)
 
   def calculate_unmerged_isigma(self, hkl_list = None):
     '''Calculate the average unmerged I/sigma.'''
 
-    if not hkl_list:
-      hkl_list = list(self._unmerged_reflections)
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
-    return sum([self._unmerged_reflections[hkl].isigma_contribution() \
-                for hkl in hkl_list]) / \
-                sum([self._unmerged_reflections[hkl].multiplicity() \
-                     for hkl in hkl_list])
+    return float(numpy.sum(engine.isigma[groups])) / \
+           float(numpy.sum(engine.multiplicity[groups]))
 
   def calculate_z2(self, hkl_list = None):
     '''Calculate average Z^2 values, where Z = I/<I> in the bin,
     from the merged observations. Now also separate centric and
     acentric reflections.'''
 
-    if not hkl_list:
-      hkl_list = list(self._merged_reflections)
+    engine = self._get_engine()
+    groups = engine.groups(hkl_list)
 
     # separate centric and acentric reflections
 
-    sg = self._mf.get_space_group()
-
-    hkl_centric = [hkl for hkl in
-                   itertools.ifilter(sg.is_centric, hkl_list)]
-    hkl_acentric = [hkl for hkl in
-                    itertools.ifilterfalse(sg.is_centric, hkl_list)]
-
-    i_s = [self._merged_reflections[hkl][0] for hkl in hkl_centric]
-    mean_i = sum(i_s) / len(i_s)
+    centric, absent = self._symmetry_flags()
 
-    z_s = [i / mean_i for i in i_s]
-    z_centric = sum([z * z for z in z_s]) / len(z_s)
+    result = []
 
-    i_s = [self._merged_reflections[hkl][0] for hkl in hkl_acentric]
-    mean_i = sum(i_s) / len(i_s)
+    for selection in (centric[groups], ~centric[groups]):
+      i_s = engine.i_mean[groups[selection]]
+      mean_i = float(numpy.sum(i_s)) / len(i_s)
+      z_s = i_s / mean_i
+      result.append(float(numpy.sum(z_s * z_s)) / len(z_s))
 
-    z_s = [i / mean_i for i in i_s]
-    z_acentric = sum([z * z for z in z_s]) / len(z_s)
+    z_centric, z_acentric = result
 
     return z_centric, z_acentric
 
@@ -705,7 +911,7 @@ def resolution_rmerge(self, limit = None, log = None):
       return ranges[-1][0]
 
     rmerge_s = get_positive_values(
-        [self.calculate_rmerge(bin) for bin in bins])
+        self._binned_rmerge())
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(rmerge_s)]
 
@@ -743,7 +949,7 @@ def new_resolution_unmerged_isigma(self, limit = None, log = None):
     bins, ranges = self.get_resolution_bins()
 
     isigma_s = get_positive_values(
-        [self.calculate_unmerged_isigma(bin) for bin in bins])
+        self._binned_unmerged_isigma())
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(isigma_s)]
 
@@ -796,7 +1002,7 @@ def resolution_unmerged_isigma(self, limit = None, log = None):
     bins, ranges = self.get_resolution_bins()
 
     isigma_s = get_positive_values(
-        [self.calculate_unmerged_isigma(bin) for bin in bins])
+        self._binned_unmerged_isigma())
 
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(isigma_s)]
 
@@ -831,7 +1037,7 @@ def new_resolution_merged_isigma(self, limit = None, log = None):
     bins, ranges = self.get_resolution_bins()
 
     misigma_s = get_positive_values(
-        [self.calculate_merged_isigma(bin) for bin in bins])
+        self._binned_merged_isigma())
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(misigma_s)]
 
     if min(misigma_s) > limit:
@@ -883,7 +1089,7 @@ def resolution_merged_isigma(self, limit = None, log = None):
     bins, ranges = self.get_resolution_bins()
 
     misigma_s = get_positive_values(
-        [self.calculate_merged_isigma(bin) for bin in bins])
+        self._binned_merged_isigma())
     s_s = [1.0 / (r[0] * r[0]) for r in ranges][:len(misigma_s)]
 
     if min(misigma_s) > limit:
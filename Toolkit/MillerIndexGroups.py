@@ -0,0 +1,34 @@
+# Grouping of observations by Miller index as numpy arrays: the indices are
+# sorted on all three columns, as in the columnar Merger, so that there is
+# no limit on their range.
+
+from __future__ import absolute_import, division
+
+import numpy
+
+def miller_index_array(indices):
+  '''Return the Miller indices (a flex.miller_index) as an n x 3 numpy
+  array of integers.'''
+
+  return numpy.rint(indices.as_vec3_double().as_numpy_array()).astype(
+    numpy.int64).reshape(-1, 3)
+
+def unique_miller_indices(hkl):
+  '''Return the unique Miller indices in hkl (an n x 3 array), sorted by
+  h, k then l, and the position of each row of hkl in them - as
+  numpy.unique(hkl, axis=0, return_inverse=True).'''
+
+  hkl = numpy.asarray(hkl, dtype=numpy.int64).reshape(-1, 3)
+  n = len(hkl)
+
+  order = numpy.lexsort((hkl[:, 2], hkl[:, 1], hkl[:, 0]))
+  sorted_hkl = hkl[order]
+
+  first = numpy.ones(n, dtype=bool)
+  if n:
+    first[1:] = numpy.any(sorted_hkl[1:] != sorted_hkl[:-1], axis=1)
+
+  inverse = numpy.empty(n, dtype=numpy.int64)
+  inverse[order] = numpy.cumsum(first) - 1
+
+  return sorted_hkl[first], inverse
@@ -28,6 +28,7 @@
 
 from xia2.Driver.DriverFactory import DriverFactory
 from xia2.lib.bits import transpose_loggraph
+from xia2.lib.loggraph import loggraph_parser
 from xia2.Handlers.Streams import Chatter, Debug
 
 def Ctruncate(DriverType = None):
@@ -60,6 +61,9 @@ def __init__(self):
 
       self._xmlout = None
 
+      self._loggraph = { }
+      self._loggraph_parser = loggraph_parser()
+
       return
 
     def set_hklin(self, hklin):
@@ -172,54 +176,17 @@ def get_nref_out(self):
     def get_nabsent(self):
       return self._nabsent
 
-    def parse_ccp4_loggraph(self):
-      '''Look through the standard output of the program for
-      CCP4 loggraph text. When this is found store it in a
-      local dictionary to allow exploration.'''
-
-      # reset the loggraph store
-      self._loggraph = { }
-
-      output = self.get_all_output()
-
-      for i in range(len(output)):
-        line = output[i]
-        if '$TABLE' in line:
-
-          n_dollar = line.count('$$')
-
-          current = line.split(':')[1].replace('>',
-                                                        '').strip()
-          self._loggraph[current] = { }
-          self._loggraph[current]['columns'] = []
-          self._loggraph[current]['data'] = []
+    def output(self):
+      record = DriverInstance.__class__.output(self)
+      self._loggraph_parser.update(self.get_all_output())
+      return record
 
-          loggraph_info = ''
-
-          while n_dollar < 4:
-            n_dollar += line.count('$$')
-            loggraph_info += line
-
-            if n_dollar == 4:
-              break
-
-            i += 1
-            line = output[i]
-
-          tokens = loggraph_info.split('$$')
-          self._loggraph[current]['columns'] = tokens[1].split()
-
-          if len(tokens) < 4:
-            raise RuntimeError, 'loggraph "%s" broken' % current
-
-          data = tokens[3].split('\n')
-
-          columns = len(self._loggraph[current]['columns'])
+    def parse_ccp4_loggraph(self):
+      '''Return the CCP4 loggraph tables found in the standard output of
+      the program, as a dictionary keyed by table name.'''
 
-          for j in range(len(data)):
-            record = data[j].split()
-            if len(record) == columns:
-              self._loggraph[current]['data'].append(record)
+      self._loggraph_parser.update(self.get_all_output())
+      self._loggraph = self._loggraph_parser.get_tables()
 
       return self._loggraph
 
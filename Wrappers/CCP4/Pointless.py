@@ -274,11 +274,8 @@ def sum_mtz(self, summedlist):
 
       cell = None
 
-      for j in range(len(output)):
-        line = output[j]
-
-        if 'Space group from HKLIN file' in line:
-          cell = tuple(map(float, output[j + 1].split()[1:]))
+      for j in self.find_output('Space group from HKLIN file'):
+        cell = tuple(map(float, output[j + 1].split()[1:]))
 
       return cell
 
@@ -693,7 +690,6 @@ def decide_spacegroup(self):
       # this should look familiar from mtzdump
 
       output = self.get_all_output()
-      length = len(output)
 
       a = 0.0
       b = 0.0
@@ -705,7 +701,7 @@ def decide_spacegroup(self):
       self._cell_info['datasets'] = []
       self._cell_info['dataset_info'] = { }
 
-      for i in range(length):
+      for i in self.find_output('Dataset ID, '):
 
         line = output[i][:-1]
 
@@ -151,12 +151,28 @@ def run(self):
         self.add_command_line('reflections_per_degree=%d' %self._reflections_per_degree)
         self.add_command_line('integrate_all_reflections=False')
 
+      # with a streaming Driver the output is watched as it is produced
+      # rather than read back from the log file afterwards
+
+      memory_error = 'There was a problem allocating memory for shoeboxes'
+      if hasattr(self, 'add_output_callback'):
+        memory_errors = []
+        self.add_output_callback(
+          memory_error, lambda line, match: memory_errors.append(line))
+      else:
+        memory_errors = None
+
       self.start()
       self.close_wait()
 
-      for record in self.get_all_output():
-        if 'There was a problem allocating memory for shoeboxes' in record:
-          raise RuntimeError(
+      if memory_errors is None:
+        memory_errors = [record for record in self.get_all_output()
+                         if memory_error in record]
+      else:
+        self.clear_output_callbacks()
+
+      if memory_errors:
+        raise RuntimeError(
 '''dials.integrate requires more memory than is available.
 Try using a machine with more memory or using fewer processor.''')
 
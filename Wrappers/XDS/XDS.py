@@ -31,6 +31,8 @@
 
 import exceptions
 import math
+import os
+import shutil
 from scitbx import matrix
 
 class XDSException(exceptions.Exception):
@@ -139,6 +141,60 @@ def xds_check_error(xds_output_list):
 
   return
 
+def xds_stage_file(src, dst, share=True):
+  '''Make the file src available as dst, as a hard link or (between file
+  systems) a symbolic link where share is set, else as a copy. A dst which
+  is already the file src is left alone.'''
+
+  if os.path.lexists(dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst) and \
+           (share or not (os.path.islink(dst) or
+                          os.stat(dst).st_nlink > 1)):
+      return
+    os.remove(dst)
+
+  if share:
+    for link in (getattr(os, 'link', None), getattr(os, 'symlink', None)):
+      if link is None:
+        continue
+      try:
+        link(os.path.abspath(src), dst)
+        return
+      except OSError:
+        continue
+
+  shutil.copyfile(src, dst)
+
+  return
+
+def xds_stage_files(working_directory, input_files, input_files_list,
+                    output_files_list):
+  '''Stage the input files of an XDS step in the working directory - by
+  name in input_files_list from the paths in input_files - and remove any
+  links to other files in the output files the step will write, so that XDS
+  writes new files rather than writing through links to files which belong
+  to other steps. Files which the step rewrites are always copied.'''
+
+  from xia2.Handlers.Phil import PhilIndex
+
+  share = PhilIndex.params.xds.stage_input_files == 'link'
+
+  for file_name in input_files_list:
+    src = input_files[file_name]
+    dst = os.path.join(working_directory, file_name)
+    if src != dst:
+      xds_stage_file(src, dst,
+                     share=share and not file_name in output_files_list)
+
+  for file_name in output_files_list:
+    path = os.path.join(working_directory, file_name)
+    if os.path.islink(path) or \
+           (os.path.exists(path) and os.stat(path).st_nlink > 1):
+      Debug.write('Unlinking %s before it is written' % path)
+      os.remove(path)
+
+  return
+
 def rotate_cbf_to_xds_convention(fast, slow, axis = (1, 0, 0)):
   '''Rotate fast and slow directions about rotation axis to give XDS
   conventional directions for fast and slow. This should be a rotation
@@ -19,6 +19,7 @@
 from xia2.Schema.Interfaces.FrameProcessor import FrameProcessor
 
 # generic helper stuff
+from xia2.Wrappers.XDS.XDS import xds_stage_files
 from xia2.Wrappers.XDS.XDS import imageset_to_xds, xds_check_version_supported
 from xia2.Wrappers.XDS.XDS import _running_xds_version, template_to_xds
 
@@ -148,12 +149,10 @@ def run(self):
 
       # write the input data files...
 
-      for file_name in self._input_data_files_list:
-        src = self._input_data_files[file_name]
-        dst = os.path.join(
-            self.get_working_directory(), file_name)
-        if src != dst:
-          shutil.copyfile(src, dst)
+      xds_stage_files(self.get_working_directory(),
+                      self._input_data_files,
+                      self._input_data_files_list,
+                      self._output_data_files_list)
 
       self.start()
       self.close_wait()
@@ -164,6 +164,83 @@ def _print_integrate_lp(integrate_lp_stats):
            data['overloads'], data['rejected'],
            data['mosaic'], data['distance'])
 
+def _wedge_ranges(first, last, wedge_images, block_images, overlap_images):
+  '''Split the images first to last into wedges of about wedge_images
+  images, with the boundaries on whole blocks of block_images images (as
+  INTEGRATE processes the images in blocks of DELPHI degrees), returning
+  for every wedge the images it owns and the images to integrate - these
+  extended by overlap_images each side, so that the reflections close to
+  the boundaries are fully recorded in the wedge which owns them.'''
+
+  block_images = max(1, block_images)
+  size = max(1, int(round(wedge_images / block_images))) * block_images
+
+  starts = range(first, last + 1, size)
+
+  # merge a short final wedge into the one before
+
+  if len(starts) > 1 and last + 1 - starts[-1] < size // 2:
+    starts.pop()
+
+  ends = [start - 1 for start in starts[1:]] + [last]
+
+  return [((start, end), (max(first, start - overlap_images),
+                          min(last, end + overlap_images)))
+          for start, end in zip(starts, ends)]
+
+def _stitch_integrate_hkl(wedges, hklout, data_range):
+  '''Join the INTEGRATE.HKL files from a list of wedges of (filename,
+  (start, end)) in order, taking from each file only the reflections
+  owned by the wedge, i.e. with ZCAL in images start to end - where the
+  first and last wedges own everything before or after. The header is
+  taken from the first file, with the DATA_RANGE of the whole sweep.'''
+
+  import numpy
+  from xia2.Modules.XDSReflections import read_header
+
+  with open(hklout, 'wb') as fout:
+
+    for j, (filename, (start, end)) in enumerate(wedges):
+      header, columns, header_lines, header_size = read_header(filename)
+      n_items = int(header.get(
+        'NUMBER_OF_ITEMS_IN_EACH_DATA_RECORD', [len(columns)])[0])
+      zcal = columns.index('ZCAL')
+
+      if j == 0:
+        for record in header_lines:
+          if record.startswith('!DATA_RANGE='):
+            record = '!DATA_RANGE=%6d%6d\n' % data_range
+          fout.write(record)
+
+      with open(filename, 'rb') as f:
+        f.seek(header_size)
+        body = f.read()
+
+      end_of_data = body.find('!END_OF_DATA')
+      if end_of_data >= 0:
+        body = body[:end_of_data]
+
+      records = body.splitlines(True)
+      z = numpy.fromstring(body, dtype=numpy.float64, sep=' ')
+      if len(z) != n_items * len(records):
+        raise RuntimeError, 'error reading %s: %d values for %d records' % \
+              (filename, len(z), len(records))
+      z = z.reshape(-1, n_items)[:, zcal]
+
+      # the images start - 1 to start cover ZCAL start - 1 to start
+
+      keep = numpy.ones(len(records), dtype=bool)
+      if j > 0:
+        keep &= z >= start - 1
+      if j < len(wedges) - 1:
+        keep &= z < end
+
+      fout.writelines(records[k] for k in numpy.nonzero(keep)[0])
+
+    fout.write('!END_OF_DATA\n')
+
+  return
+
 
 if __name__ == '__main__':
   if len(sys.argv) > 1:
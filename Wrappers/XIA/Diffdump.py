@@ -53,21 +53,61 @@
   debug = False
 
 from xia2.Driver.DriverFactory import DriverFactory
+from xia2.Handlers.DiskCache import DiskCache, file_key
+
+def _from_json(value):
+  '''Return a value read from JSON with the strings as str, as they are
+  when the header is parsed.'''
+
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, list):
+    return [_from_json(v) for v in value]
+  if isinstance(value, dict):
+    return dict((_from_json(k), _from_json(v)) for k, v in value.items())
+  return value
+
+def _header_key(image):
+  '''Return the DiskCache key for the header of image, which depends on
+  the source of this module (the header parsers) too.'''
+
+  from xia2.Handlers.StartupCache import module_source, source_key
+  return file_key([image], source_key(paths=[module_source(__file__)]))
 
 class _HeaderCache(object):
-  '''A cache for image headers.'''
+  '''A cache for image headers, backed by the persistent DiskCache - as
+  JSON, with the names of the values which are tuples so that these are
+  restored as tuples rather than lists, and strings restored as str.'''
 
   def __init__(self):
     self._headers = { }
 
   def put(self, image, header):
     self._headers[image] = copy.deepcopy(header)
+    tuples = sorted(k for k in header if isinstance(header[k], tuple))
+    try:
+      DiskCache.put('header', _header_key(image),
+                    {'header':header, 'tuples':tuples})
+    except OSError:
+      pass
 
   def get(self, image):
     return self._headers[image]
 
   def check(self, image):
-    return image in self._headers
+    if image in self._headers:
+      return True
+    try:
+      entry = DiskCache.get('header', _header_key(image))
+    except OSError:
+      return False
+    if entry is None:
+      return False
+    header = _from_json(entry['header'])
+    for k in _from_json(entry['tuples']):
+      header[k] = tuple(header[k])
+    self._headers[image] = header
+    return True
 
   def write(self, filename):
     import json
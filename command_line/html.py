@@ -35,6 +35,7 @@ def generate_xia2_html(xinfo, filename='xia2.html'):
   params = params.extract()
 
   from xia2.command_line.report import xia2_report
+  from xia2.Modules.MergingStatistics import evict_statistics_session
   crystal = xinfo.get_crystals().values()[0]
 
   xia2_txt = os.path.join(os.path.abspath(os.path.curdir), 'xia2.txt')
@@ -95,7 +96,11 @@ def generate_xia2_html(xinfo, filename='xia2.html'):
       ]
       columns.append(column)
 
-      xtriage_success, xtriage_warnings, xtriage_danger = report.xtriage_report()
+      sections = report.compute_sections(
+        params.sections, nproc=params.nproc, pychef={'n_bins':1})
+
+      xtriage_success, xtriage_warnings, xtriage_danger = sections.get(
+        'xtriage', ([], [], []))
 
       d = {}
       d['merging_statistics_table'] = report.merging_statistics_table()
@@ -103,24 +108,14 @@ def generate_xia2_html(xinfo, filename='xia2.html'):
 
       individual_dataset_reports[wname] = d
 
-      json_data = {}
-
-      json_data.update(report.multiplicity_vs_resolution_plot())
-      json_data.update(report.multiplicity_histogram())
-      json_data.update(report.completeness_plot())
-      json_data.update(report.scale_rmerge_vs_batch_plot())
-      json_data.update(report.cc_one_half_plot())
-      json_data.update(report.i_over_sig_i_plot())
-      json_data.update(report.second_moments_plot())
-      json_data.update(report.cumulative_intensity_distribution_plot())
-      json_data.update(report.l_test_plot())
-      json_data.update(report.wilson_plot())
-      json_data.update(report.pychef_plots(n_bins=1))
+      json_data = report.json_data(sections)
 
       from scitbx.array_family import flex
       max_points = 500
       for g in ('scale_rmerge_vs_batch', 'completeness_vs_dose',
         'rcp_vs_dose', 'scp_vs_dose', 'rd_vs_batch_difference'):
+        if not g in json_data:
+          continue
         for i, data in enumerate(json_data[g]['data']):
           x = data['x']
           n = len(x)
@@ -141,13 +136,14 @@ def generate_xia2_html(xinfo, filename='xia2.html'):
       batch_graphs = OrderedDict(
         (k + '_' + wname, json.dumps(json_data[k])) for k in
         ('scale_rmerge_vs_batch', 'completeness_vs_dose',
-         'rcp_vs_dose', 'scp_vs_dose', 'rd_vs_batch_difference'))
+         'rcp_vs_dose', 'scp_vs_dose', 'rd_vs_batch_difference')
+        if k in json_data)
 
       misc_graphs = OrderedDict(
         (k + '_' + wname, json.dumps(json_data[k])) for k in
         ('cumulative_intensity_distribution', 'l_test', 'multiplicities') if k in json_data)
 
-      for k, v in report.multiplicity_plots().iteritems():
+      for k, v in sections.get('multiplicity', { }).iteritems():
         misc_graphs[k + '_' + wname] = {'img': v}
 
       d['resolution_graphs'] = resolution_graphs
@@ -159,6 +155,9 @@ def generate_xia2_html(xinfo, filename='xia2.html'):
         'danger': xtriage_danger
       }
 
+      # the report is complete, so the reflection file is no longer needed
+      evict_statistics_session(unmerged_mtz)
+
   table = [[c[i] for c in columns] for i in range(len(columns[0]))]
 
   cell = xcryst.get_cell()
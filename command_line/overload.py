@@ -1,7 +1,17 @@
+# Overload analysis of a sweep of CBF images: pixel values from a fraction
+# of the overload limit upwards are counted exactly, in a sparse histogram as
+# there are few distinct values, and lower values in a coarse histogram,
+# together with the number of overloaded pixels on every frame. The coarse
+# histogram and the table of frames are held in shared memory, to which the
+# worker processes add each frame as it is read (with the next frames read
+# ahead in a background thread), so the memory used depends neither on the
+# overload limit nor on the number of frames.
+
 from __future__ import absolute_import, division
 import binascii
 import json
 import sys
+import threading
 import timeit
 
 try:
@@ -38,14 +48,19 @@ def open_file(filename, mode='rb'):
 
   return open(filename, mode)
 
-def read_cbf_image(cbf_image):
+def read_cbf_data(cbf_image):
+  '''Read the (uncompressed) contents of a CBF image file.'''
+
+  with open_file(cbf_image, 'rb') as fh:
+    return fh.read()
+
+def decode_cbf_data(data):
+  '''Decode the pixel values of a CBF image from its contents.'''
+
   from cbflib_adaptbx import uncompress
 
   start_tag = binascii.unhexlify('0c1a04d5')
 
-  with open_file(cbf_image, 'rb') as fh:
-    data = fh.read()
-
   data_offset = data.find(start_tag) + 4
   cbf_header = data[:data_offset - 4]
 
@@ -70,20 +85,152 @@ def read_cbf_image(cbf_image):
 
   return pixel_values
 
+def read_cbf_image(cbf_image):
+  return decode_cbf_data(read_cbf_data(cbf_image))
+
 def get_overload(cbf_file):
   with open_file(cbf_file, 'rb') as fh:
     for record in fh:
       if 'Count_cutoff' in record:
         return float(record.split()[-2])
 
-def build_hist(nproc=1):
-  from scitbx.array_family import flex
-  from libtbx import easy_mp
+class prefetching_reader(object):
+  '''Iterate over the contents of a list of files, with up to n_ahead files
+  read ahead in a background thread while the current one is processed.'''
+
+  def __init__(self, filenames, n_ahead=2):
+    import Queue
+    self._filenames = filenames
+    self._queue = Queue.Queue(maxsize=n_ahead)
+    self._thread = threading.Thread(target=self._read)
+    self._thread.daemon = True
+    self._thread.start()
+
+    return
+
+  def _read(self):
+    for filename in self._filenames:
+      try:
+        self._queue.put((read_cbf_data(filename), None))
+      except Exception, e:
+        self._queue.put((None, e))
+        return
+
+  def __iter__(self):
+    for filename in self._filenames:
+      data, error = self._queue.get()
+      if error is not None:
+        raise error
+      yield data
+    self._thread.join()
+
+class overload_histogram(object):
+  '''The accumulated histogram of the pixel values of a sweep: exact counts
+  of the values from threshold * limit upwards, coarse counts of the values
+  below, and the number of overloaded pixels and largest value on each
+  frame - the last two held in shared memory.'''
+
+  def __init__(self, limit, n_frames, threshold=0.5, n_coarse=1000):
+    import multiprocessing
+
+    self.limit = limit
+    self.threshold = threshold * limit
+    self.n_coarse = n_coarse
+    self.coarse_width = self.threshold / n_coarse
+    self.n_frames = n_frames
+
+    self._coarse = multiprocessing.RawArray('d', n_coarse)
+    self._frames = multiprocessing.RawArray('d', 2 * n_frames)
+    self._lock = multiprocessing.Lock()
+    self.counts = { }
+
+    return
+
+  def coarse(self):
+    import numpy
+    return numpy.frombuffer(self._coarse, dtype=numpy.float64)
+
+  def frames(self):
+    import numpy
+    return numpy.frombuffer(
+      self._frames, dtype=numpy.float64).reshape(self.n_frames, 2)
+
+  def add_frame(self, j, values):
+    '''Add the pixel values of frame j, returning the exact counts of the
+    values above threshold as a dictionary - the rest of the frame is added
+    to the shared histograms.'''
+
+    import numpy
+
+    values = values[values >= 0]
+    high = values >= self.threshold
+
+    low = numpy.bincount(numpy.minimum(
+      (values[~high] // self.coarse_width).astype(numpy.int64),
+      self.n_coarse - 1), minlength=self.n_coarse)
+    with self._lock:
+      coarse = self.coarse()
+      coarse += low
+
+    frames = self.frames()
+    frames[j, 0] = numpy.count_nonzero(values >= self.limit)
+    frames[j, 1] = values.max() if len(values) else 0
+
+    high_values, n = numpy.unique(values[high], return_counts=True)
+    return dict(zip(high_values.tolist(), n.tolist()))
+
+  def add_counts(self, counts):
+    for value, n in counts.iteritems():
+      self.counts[value] = self.counts.get(value, 0) + n
+
+    return
+
+  def as_dict(self, image_list):
+    coarse = self.coarse()
+    frames = self.frames()
+    return {'scale_factor': 1 / self.limit,
+            'overload_limit': self.limit,
+            'threshold': self.threshold,
+            'counts': dict((int(v), n) for v, n in self.counts.iteritems()),
+            'coarse_bin_width': self.coarse_width,
+            'coarse_counts': dict((b, int(c)) for b, c in enumerate(coarse)
+                                  if c > 0),
+            'frames': [{'image': image, 'overloads': int(frame[0]),
+                        'max': int(frame[1])}
+                       for image, frame in zip(image_list, frames)]}
+
+# the histogram and list of images, inherited by the worker processes when
+# they are forked
+
+_shared = None
+
+def _process_frames(frames):
+  import numpy
   from collections import Counter
 
+  histogram, image_list = _shared
+  counts = Counter()
+  reader = prefetching_reader([image_list[j] for j in frames])
+  for j, data in zip(frames, reader):
+    values = decode_cbf_data(data).as_numpy_array().ravel()
+    counts.update(histogram.add_frame(j, values))
+  return len(frames), dict(counts)
+
+def build_hist(nproc=1):
+  global _shared
+
+  import multiprocessing
+
+  threshold = 0.5
+
   # FIXME use proper optionparser here. This works for now
-  if len(sys.argv) >= 2 and sys.argv[1].startswith('nproc='):
-    nproc=int(sys.argv[1][6:])
+  while len(sys.argv) >= 2 and sys.argv[1].split('=')[0] in \
+        ('nproc', 'threshold'):
+    name, value = sys.argv[1].split('=')
+    if name == 'nproc':
+      nproc = int(value)
+    else:
+      threshold = float(value)
     sys.argv = sys.argv[1:]
   if len(sys.argv) == 2 and sys.argv[1].endswith('.json'):
     from dxtbx import datablock
@@ -93,68 +240,56 @@ def build_hist(nproc=1):
     image_list = sys.argv[1:]
   image_count = len(image_list)
 
-  # Faster, yet still less than ideal and wasting a lot of resources.
   limit = get_overload(image_list[0])
-  binfactor = 5 # register up to 500% counts
-  histmax = (limit * binfactor) + 0.0
-  histbins = int(limit * binfactor) + 1
-  use_python_counter = histbins > 90000000 # empirically determined
+  histogram = overload_histogram(limit, image_count, threshold=threshold)
 
-  print "Processing %d images in %d processes using %s\n" % (image_count, nproc, \
-    "python Counter" if use_python_counter else "flex arrays")
+  print "Processing %d images in %d processes\n" % (image_count, nproc)
 
-  def process_image(process):
-    last_update = start = timeit.default_timer()
+  # contiguous chunks of frames, so that the files may be read ahead
 
-    i = process
-    if use_python_counter:
-      local_hist = Counter()
-    else:
-      local_hist = flex.histogram(flex.double(), data_min=0.0, data_max=histmax, n_slots=histbins)
-
-    max_images = image_count // nproc
-    if process >= image_count % nproc:
-      max_images += 1
-    while i < image_count:
-      data = read_cbf_image(image_list[i])
-      if not use_python_counter:
-        data = flex.histogram(data.as_double().as_1d(), data_min=0.0, data_max=histmax, n_slots=histbins)
-      local_hist.update(data)
-      i = i + nproc
-      if process == 0:
-        if timeit.default_timer() > (last_update + 3):
-          last_update = timeit.default_timer()
-          if sys.stdout.isatty():
-            sys.stdout.write('\033[A')
-          print 'Processed %d%% (%d seconds remain)    ' % (100 * i // image_count, round((image_count - i) * (last_update - start) / (i+1)))
-    return local_hist
-
-  results = easy_mp.parallel_map(
-    func=process_image,
-    iterable=range(nproc),
-    processes=nproc,
-    preserve_exception_message=True)
-
-  print "Merging results"
-  result_hist = None
-  for hist in results:
-    if result_hist is None:
-      result_hist = hist
-    else:
-      result_hist.update(hist)
+  chunk = max(1, min(50, image_count // (4 * nproc)))
+  chunks = [range(j, min(j + chunk, image_count))
+            for j in range(0, image_count, chunk)]
 
-  if not use_python_counter:
-    # reformat histogram into dictionary
-    result = list(result_hist.slots())
-    result_hist = { b: count for b, count in enumerate(result) if count > 0 }
+  _shared = (histogram, image_list)
+  if nproc > 1:
+    pool = multiprocessing.Pool(nproc)
+    results = pool.imap_unordered(_process_frames, chunks)
+  else:
+    pool = None
+    results = (_process_frames(frames) for frames in chunks)
 
-  results = { 'scale_factor': 1 / limit,
-              'overload_limit': limit,
-              'counts': result_hist }
+  last_update = start = timeit.default_timer()
+  done = 0
+  try:
+    for n, counts in results:
+      histogram.add_counts(counts)
+      done += n
+      if timeit.default_timer() > (last_update + 3):
+        last_update = timeit.default_timer()
+        if sys.stdout.isatty():
+          sys.stdout.write('\033[A')
+        print 'Processed %d%% (%d seconds remain)    ' % (
+          100 * done // image_count,
+          round((image_count - done) * (last_update - start) / (done + 1)))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    _shared = None
+
+  results = histogram.as_dict(image_list)
 
   print "Writing results to overload.json"
   with open('overload.json', 'w') as fh:
     json.dump(results, fh, indent=1, sort_keys=True)
 
+  print "Writing overloads per frame to overload.txt"
+  with open('overload.txt', 'w') as fh:
+    fh.write('%6s %10s %10s %s\n' % ('frame', 'overloads', 'max', 'image'))
+    for j, frame in enumerate(results['frames']):
+      fh.write('%6d %10d %10d %s\n' % (
+        j + 1, frame['overloads'], frame['max'], frame['image']))
+
 if __name__ == '__main__':
   build_hist()
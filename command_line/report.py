@@ -39,18 +39,58 @@ def flush(self):
     self._out_orig.flush()
 
 
+# the sections of the report, each computed by the xia2_report method given
+# and independent of the others once the arrays are loaded, and those which
+# give plots as dictionaries of JSON data
+
+report_sections = OrderedDict([
+  ('xtriage', 'xtriage_report'),
+  ('multiplicity', 'multiplicity_plots'),
+  ('multiplicity_vs_resolution', 'multiplicity_vs_resolution_plot'),
+  ('multiplicity_histogram', 'multiplicity_histogram'),
+  ('completeness', 'completeness_plot'),
+  ('scale_rmerge_vs_batch', 'scale_rmerge_vs_batch_plot'),
+  ('cc_one_half', 'cc_one_half_plot'),
+  ('i_over_sig_i', 'i_over_sig_i_plot'),
+  ('second_moments', 'second_moments_plot'),
+  ('cumulative_intensity_distribution',
+   'cumulative_intensity_distribution_plot'),
+  ('l_test', 'l_test_plot'),
+  ('wilson', 'wilson_plot'),
+  ('pychef', 'pychef_plots'),
+])
+
+json_sections = [s for s in report_sections
+                 if not s in ('xtriage', 'multiplicity')]
+
+# the sections which use the xtriage analyses
+
+xtriage_sections = ['xtriage', 'cumulative_intensity_distribution', 'l_test',
+                    'wilson']
+
+# the report (and the arguments for its sections) being computed by a pool
+# of processes, which inherit it when they are forked rather than having it
+# pickled for every task
+
+_pool_report = None
+
+def _compute_section(name):
+  report, kwargs = _pool_report
+  return name, report.compute_section(name, **kwargs.get(name, { }))
+
 class xia2_report(object):
 
   def __init__(self, unmerged_mtz, params):
 
-    from iotbx.reflection_file_reader import any_reflection_file
+    from xia2.Modules.MergingStatistics import get_statistics_session
 
     self.unmerged_mtz = unmerged_mtz
     self.params = params
 
-    reader = any_reflection_file(unmerged_mtz)
-    assert reader.file_type() == 'ccp4_mtz'
-    arrays = reader.as_miller_arrays(merge_equivalents=False)
+    # the file is decoded once per process, and shared with the scalers
+    self._session = get_statistics_session(unmerged_mtz)
+    assert self._session.get_file_type() == 'ccp4_mtz'
+    arrays = self._session.get_miller_arrays()
 
     self.intensities = None
     self.batches = None
@@ -71,9 +111,9 @@ def __init__(self, unmerged_mtz, params):
 
     assert self.intensities is not None
     assert self.batches is not None
-    self.mtz_object = reader.file_content()
+    self.mtz_object = self._session.get_mtz_object()
 
-    self.indices = self.mtz_object.extract_original_index_miller_indices()
+    self.indices = self._session.get_original_indices()
     self.intensities = self.intensities.customized_copy(
       indices=self.indices, info=self.intensities.info())
     self.batches = self.batches.customized_copy(
@@ -88,21 +128,77 @@ def __init__(self, unmerged_mtz, params):
     self.intensities.setup_binner(n_bins=self.params.resolution_bins)
     self.merged_intensities = self.intensities.merge_equivalents().array()
 
+    self._sections = { }
+    self._xanalysis = None
+
+  def compute_section(self, name, **kwargs):
+    '''Compute a single section of the report.'''
+
+    return getattr(self, report_sections[name])(**kwargs)
+
+  def compute_sections(self, sections=None, nproc=1, **kwargs):
+    '''Return the named sections of the report (by default all of them) as
+    an ordered dictionary, computing each only when it is first asked for -
+    in a pool of nproc processes if nproc > 1. Any keyword arguments give
+    the arguments for the section of the same name, as a dictionary.'''
+
+    global _pool_report
+
+    if sections is None:
+      sections = report_sections.keys()
+    sections = [s for s in report_sections if s in sections]
+    todo = [s for s in sections if not s in self._sections]
+
+    if nproc > 1 and len(todo) > 1:
+      import multiprocessing
+
+      # the xtriage analyses are shared by several sections: run them once
+      # here, for the processes to inherit
+      if any(s in xtriage_sections for s in todo):
+        self._xtriage_analyses()
+
+      _pool_report = (self, kwargs)
+      pool = multiprocessing.Pool(min(nproc, len(todo)))
+      try:
+        for name, result in pool.imap_unordered(_compute_section, todo):
+          self._sections[name] = result
+      finally:
+        pool.close()
+        pool.join()
+        _pool_report = None
+
+    else:
+      for name in todo:
+        self._sections[name] = self.compute_section(
+          name, **kwargs.get(name, { }))
+
+    return OrderedDict((s, self._sections[s]) for s in sections)
+
+  def json_data(self, sections):
+    '''Return the plots from the sections computed, as JSON data.'''
+
+    json_data = { }
+    for name, result in sections.iteritems():
+      if name in json_sections:
+        json_data.update(result)
+    return json_data
+
 
   def _compute_merging_stats(self):
 
-    from iotbx import merging_statistics
-    self.merging_stats = merging_statistics.dataset_statistics(
-      self.intensities, n_bins=self.params.resolution_bins,
-      cc_one_half_significance_level=self.params.cc_half_significance_level,
-      assert_is_not_unique_set_under_symmetry=False)
+    # as computed by iotbx.merging_statistics by default, which the
+    # session keeps for any other report on the same file
+    self.merging_stats = self._session.merging_statistics(
+      n_bins=self.params.resolution_bins,
+      use_internal_variance=True, eliminate_sys_absent=True,
+      original_indices=True,
+      cc_one_half_significance_level=self.params.cc_half_significance_level)
 
-    intensities_anom = self.intensities.as_anomalous_array()
-    intensities_anom = intensities_anom.map_to_asu().customized_copy(info=self.intensities.info())
-    self.merging_stats_anom = merging_statistics.dataset_statistics(
-      intensities_anom, n_bins=self.params.resolution_bins, anomalous=True,
-      cc_one_half_significance_level=self.params.cc_half_significance_level,
-      assert_is_not_unique_set_under_symmetry=False)
+    self.merging_stats_anom = self._session.merging_statistics(
+      anomalous=True, n_bins=self.params.resolution_bins,
+      use_internal_variance=True, eliminate_sys_absent=True,
+      original_indices=True,
+      cc_one_half_significance_level=self.params.cc_half_significance_level)
 
     self.d_star_sq_bins = [
       (1/bin_stats.d_min**2) for bin_stats in self.merging_stats.bins]
@@ -213,10 +309,13 @@ def symmetry_table_html(self):
         str(self.intensities.unit_cell()))
     return symmetry_table_html
 
-  def xtriage_report(self):
-    xtriage_success = []
-    xtriage_warnings = []
-    xtriage_danger = []
+  def _xtriage_analyses(self):
+    '''Return the xtriage analyses of the intensities, running them (and
+    writing xtriage.log) when first asked for.'''
+
+    if self._xanalysis is not None:
+      return self._xanalysis
+
     s = StringIO()
     pout = printed_output(out=s)
     from mmtbx.scaling.xtriage import xtriage_analyses
@@ -230,6 +329,14 @@ def xtriage_report(self):
       )
     with open('xtriage.log', 'wb') as f:
       print >> f, s.getvalue()
+    self._xanalysis = xanalysis
+    return xanalysis
+
+  def xtriage_report(self):
+    xtriage_success = []
+    xtriage_warnings = []
+    xtriage_danger = []
+    xanalysis = self._xtriage_analyses()
     xs = StringIO()
     xout = xtriage_output(xs)
     xanalysis.show(out=xout)
@@ -250,7 +357,6 @@ def xtriage_report(self):
       if level == 0: xtriage_success.append(d)
       elif level == 1: xtriage_warnings.append(d)
       elif level == 2: xtriage_danger.append(d)
-    self._xanalysis = xanalysis
     return xtriage_success, xtriage_warnings, xtriage_danger
 
   def i_over_sig_i_plot(self):
@@ -578,9 +684,10 @@ def second_moments_plot(self):
     }
 
   def cumulative_intensity_distribution_plot(self):
-    if not self._xanalysis.twin_results:
+    xanalysis = self._xtriage_analyses()
+    if not xanalysis.twin_results:
       return {}
-    nz_test = self._xanalysis.twin_results.nz_test
+    nz_test = xanalysis.twin_results.nz_test
     return {
       'cumulative_intensity_distribution': {
         'data': [
@@ -644,9 +751,10 @@ def cumulative_intensity_distribution_plot(self):
     }
 
   def l_test_plot(self):
-    if not self._xanalysis.twin_results:
+    xanalysis = self._xtriage_analyses()
+    if not xanalysis.twin_results:
       return {}
-    l_test = self._xanalysis.twin_results.l_test
+    l_test = xanalysis.twin_results.l_test
     return {
       'l_test': {
         'data': [
@@ -699,9 +807,10 @@ def l_test_plot(self):
     }
 
   def wilson_plot(self):
-    if not self._xanalysis.wilson_scaling:
+    xanalysis = self._xtriage_analyses()
+    if not xanalysis.wilson_scaling:
       return {}
-    wilson_scaling = self._xanalysis.wilson_scaling
+    wilson_scaling = xanalysis.wilson_scaling
     tickvals_wilson, ticktext_wilson = d_star_sq_to_d_ticks(
       wilson_scaling.d_star_sq, nticks=5)
 
@@ -800,22 +909,13 @@ def run(args):
   merging_stats_table = report.merging_statistics_table()
   symmetry_table_html = report.symmetry_table_html()
 
+  sections = report.compute_sections(params.sections, nproc=params.nproc)
+
   # xtriage
-  xtriage_success, xtriage_warnings, xtriage_danger = report.xtriage_report()
-
-  json_data = {}
-
-  json_data.update(report.multiplicity_vs_resolution_plot())
-  json_data.update(report.multiplicity_histogram())
-  json_data.update(report.completeness_plot())
-  json_data.update(report.scale_rmerge_vs_batch_plot())
-  json_data.update(report.cc_one_half_plot())
-  json_data.update(report.i_over_sig_i_plot())
-  json_data.update(report.second_moments_plot())
-  json_data.update(report.cumulative_intensity_distribution_plot())
-  json_data.update(report.l_test_plot())
-  json_data.update(report.wilson_plot())
-  json_data.update(report.pychef_plots())
+  xtriage_success, xtriage_warnings, xtriage_danger = sections.get(
+    'xtriage', ([], [], []))
+
+  json_data = report.json_data(sections)
 
   import json
 
@@ -827,13 +927,14 @@ def run(args):
   batch_graphs = OrderedDict(
     (k, json.dumps(json_data[k])) for k in
     ('scale_rmerge_vs_batch', 'completeness_vs_dose',
-     'rcp_vs_dose', 'scp_vs_dose', 'rd_vs_batch_difference'))
+     'rcp_vs_dose', 'scp_vs_dose', 'rd_vs_batch_difference')
+    if k in json_data)
 
   misc_graphs = OrderedDict(
     (k, json.dumps(json_data[k])) for k in
     ('cumulative_intensity_distribution', 'l_test', 'multiplicities') if k in json_data)
 
-  misc_graphs.update(report.multiplicity_plots())
+  misc_graphs.update(sections.get('multiplicity', { }))
 
   styles = {}
   for axis in ('h', 'k', 'l'):
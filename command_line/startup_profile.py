@@ -0,0 +1,113 @@
+# Report the time taken to start xia2: the time taken to import each module
+# (on its own, and including the modules it imports in turn) and then to set
+# up the handler singletons which are built on first use (PhilIndex, Syminfo,
+# Citations) - run twice to see the effect of the startup cache.
+
+from __future__ import absolute_import, division
+import __builtin__
+import sys
+import timeit
+
+default_modules = ['xia2.Handlers.Streams',
+                   'xia2.Handlers.Phil',
+                   'xia2.Handlers.Syminfo',
+                   'xia2.Handlers.Citations',
+                   'xia2.command_line.get_image_number']
+
+class import_timer(object):
+  '''Time the modules imported while installed, in place of the builtin
+  __import__.'''
+
+  def __init__(self):
+    self.times = { }
+    self._import = None
+    self._children = [0.0]
+
+    return
+
+  def _timed_import(self, name, *args, **kwargs):
+    before = len(sys.modules)
+    self._children.append(0.0)
+    t0 = timeit.default_timer()
+    try:
+      return self._import(name, *args, **kwargs)
+    finally:
+      t = timeit.default_timer() - t0
+      children = self._children.pop()
+      self._children[-1] += t
+      if len(sys.modules) > before and not name in self.times:
+        self.times[name] = (t - children, t)
+
+  def __enter__(self):
+    self._import = __builtin__.__import__
+    __builtin__.__import__ = self._timed_import
+    return self
+
+  def __exit__(self, *args):
+    __builtin__.__import__ = self._import
+    return False
+
+def _initialise_singletons():
+  '''Set up each of the lazily built handler singletons, returning a list
+  of (name, time or error).'''
+
+  def phil_index():
+    from xia2.Handlers.Phil import PhilIndex
+    PhilIndex.params
+
+  def syminfo():
+    from xia2.Handlers.Syminfo import Syminfo
+    Syminfo.get_syminfo(1)
+
+  def citations():
+    from xia2.Handlers.Citations import Citations
+    Citations.find_citations(program='xia2')
+
+  result = []
+  for name, initialise in [('PhilIndex', phil_index),
+                           ('Syminfo', syminfo),
+                           ('Citations', citations)]:
+    t0 = timeit.default_timer()
+    try:
+      initialise()
+    except Exception, e:
+      result.append((name, 'failed: %s' % str(e)))
+      continue
+    result.append((name, timeit.default_timer() - t0))
+
+  return result
+
+def run(args):
+  n_show = 25
+  modules = []
+  for arg in args:
+    if arg.startswith('n='):
+      n_show = int(arg[2:])
+    else:
+      modules.append(arg)
+  if not modules:
+    modules = default_modules
+
+  t0 = timeit.default_timer()
+  with import_timer() as timer:
+    for module in modules:
+      __import__(module)
+  t_import = timeit.default_timer() - t0
+
+  print 'Import times (s), slowest %d modules:' % n_show
+  print '%10s %10s  %s' % ('self', 'total', 'module')
+  for name, (t_self, t_total) in sorted(
+    timer.times.iteritems(), key=lambda x: x[1][0], reverse=True)[:n_show]:
+    print '%10.4f %10.4f  %s' % (t_self, t_total, name)
+  print '%10s %10.4f  %d modules imported' % ('', t_import, len(timer.times))
+
+  print
+  print 'Initialisation times (s):'
+  for name, t in _initialise_singletons():
+    if isinstance(t, float):
+      print '%10.4f  %s' % (t, name)
+    else:
+      print '%10s  %s %s' % ('', name, t)
+
+if __name__ == '__main__':
+  run(sys.argv[1:])
@@ -18,8 +18,6 @@
 
 from xia2.Applications.xia2_main import check_environment, get_command_line, write_citations, help
 
-from xia2.Applications.xia2_helpers import process_one_sweep
-
 def get_ccp4_version():
   CCP4 = os.environ.get('CCP4')
   if CCP4 is not None:
@@ -29,6 +27,37 @@ def get_ccp4_version():
         version = f.read().strip()
         return version
 
+def load_sweep_result(wavelength, sweep, result, xinfo):
+  '''Update sweep with the serialized indexer/refiner/integrater from
+  process_one_sweep, or remove it if processing failed, then save the
+  intermediate xia2.json file in case a scaling step fails.'''
+
+  success, output, xsweep_dict = result
+  if output is not None:
+    Chatter.write(output)
+  if not success:
+    Chatter.write('Sweep failed: removing %s' %sweep.get_name())
+    wavelength.remove_sweep(sweep)
+    sample = sweep.get_xsample()
+    sample.remove_sweep(sweep)
+  else:
+    assert xsweep_dict is not None
+    Chatter.write('Loading sweep: %s' % sweep.get_name())
+    from xia2.Schema.XSweep import XSweep
+    new_sweep = XSweep.from_dict(xsweep_dict)
+    sweep._indexer = new_sweep._indexer
+    sweep._refiner = new_sweep._refiner
+    sweep._integrater = new_sweep._integrater
+
+  xinfo.as_json(filename='xia2.json')
+
+def scale_crystal(crystal):
+  '''Scale all of the sweeps of a crystal which were processed.'''
+
+  if not crystal._get_integraters():
+    return
+  crystal.get_scaled_merged_reflections()
+
 def xia2_main(stop_after=None):
   '''Actually process something...'''
 
@@ -138,17 +167,43 @@ def xia2_main(stop_after=None):
   if mp_params.mode == 'parallel' and njob > 1:
     driver_type = mp_params.type
     command_line_args = CommandLine.get_argv()[1:]
+
+    from xia2.Driver.DriverFactory import DriverFactory
+    default_driver_type = DriverFactory.get_driver_type()
+
+    if mp_params.sweep_worker == 'fork':
+      from xia2.Applications.xia2_helpers import set_forked_xinfo, \
+           process_one_sweep_forked
+      set_forked_xinfo(xinfo)
+      process_sweep = process_one_sweep_forked
+    else:
+      from xia2.Applications.xia2_helpers import process_one_sweep
+      process_sweep = process_one_sweep
+
+    # one slot runs jobs on the current computer (no need to submit to
+    # qsub), the remainder use the requested driver type
+    from xia2.Applications.xia2_scheduler import scheduler
+    sweep_scheduler = scheduler(
+      [default_driver_type] + [driver_type] * (njob - 1))
+
     for crystal_id in crystals.keys():
-      for wavelength_id in crystals[crystal_id].get_wavelength_names():
-        wavelength = crystals[crystal_id].get_xwavelength(wavelength_id)
+      crystal = crystals[crystal_id]
+      sweep_tasks = []
+      for wavelength_id in crystal.get_wavelength_names():
+        wavelength = crystal.get_xwavelength(wavelength_id)
         sweeps = wavelength.get_sweeps()
         for sweep in sweeps:
           sweep._get_indexer()
           sweep._get_refiner()
           sweep._get_integrater()
-          args.append((
-            group_args(
-              driver_type=driver_type,
+          # index, refine and integrate are run together in one child
+          # xia2.integrate process per sweep
+          sweep_tasks.append(sweep_scheduler.add_task(
+            'integrate %s/%s/%s' % (crystal_id, wavelength_id,
+                                    sweep.get_name()),
+            process_sweep,
+            ((group_args(
+              driver_type=None,
               stop_after=stop_after,
               failover=failover,
               command_line_args=command_line_args,
@@ -156,62 +211,18 @@ def xia2_main(stop_after=None):
               crystal_id=crystal_id,
               wavelength_id=wavelength_id,
               sweep_id=sweep.get_name(),
-              ),))
-
-    from xia2.Driver.DriverFactory import DriverFactory
-    default_driver_type = DriverFactory.get_driver_type()
-
-    # run every nth job on the current computer (no need to submit to qsub)
-    for i_job, arg in enumerate(args):
-      if (i_job % njob) == 0:
-        arg[0].driver_type = default_driver_type
-
-    if mp_params.type == "qsub":
-      method = "sge"
-    else:
-      method = "multiprocessing"
-    nproc = mp_params.nproc
-    qsub_command = mp_params.qsub_command
-    if not qsub_command:
-      qsub_command = 'qsub'
-    qsub_command = '%s -V -cwd -pe smp %d' %(qsub_command, nproc)
-
-    from libtbx import easy_mp
-    results = easy_mp.parallel_map(
-      process_one_sweep, args, processes=njob,
-      #method=method,
-      method="multiprocessing",
-      qsub_command=qsub_command,
-      preserve_order=True,
-      preserve_exception_message=True)
-
-    # Hack to update sweep with the serialized indexers/refiners/integraters
-    i_sweep = 0
-    for crystal_id in crystals.keys():
-      for wavelength_id in crystals[crystal_id].get_wavelength_names():
-        wavelength = crystals[crystal_id].get_xwavelength(wavelength_id)
-        remove_sweeps = []
-        sweeps = wavelength.get_sweeps()
-        for sweep in sweeps:
-          success, output, xsweep_dict = results[i_sweep]
-          if output is not None:
-            Chatter.write(output)
-          if not success:
-            Chatter.write('Sweep failed: removing %s' %sweep.get_name())
-            remove_sweeps.append(sweep)
-          else:
-            assert xsweep_dict is not None
-            Chatter.write('Loading sweep: %s' % sweep.get_name())
-            from xia2.Schema.XSweep import XSweep
-            new_sweep = XSweep.from_dict(xsweep_dict)
-            sweep._indexer = new_sweep._indexer
-            sweep._refiner = new_sweep._refiner
-            sweep._integrater = new_sweep._integrater
-          i_sweep += 1
-        for sweep in remove_sweeps:
-          wavelength.remove_sweep(sweep)
-          sample = sweep.get_xsample()
-          sample.remove_sweep(sweep)
+              ),),),
+            callback=lambda result, wavelength=wavelength, sweep=sweep: \
+              load_sweep_result(wavelength, sweep, result, xinfo)))
+
+      # start preparing and scaling each crystal as soon as all of its
+      # sweeps are integrated, while other crystals are still running
+      if stop_after not in ('index', 'integrate'):
+        sweep_scheduler.add_task(
+          'scale %s' % crystal_id, scale_crystal, (crystal,),
+          depends_on=sweep_tasks, local=True)
+
+    sweep_scheduler.run()
 
   else:
     for crystal_id in crystals.keys():
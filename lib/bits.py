@@ -126,8 +126,9 @@ def _get_number():
 
 ###### END MESSY CODE ######
 
-def auto_logfiler(DriverInstance, extra = None):
-  '''Create a "sensible" log file for this program wrapper & connect it.'''
+def auto_logfiler(DriverInstance, extra = None, number = None):
+  '''Create a "sensible" log file for this program wrapper & connect it,
+  numbered with the next run number unless a number is given.'''
 
   working_directory = DriverInstance.get_working_directory()
 
@@ -135,7 +136,8 @@ def auto_logfiler(DriverInstance, extra = None):
     return
 
   executable = os.path.split(DriverInstance.get_executable())[-1]
-  number = _get_number()
+  if number is None:
+    number = _get_number()
 
   if executable[-4:] == '.bat':
     executable = executable[:-4]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# loggraph.py
+#
+#   This code is distributed under the BSD license, a copy of which is
+#   included in the root directory of this package.
+#
+# An incremental parser for CCP4 loggraph tables, which consumes program
+# output one record at a time (as it is produced) and keeps the tables
+# found so far, so that they are available as soon as the program exits
+# without a second pass over the output. A table starts with a $TABLE
+# record, and is complete after four $$ markers: the column names are
+# between the first and second and the data between the third and fourth.
+
+from __future__ import absolute_import, division
+
+class loggraph_parser(object):
+  '''A state machine to find loggraph tables in program output.'''
+
+  def __init__(self):
+    self._output = None
+    self.reset()
+
+    return
+
+  def reset(self):
+    self._tables = { }
+    self._current = None
+    self._text = []
+    self._n_dollar = 0
+    self.n_records = 0
+
+    return
+
+  def feed(self, record):
+    '''Consume the next record of output.'''
+
+    self.n_records += 1
+
+    if self._current is None:
+      if not '$TABLE' in record:
+        return
+      self._current = record.split(':')[1].replace('>', '').strip()
+      self._text = []
+      self._n_dollar = 0
+
+    self._n_dollar += record.count('$$')
+    self._text.append(record)
+
+    if self._n_dollar >= 4:
+      self._finish_table()
+
+    return
+
+  def _finish_table(self):
+    tokens = ''.join(self._text).split('$$')
+
+    columns = tokens[1].split()
+    data = []
+
+    # code around cases where columns merge together...
+
+    for line in tokens[3].split('\n'):
+      record = line.split()
+      if len(record) == len(columns):
+        data.append(record)
+
+    self._tables[self._current] = {'columns':columns, 'data':data}
+
+    self._current = None
+    self._text = []
+
+    return
+
+  def update(self, output):
+    '''Consume the records of output which have not yet been seen: if output
+    is not the list of records previously given start again from the
+    beginning.'''
+
+    if output is not self._output:
+      self.reset()
+      self._output = output
+
+    if self.n_records < len(output):
+      for record in output[self.n_records:]:
+        self.feed(record)
+
+    return
+
+  def get_tables(self):
+    '''Return the complete tables, as a dictionary keyed by name of
+    dictionaries with the column names ('columns') and rows of values as
+    strings ('data'), as expected by transpose_loggraph.'''
+
+    if self._current is not None:
+      raise RuntimeError, 'loggraph "%s" broken' % self._current
+
+    return self._tables
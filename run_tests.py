@@ -15,6 +15,9 @@
 tst_list = (
   "$D/Test/Schema/TstXProject.py",
   "$D/Test/Handlers/TstXinfo.py",
+  "$D/Test/Driver/TstOutputStore.py",
+  "$D/Test/Driver/TstStreamingDriver.py",
+  "$D/Test/Applications/TstScheduler.py",
   ["$D/Test/Wrappers/Dials/TstDialsWrappers.py", "1"],
   #["$D/Test/Modules/Refiner/TstDialsRefiner.py", "1"],
   ["$D/Test/Modules/Integrater/TstMosflmIntegrater.py", "1"], # serial
@@ -29,12 +32,17 @@
   ["$D/Test/Modules/Indexer/TstXDSIndexerII.py", "1"],
   ["$D/Test/Modules/Scaler/TstCCP4ScalerA.py", "1"],
   ["$D/Test/Modules/Scaler/TstXDSScalerA.py", "1"],
+  "$D/Test/Modules/Scaler/TstAddMtzHistory.py",
+  "$D/Test/Experts/TstRemoveBlank.py",
   "$D/Test/Wrappers/CCP4/TstBlend.py",
+  "$D/Test/Wrappers/XDS/TstXDSIntegrateHelpers.py",
   "$D/Test/Wrappers/Labelit/TstLabelitIndex.py",
   "$D/Test/Wrappers/Mosflm/TstMosflmIndex.py",
   "$D/Test/Wrappers/Mosflm/TstMosflmRefineCell.py",
   "$D/Test/System/TstRunXia2.py",
   "$D/Test/Modules/TstPychef.py",
+  "$D/Test/Modules/TstPyStatistics.py",
+  "$D/Test/Modules/TstDeltaCcHalf.py",
 )
 
 def run():